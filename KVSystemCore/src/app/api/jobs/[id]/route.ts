@@ -0,0 +1,35 @@
+import { NextResponse } from 'next/server'
+import { KV_SERVER_URL } from '@/lib/server'
+
+async function forward(method: 'GET' | 'DELETE', id: string) {
+  try {
+    const response = await fetch(`${KV_SERVER_URL}/jobs/${encodeURIComponent(id)}`, {
+      method,
+      cache: 'no-store'
+    })
+    const data = await response.json()
+    return NextResponse.json(data, { status: response.status })
+  } catch (error) {
+    console.error(`[API] Error in jobs/${id} (${method}):`, error)
+    return NextResponse.json(
+      { success: false, error: error instanceof Error ? error.message : 'Internal server error' },
+      { status: 500 }
+    )
+  }
+}
+
+// Polls a job's status and, once finished, its result
+export async function GET(
+  request: Request,
+  { params }: { params: { id: string } }
+) {
+  return forward('GET', params.id)
+}
+
+// Cancels a queued or running job
+export async function DELETE(
+  request: Request,
+  { params }: { params: { id: string } }
+) {
+  return forward('DELETE', params.id)
+}
@@ -0,0 +1,48 @@
+import { NextRequest, NextResponse } from 'next/server'
+import { KV_SERVER_URL, clientHeaders } from '@/lib/server'
+
+// Submits a generation job; the server answers immediately with a job id to poll
+export async function POST(request: NextRequest) {
+  try {
+    // The server trusts this proxy's word on who is asking and how urgently, so the browser doesn't get a say
+    const { user_id, priority, ...payload } = await request.json()
+    console.log('[API] Submitting job:', {
+      ...payload,
+      positive_prompt: payload.positive_prompt?.substring(0, 100) + '...' // Truncate for logging
+    })
+
+    const headers: Record<string, string> = {
+      'Content-Type': 'application/json',
+      // The server queues each browser's jobs fairly against everyone else's
+      ...(await clientHeaders(request)),
+    }
+    // Lets the server hand a retried submission the job it already started
+    const idempotencyKey = request.headers.get('Idempotency-Key')
+    if (idempotencyKey) {
+      headers['Idempotency-Key'] = idempotencyKey
+    }
+
+    const response = await fetch(`${KV_SERVER_URL}/jobs`, {
+      method: 'POST',
+      headers,
+      body: JSON.stringify(payload)
+    })
+
+    const data = await response.json()
+    if (!response.ok) {
+      console.error('[API] Error submitting job:', data)
+    }
+    // A 429 says when the queue is expected to have room again
+    const retryAfter = response.headers.get('Retry-After')
+    return NextResponse.json(data, {
+      status: response.status,
+      headers: retryAfter ? { 'Retry-After': retryAfter } : undefined
+    })
+  } catch (error) {
+    console.error('[API] Error in jobs:', error)
+    return NextResponse.json(
+      { success: false, error: error instanceof Error ? error.message : 'Internal server error' },
+      { status: 500 }
+    )
+  }
+}
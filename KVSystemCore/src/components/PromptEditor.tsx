@@ -1,6 +1,6 @@
 'use client'
 
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
 import { Card } from '@/components/ui/card'
 import { Button } from '@/components/ui/button'
 import { Textarea } from '@/components/ui/textarea'
@@ -14,6 +14,9 @@ import { useToast } from '@/components/ui/use-toast'
 import { useProduct } from '@/lib/contexts/ProductContext'
 import { supabase } from '@/lib/supabase'
 
+// Consecutive failed status polls tolerated before a generation is given up on
+const MAX_MISSED_POLLS = 5;
+
 export default function PromptEditor() {
   const { selectedStyle } = useStyle()
   const { selectedProduct } = useProduct()
@@ -32,6 +35,7 @@ export default function PromptEditor() {
     seed: number;
   }>>([])
   const [currentImageIndex, setCurrentImageIndex] = useState(0)
+  const jobIdRef = useRef<string | null>(null)
 
   useEffect(() => {
     if (selectedStyle) {
@@ -71,17 +75,20 @@ export default function PromptEditor() {
       });
 
       const payload = {
+        type: 'flux_lora',
         width,
         height,
         lora_name,
         positive_prompt: combinedPrompt,
         negative_prompt: "",
-        batch_size: variants
+        batch_size: variants,
+        product: selectedProduct.name,
+        style: selectedStyle.name
       };
 
-      console.log('[Generate] Sending request with payload:', JSON.stringify(payload, null, 2));
+      console.log('[Generate] Submitting job with payload:', JSON.stringify(payload, null, 2));
 
-      const response = await fetch('/api/generate', {
+      const submitResponse = await fetch('/api/jobs', {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -89,8 +96,45 @@ export default function PromptEditor() {
         body: JSON.stringify(payload),
       });
 
-      const data = await response.json();
-      console.log('[Generate] Received response:', data);
+      let job = await submitResponse.json();
+      if (!submitResponse.ok || !job.success) {
+        throw new Error(job.error || 'Failed to submit generation job');
+      }
+      jobIdRef.current = job.job_id;
+
+      // Poll until the job finishes instead of holding one long request open
+      let missedPolls = 0;
+      while (job.status === 'queued' || job.status === 'running') {
+        await new Promise(resolve => setTimeout(resolve, 1500));
+        let polled: { error?: string } | null = null;
+        try {
+          const pollResponse = await fetch(`/api/jobs/${job.job_id}`, { cache: 'no-store' });
+          polled = await pollResponse.json();
+          if (pollResponse.ok) {
+            job = polled;
+            missedPolls = 0;
+            continue;
+          }
+        } catch (error) {
+          console.warn('[Generate] Job poll failed:', error);
+        }
+        // A restarting server or a dropped connection is worth a few more tries
+        missedPolls += 1;
+        if (missedPolls >= MAX_MISSED_POLLS) {
+          throw new Error(polled?.error || 'Lost track of generation job');
+        }
+      }
+      jobIdRef.current = null;
+
+      if (job.status === 'cancelled') {
+        return;
+      }
+      if (job.status !== 'succeeded') {
+        throw new Error(job.error || 'Failed to generate image');
+      }
+
+      const data = job.result;
+      console.log('[Generate] Received result:', data);
 
       if (!data || Object.keys(data).length === 0) {
         throw new Error('No result received from server');
@@ -144,12 +188,20 @@ export default function PromptEditor() {
         variant: "destructive",
       });
     } finally {
+      jobIdRef.current = null;
       setIsGenerating(false);
     }
   };
 
-  const handleStop = () => {
-    // TODO: Implement stop generation logic when API supports it
+  const handleStop = async () => {
+    const jobId = jobIdRef.current;
+    if (jobId) {
+      try {
+        await fetch(`/api/jobs/${jobId}`, { method: 'DELETE' });
+      } catch (error) {
+        console.error('[Generate] Failed to cancel job:', error);
+      }
+    }
     setIsGenerating(false);
   };
 
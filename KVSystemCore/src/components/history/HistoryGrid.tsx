@@ -49,7 +49,7 @@ export default function HistoryGrid({ images, onToggleFavorite, onDownload, onDe
             <div className="relative h-[320px]">
               {image.image_url && (
                 <Image
-                  src={image.image_url}
+                  src={image.variants?.['512'] ?? image.image_url}
                   alt={image.prompt || 'Generated image'}
                   fill
                   className="object-contain transition-transform group-hover:scale-105"
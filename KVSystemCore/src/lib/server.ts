@@ -0,0 +1,45 @@
+import { createRouteHandlerClient } from '@supabase/auth-helpers-nextjs'
+import { cookies } from 'next/headers'
+import type { NextRequest } from 'next/server'
+
+// The KV System server the API routes forward to; set KV_SERVER_URL to use another deployment
+export const KV_SERVER_URL = (process.env.KV_SERVER_URL || 'https://kv-system-server-production.up.railway.app')
+  .replace(/\/+$/, '')
+
+// Shared with the server (KV_PROXY_SECRET there too); it only believes who a request is for,
+// and its priority, when the request carries this. Server-only: never expose it to the browser.
+const KV_PROXY_SECRET = process.env.KV_PROXY_SECRET
+if (!KV_PROXY_SECRET) {
+  console.warn('[API] KV_PROXY_SECRET is not set; the server will count every user as this proxy')
+}
+
+// Identifies the browser behind a proxied request, so the server queues each user's
+// generations fairly instead of counting everyone as this proxy's address
+export async function clientHeaders(request: NextRequest): Promise<Record<string, string>> {
+  const headers: Record<string, string> = {}
+  if (KV_PROXY_SECRET) {
+    headers['X-Proxy-Secret'] = KV_PROXY_SECRET
+  }
+  const address = request.ip
+    || request.headers.get('X-Forwarded-For')?.split(',')[0].trim()
+    || request.headers.get('X-Real-IP')
+  if (address) {
+    headers['X-Forwarded-For'] = address
+  }
+
+  let userId: string | undefined
+  try {
+    const cookieStore = cookies()
+    const supabase = createRouteHandlerClient({ cookies: () => cookieStore })
+    const { data } = await supabase.auth.getSession()
+    userId = data.session?.user.id
+  } catch (error) {
+    console.warn('[API] Could not read the Supabase session:', error)
+  }
+  if (userId) {
+    headers['X-Client-Id'] = `user:${userId}`
+  } else if (address) {
+    headers['X-Client-Id'] = `ip:${address}`
+  }
+  return headers
+}
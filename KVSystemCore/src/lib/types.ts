@@ -46,4 +46,5 @@ export interface ImageGeneration {
   seed: number | null
   node_id: string | null
   favorite: boolean | null
+  variants?: { master?: string; '256'?: string; '512'?: string } | null
 }
\ No newline at end of file
@@ -0,0 +1,2 @@
+-- WebP/AVIF master and thumbnail URLs written by the generation server
+ALTER TABLE public.image_generations ADD COLUMN IF NOT EXISTS variants jsonb;
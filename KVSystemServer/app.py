@@ -1,6 +1,23 @@
-from quart import Quart, render_template, request, jsonify
-from async_image_processor import AsyncImageProcessor
+from quart import Quart, render_template, request, jsonify, make_response
+from async_image_processor import AsyncImageProcessor, PROMPT_TEMPLATE, FLUX_LORA_TEMPLATE, bind_flux_lora_workflow
 from async_llm_processor import AsyncLLMProcessor
+from llm_cache import LLMCache
+from backend_pool import BackendPool
+from fair_scheduler import FairScheduler, SchedulerFull, INTERACTIVE, BULK, PRIORITIES, default_priority
+from workflow_registry import get_registry
+from workflow_optimizer import get_optimizer
+from generation_batcher import GenerationBatcher, split_batch
+from generation_cache import GenerationCache, canonical_hash
+from prompt_cache import PromptCache
+from persistence import get_persister
+from job_manager import Job, JobRegistry, JobFailed
+from progress_stream import JobProgress, format_sse, stream_job_events, stream_shared_job_events
+from node_profiler import get_profiler
+import metrics
+import asyncio
+import hmac
+import io
+from collections import namedtuple
 import os
 import logging
 from datetime import datetime
@@ -17,6 +34,255 @@ logging.getLogger("hpack").setLevel(logging.WARNING)
 # Configure the output directory path
 COMFYUI_OUTPUT_DIR = os.path.join("D:", "ComfyUI", "ComfyUI", "output")  # Adjust this path to match your ComfyUI installation
 
+# Longest a generation may take, waiting for a backend and in the ComfyUI queue included.
+# Requests can ask for less with a "timeout" field or an X-Request-Timeout header.
+GENERATION_DEADLINE_SECONDS = float(os.environ.get("GENERATION_DEADLINE_SECONDS", 600))
+PROMPT_DEADLINE_SECONDS = float(os.environ.get("PROMPT_DEADLINE_SECONDS", 300))
+# Prompts accepted by one /run_llm/batch call
+LLM_BATCH_MAX_PROMPTS = int(os.environ.get("LLM_BATCH_MAX_PROMPTS", 500))
+# Shared with the web app, whose API routes send it as X-Proxy-Secret. The server is reachable
+# directly, so only requests carrying it may say which user they are for or ask for interactive
+# priority; without it set, every request counts against its address.
+PROXY_SECRET = os.environ.get("KV_PROXY_SECRET", "")
+
+@app.before_serving
+async def startup():
+    # Load and validate every workflow template once, before taking requests
+    app.workflow_registry = get_registry()
+    # One pooled client per ComfyUI backend per hypercorn worker, shared by every request
+    app.backend_pool = BackendPool()
+    await app.backend_pool.start()
+    # Bounds what reaches the backends and shares the wait fairly between users
+    app.scheduler = FairScheduler(app.backend_pool)
+    # Jobs run in the worker that accepted them; their state is shared with the other workers
+    app.job_registry = JobRegistry()
+    # Compatible flux_lora requests arriving close together share one ComfyUI prompt
+    app.flux_batcher = GenerationBatcher(run_flux_lora_batch)
+    # Results of seeded generations and idempotent requests, shared by workers, with in-flight deduplication
+    app.generation_cache = GenerationCache()
+    # Prompts already extracted from an image, persisted across restarts and workers
+    app.prompt_cache = PromptCache()
+    # DeepSeek responses for batch prompt optimization, so unchanged prompts aren't re-run
+    app.llm_cache = LLMCache()
+    # Refuse to serve rather than store every image without its variants
+    if get_persister().postprocessor is not None:
+        await get_persister().postprocessor.check()
+
+@app.after_serving
+async def shutdown():
+    await app.job_registry.close()
+    await app.flux_batcher.close()
+    await app.backend_pool.close()
+    # Let uploads still running behind early responses finish
+    await get_persister().close()
+    app.generation_cache.cache.close()
+    app.prompt_cache.cache.close()
+    app.llm_cache.cache.close()
+
+@app.before_request
+async def label_request():
+    # Stage timings recorded while serving this request, or by tasks it starts, carry its route
+    metrics.set_labels(route=request.url_rule.rule if request.url_rule else 'unmatched')
+
+FLUX_LORA_FIELDS = ['width', 'height', 'lora_name', 'positive_prompt', 'negative_prompt', 'batch_size', 'product','style']
+# Request fields that shape a cached flux_lora result beyond the workflow itself
+FLUX_LORA_METADATA_FIELDS = ['negative_prompt', 'product', 'style', 'inline_thumbnails']
+
+def missing_flux_lora_field(data):
+    """Return the first required generate_flux_lora field absent from data"""
+    for field in FLUX_LORA_FIELDS:
+        if field not in data:
+            return field
+    return None
+
+def request_deadline(data, limit):
+    """Seconds this request may run: what the client asked for, capped at ``limit``"""
+    value = data.get('timeout') or request.headers.get('X-Request-Timeout')
+    try:
+        seconds = float(value) if value else limit
+    except (TypeError, ValueError):
+        seconds = limit
+    return min(seconds, limit) if seconds > 0 else limit
+
+def from_trusted_proxy():
+    """Whether the request came through the web app's proxy, per its X-Proxy-Secret"""
+    secret = request.headers.get('X-Proxy-Secret', '')
+    return bool(PROXY_SECRET) and hmac.compare_digest(secret.encode(), PROXY_SECRET.encode())
+
+def request_user(data):
+    """Who a request counts against for fair queuing.
+
+    From the trusted proxy: X-User-Id, else X-Client-Id, which the web app
+    sets to the signed-in user or the browser's address, else a user_id
+    field, else the forwarded client address. Anyone else is their own
+    address, however they label themselves.
+    """
+    if from_trusted_proxy():
+        forwarded = request.headers.get('X-Forwarded-For', '').split(',')[0].strip()
+        user = (request.headers.get('X-User-Id') or request.headers.get('X-Client-Id') or data.get('user_id')
+                or forwarded)
+        if user:
+            return user
+    return request.remote_addr or 'anonymous'
+
+def request_priority(data, images=1):
+    """The priority class asked for, else interactive for small requests and bulk for big ones.
+
+    Only the trusted proxy may raise a request to interactive; anyone may lower theirs to bulk.
+    """
+    priority = data.get('priority') or request.headers.get('X-Priority')
+    if priority == BULK or (priority in PRIORITIES and from_trusted_proxy()):
+        return priority
+    return default_priority(images)
+
+def too_busy(e):
+    return jsonify({
+        'success': False,
+        'error': str(e),
+        'steps': []
+    }), 429, {'Retry-After': str(e.retry_after)}
+
+def cache_bypassed(form):
+    """True when the client asked for a fresh result via ?bypass_cache=1 or a bypass_cache form field"""
+    value = request.args.get('bypass_cache') or form.get('bypass_cache') or ''
+    return value.lower() in ('1', 'true', 'yes')
+
+async def run_image_prompt(image_data, on_event=None, bypass_cache=False, user='anonymous', check_limits=True):
+    # The same reference images come back all the time; reuse their prompt unless told not to
+    image_bytes = image_data.read()
+    image_data.seek(0)
+    version = app.workflow_registry.get(PROMPT_TEMPLATE).version
+    cache_keys = await asyncio.to_thread(app.prompt_cache.keys, image_bytes, version)
+    if not bypass_cache:
+        cached = await app.prompt_cache.get(cache_keys)
+        if cached is not None:
+            return {'success': True, 'error': None, 'cached': True, **cached}
+
+    async with app.scheduler.slot(user, INTERACTIVE, check=check_limits), \
+            app.backend_pool.acquire(model=PROMPT_TEMPLATE) as backend, \
+            AsyncImageProcessor(output_dir=COMFYUI_OUTPUT_DIR, client=backend.client,
+                                registry=app.workflow_registry, on_event=on_event) as processor:
+        with metrics.labels(template=PROMPT_TEMPLATE, backend=backend.address):
+            result = await processor.process_image_prompt(image_data)
+    if result['success']:
+        await app.prompt_cache.put(cache_keys, result['final_prompt'], result['steps'])
+    return result
+
+def flux_lora_batch_key(data):
+    """Requests with equal keys can be generated as one batched prompt.
+
+    Everything that conditions the whole batch must match; sampler settings
+    come from the template and so are always shared. A request pinning its
+    seed is never merged, since the images of a batch all derive from the
+    batch's seed.
+    """
+    if data.get('seed') is not None:
+        return None
+    return (data['lora_name'], int(data['width']), int(data['height']),
+            data['positive_prompt'], data['negative_prompt'])
+
+def seeded_flux_lora_workflow(data):
+    """The workflow a seeded request will queue, bound once for both its cache key and its run.
+
+    Without a seed the seed is only drawn at run time, so there is nothing to bind yet.
+    """
+    if data.get('seed') is None:
+        return None
+    return bind_flux_lora_workflow(app.workflow_registry, int(data['width']), int(data['height']),
+                                   data['lora_name'], data['positive_prompt'], data['negative_prompt'],
+                                   int(data['batch_size']), int(data['seed']))
+
+def flux_lora_cache_key(data, workflow):
+    """Content address of a seeded request: the exact workflow it queues and the metadata its rows carry.
+
+    The optimized workflow can drop fields that still go into the stored
+    rows, e.g. the negative prompt at cfg 1, so those are hashed alongside.
+    """
+    if workflow is None:
+        return None
+    metadata = {field: data.get(field) for field in FLUX_LORA_METADATA_FIELDS}
+    return f"workflow:{FLUX_LORA_TEMPLATE}:{canonical_hash({'workflow': workflow, 'metadata': metadata})}"
+
+def idempotency_key(params):
+    """Scope the client's Idempotency-Key header to the request it came with"""
+    key = request.headers.get('Idempotency-Key')
+    if not key:
+        return None
+    return f"idempotency:{canonical_hash({'key': key, 'params': params})}"
+
+# One caller's share of a merged flux_lora batch
+FluxLoraRequest = namedtuple('FluxLoraRequest', 'data on_event workflow user priority')
+
+async def run_flux_lora(data, on_event=None, user='anonymous', priority=INTERACTIVE, check_limits=True):
+    images = int(data['batch_size'])
+    workflow = seeded_flux_lora_workflow(data)
+
+    async def generate():
+        # Only work that reaches a backend is admitted; cached results skip the limits. The scheduler
+        # slot itself is taken per merged batch, so waiting in a batch window holds no slot
+        if check_limits:
+            app.scheduler.check(user)
+        return await app.flux_batcher.submit(flux_lora_batch_key(data),
+                                             FluxLoraRequest(data, on_event, workflow, user, priority), images)
+
+    # Identical seeded requests share one run and afterwards its stored Supabase URLs
+    return await app.generation_cache.get_or_run(flux_lora_cache_key(data, workflow), generate)
+
+async def run_flux_lora_batch(requests, sizes):
+    """Generate a merged batch once, then save each caller's share of the images"""
+    data = requests[0].data
+    listeners = [item.on_event for item in requests if item.on_event is not None]
+    # Only seeded requests arrive bound, and those are never merged
+    workflow = requests[0].workflow if len(requests) == 1 else None
+    # The batch is one backend job, so it takes one scheduler turn: charged to its first caller,
+    # for all its images, and interactive if any caller is
+    priority = INTERACTIVE if any(item.priority == INTERACTIVE for item in requests) else BULK
+
+    async def on_event(event):
+        await asyncio.gather(*(listener(event) for listener in listeners))
+
+    # Send the job where its unet and LoRA are most likely already loaded
+    unet_name = app.workflow_registry.get(FLUX_LORA_TEMPLATE).default('unet_name')
+    async with app.scheduler.slot(requests[0].user, priority, sum(sizes), check=False), \
+            app.backend_pool.acquire(model=unet_name, lora=data['lora_name']) as backend, \
+            AsyncImageProcessor(output_dir=COMFYUI_OUTPUT_DIR, client=backend.client,
+                                registry=app.workflow_registry,
+                                on_event=on_event if listeners else None) as processor:
+        # Label the rest of this generation's stages, downloads and storage uploads included
+        metrics.set_labels(template=FLUX_LORA_TEMPLATE, backend=backend.address,
+                           lora_name=metrics.lora_label(data['lora_name']))
+        generation = await processor.generate_flux_gguf_lora_basic(
+            width=data['width'],
+            height=data['height'],
+            lora_name=data['lora_name'],
+            positive_prompt=data['positive_prompt'],
+            negative_prompt=data['negative_prompt'],
+            batch_size=sum(sizes),
+            seed=data.get('seed'),
+            workflow=workflow
+        )
+        if generation is None:
+            return [None] * len(requests)
+
+        offsets = [sum(sizes[:index]) for index in range(len(sizes))]
+        return await asyncio.gather(*(
+            processor.save_flux_gguf_lora_basic_images(
+                images,
+                seed=generation['seed'],
+                width=request_data['width'],
+                height=request_data['height'],
+                lora_name=request_data['lora_name'],
+                positive_prompt=request_data['positive_prompt'],
+                negative_prompt=request_data['negative_prompt'],
+                style=request_data['style'],
+                product=request_data['product'],
+                batch_offset=offset,
+                background=request_data.get('persist_in_background'),
+                inline_thumbnails=bool(request_data.get('inline_thumbnails'))
+            )
+            for (request_data, *_), images, offset in zip(requests, split_batch(generation['images'], sizes), offsets)
+        ))
+
 @app.route('/')
 async def home():
     return await render_template('index.html')
@@ -52,20 +318,33 @@ async def generate_prompt():
                 'steps': []
             }), 400
 
-        async with AsyncImageProcessor(output_dir=COMFYUI_OUTPUT_DIR) as processor:
-            result = await processor.process_image_prompt(image_file.stream)
+        form = await request.form
+        deadline = request_deadline(form, PROMPT_DEADLINE_SECONDS)
+        # A client disconnect cancels this handler, which also cancels the ComfyUI prompt
+        result = await asyncio.wait_for(run_image_prompt(image_file.stream, bypass_cache=cache_bypassed(form),
+                                                         user=request_user(form)),
+                                        deadline)
             
         response = {
             'success': result['success'],
             'steps': result['steps'],
-            'error': result['error']
+            'error': result['error'],
+            'cached': result.get('cached', False)
         }
             
         if result['success']:
             response['prompt'] = result['final_prompt']
                 
         return jsonify(response), 200 if result['success'] else 500
-        
+
+    except SchedulerFull as e:
+        return too_busy(e)
+    except asyncio.TimeoutError:
+        return jsonify({
+            'success': False,
+            'error': f'Prompt generation did not finish within {deadline:g}s',
+            'steps': []
+        }), 504
     except Exception as e:
         return jsonify({
             'success': False,
@@ -80,31 +359,27 @@ async def generate_flux_lora():
         data = await request.get_json()
         print(f"Request data: {data}")
         
-        required_fields = ['width', 'height', 'lora_name', 'positive_prompt', 'negative_prompt', 'batch_size', 'product','style']
-        
         # Validate required fields
-        for field in required_fields:
-            if field not in data:
-                error_msg = f'Missing required field: {field}'
-                print(f"Error: {error_msg}")
-                return jsonify({
-                    'success': False,
-                    'error': error_msg,
-                    'steps': []
-                }), 400
+        field = missing_flux_lora_field(data)
+        if field is not None:
+            error_msg = f'Missing required field: {field}'
+            print(f"Error: {error_msg}")
+            return jsonify({
+                'success': False,
+                'error': error_msg,
+                'steps': []
+            }), 400
 
         print("All required fields present, processing request...")
-        async with AsyncImageProcessor(output_dir=COMFYUI_OUTPUT_DIR) as processor:
-            result = await processor.process_flux_gguf_lora_basic(
-                width=data['width'],
-                height=data['height'],
-                lora_name=data['lora_name'],
-                positive_prompt=data['positive_prompt'],
-                negative_prompt=data['negative_prompt'],
-                batch_size=data['batch_size'],
-                product=data['product'],
-                style=data['style']
-            )
+        # Retries carrying the same Idempotency-Key get the first request's result.
+        # A client disconnect or the deadline cancels the wait, and with it the
+        # ComfyUI prompt once no other request shares it.
+        deadline = request_deadline(data, GENERATION_DEADLINE_SECONDS)
+        result = await asyncio.wait_for(
+            app.generation_cache.get_or_run(idempotency_key(data), lambda: run_flux_lora(
+                data, user=request_user(data), priority=request_priority(data, int(data['batch_size'])))),
+            deadline
+        )
         
         if result is not None:
             return jsonify(result), 200
@@ -114,7 +389,15 @@ async def generate_flux_lora():
                 'error': 'Failed to generate images',
                 'steps': []
             }), 500
-        
+
+    except SchedulerFull as e:
+        return too_busy(e)
+    except asyncio.TimeoutError:
+        return jsonify({
+            'success': False,
+            'error': f'Generation did not finish within {deadline:g}s',
+            'steps': []
+        }), 504
     except Exception as e:
         error_msg = f"Server error in generate_flux_lora: {str(e)}"
         print(f"Error: {error_msg}")
@@ -124,6 +407,194 @@ async def generate_flux_lora():
             'steps': []
         }), 500
 
+async def flux_lora_job(job, user, priority, deadline=GENERATION_DEADLINE_SECONDS):
+    try:
+        # Admitted when submitted, so the queue limits are not checked again
+        result = await asyncio.wait_for(run_flux_lora(job.params, on_event=JobProgress(job), user=user,
+                                                      priority=priority, check_limits=False), deadline)
+    except asyncio.TimeoutError:
+        raise JobFailed(f'Generation did not finish within {deadline:g}s')
+    if result is None:
+        raise JobFailed('Failed to generate images')
+    return result
+
+async def image_prompt_job(job, image_data, user, bypass_cache=False, deadline=PROMPT_DEADLINE_SECONDS):
+    try:
+        result = await asyncio.wait_for(
+            run_image_prompt(image_data, on_event=JobProgress(job), bypass_cache=bypass_cache, user=user,
+                             check_limits=False), deadline)
+    except asyncio.TimeoutError:
+        raise JobFailed(f'Prompt generation did not finish within {deadline:g}s')
+    if not result['success']:
+        raise JobFailed(result['error'])
+    return {
+        'prompt': result['final_prompt'],
+        'steps': result['steps'],
+        'cached': result.get('cached', False)
+    }
+
+@app.route('/jobs', methods=['POST'])
+async def submit_job():
+    """Accept a generation and return its job id without waiting for it.
+
+    JSON bodies are flux_lora jobs with the same fields as /generate_flux_lora;
+    multipart bodies with an ``image`` file are prompt-extraction jobs.
+    """
+    try:
+        files = await request.files
+        if 'image' in files:
+            image_file = files['image']
+            if image_file.filename == '':
+                return jsonify({
+                    'success': False,
+                    'error': 'No selected file'
+                }), 400
+            # The upload is gone once this request ends, so keep its bytes
+            image_data = io.BytesIO(image_file.read())
+            image_data.name = image_file.filename
+            params = {'filename': image_file.filename}
+            form = await request.form
+            bypass_cache = cache_bypassed(form)
+            deadline = request_deadline(form, PROMPT_DEADLINE_SECONDS)
+            user = request_user(form)
+            app.scheduler.check(user)
+            job = await app.job_registry.submit('vlm_prompt', params,
+                                                lambda job: image_prompt_job(job, image_data, user, bypass_cache,
+                                                                             deadline),
+                                                idempotency_key=idempotency_key(params))
+        else:
+            data = await request.get_json(silent=True)
+            if not data:
+                return jsonify({
+                    'success': False,
+                    'error': 'No job parameters provided'
+                }), 400
+            if data.get('type', 'flux_lora') != 'flux_lora':
+                return jsonify({
+                    'success': False,
+                    'error': f"Unsupported job type: {data.get('type')}"
+                }), 400
+            field = missing_flux_lora_field(data)
+            if field is not None:
+                return jsonify({
+                    'success': False,
+                    'error': f'Missing required field: {field}'
+                }), 400
+            deadline = request_deadline(data, GENERATION_DEADLINE_SECONDS)
+            user = request_user(data)
+            priority = request_priority(data, int(data['batch_size']))
+            key = idempotency_key(data)
+            if key is None or await app.job_registry.find(key) is None:
+                # A retry of a known job is answered with that job, however busy we are
+                app.scheduler.check(user)
+            job = await app.job_registry.submit('flux_lora', data,
+                                                lambda job: flux_lora_job(job, user, priority, deadline),
+                                                idempotency_key=key)
+
+        return jsonify({'success': True, **job.to_dict()}), 202, {'Location': f'/jobs/{job.id}'}
+
+    except SchedulerFull as e:
+        return too_busy(e)
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    job = await app.job_registry.lookup(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': 'Unknown job'
+        }), 404
+    return jsonify({'success': True, **job.to_dict()})
+
+@app.route('/jobs/<job_id>', methods=['DELETE'])
+async def cancel_job(job_id):
+    job = await app.job_registry.cancel(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': 'Unknown job'
+        }), 404
+    return jsonify({'success': True, **job.to_dict()})
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+async def job_events(job_id):
+    """Stream a job's queue position, node, sampling step and previews as server-sent events.
+
+    Previews are only streamed by the worker running the job; elsewhere the
+    stream follows the job's shared state.
+    """
+    job = await app.job_registry.lookup(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'error': 'Unknown job'
+        }), 404
+    events = stream_job_events(job) if isinstance(job, Job) else stream_shared_job_events(app.job_registry, job)
+    response = await make_response(events, {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    response.timeout = None
+    return response
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_endpoint():
+    """Prometheus text exposition of stage timings and current load, for this worker"""
+    metrics.INFLIGHT_JOBS.clear()
+    metrics.BACKEND_QUEUE_DEPTH.clear()
+    metrics.BACKEND_HEALTHY.clear()
+    for backend in app.backend_pool.backends:
+        metrics.INFLIGHT_JOBS.set(backend.inflight, backend=backend.address)
+        metrics.BACKEND_QUEUE_DEPTH.set(backend.queue_running, backend=backend.address, state='running')
+        metrics.BACKEND_QUEUE_DEPTH.set(backend.queue_pending, backend=backend.address, state='pending')
+        metrics.BACKEND_HEALTHY.set(int(backend.healthy), backend=backend.address)
+        metrics.WEBSOCKET_RECONNECTS.set(backend.client.events.reconnects, backend=backend.address)
+    metrics.SCHEDULED_JOBS.set(app.scheduler.inflight, state='running')
+    metrics.SCHEDULED_JOBS.set(app.scheduler.depth, state='waiting')
+    metrics.BACKGROUND_JOBS.clear()
+    for status in ('queued', 'running', 'succeeded', 'failed', 'cancelled'):
+        metrics.BACKGROUND_JOBS.set(0, status=status)
+    for job in app.job_registry.jobs.values():
+        metrics.BACKGROUND_JOBS.inc(status=job.status)
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+@app.route('/profile/nodes', methods=['GET'])
+async def node_profile():
+    """Where recent prompts spent their time, node by node, per template and backend"""
+    return jsonify({
+        'window': get_profiler().window,
+        'templates': get_profiler().to_dict(request.args.get('template'))
+    })
+
+@app.route('/backends', methods=['GET'])
+async def backends():
+    return jsonify({
+        **app.backend_pool.to_dict(),
+        'scheduler': app.scheduler.to_dict(),
+        'batching': app.flux_batcher.to_dict(),
+        'generation_cache': app.generation_cache.to_dict(),
+        'prompt_cache': app.prompt_cache.to_dict(),
+        'llm_cache': app.llm_cache.to_dict(),
+        'workflow_optimizer': get_optimizer().to_dict()
+    })
+
+async def stream_llm(processor, prompt):
+    """Server-sent ``token`` events as DeepSeek produces them, then ``done`` with the whole text, or ``error``"""
+    parts = []
+    try:
+        async for text in processor.stream(prompt):
+            parts.append(text)
+            yield format_sse('token', {'text': text})
+        yield format_sse('done', {'success': True, 'response': ''.join(parts).strip()})
+    except Exception as e:
+        yield format_sse('error', {'success': False, 'error': str(e)})
+
 @app.route('/run_llm', methods=['POST'])
 async def run_llm():
     try:
@@ -135,7 +606,16 @@ async def run_llm():
             }), 400
 
         prompt = data['prompt']
-        processor = AsyncLLMProcessor()
+        processor = AsyncLLMProcessor(session=app.backend_pool.session)
+        if data.get('stream') or 'text/event-stream' in request.headers.get('Accept', ''):
+            response = await make_response(stream_llm(processor, prompt), {
+                'Content-Type': 'text/event-stream',
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            })
+            response.timeout = None
+            return response
+
         response = await processor.process(prompt)
         
         return jsonify({
@@ -149,6 +629,64 @@ async def run_llm():
             'error': str(e)
         }), 500
 
+async def stream_llm_batch(results):
+    """A ``result`` event per prompt as it finishes, then ``done`` with the counts"""
+    counts = {'succeeded': 0, 'failed': 0, 'cached': 0}
+    async for result in results:
+        counts['succeeded' if result['success'] else 'failed'] += 1
+        counts['cached'] += result['cached']
+        yield format_sse('result', result)
+    yield format_sse('done', {'success': True, **counts})
+
+@app.route('/run_llm/batch', methods=['POST'])
+async def run_llm_batch():
+    """Run many prompts at once, e.g. every style x product pair of a catalog.
+
+    Takes ``{"prompts": [...]}``. Answers with the results in prompt order, or
+    with ``"stream": true`` streams each as it finishes. Responses are cached
+    on disk unless ``bypass_cache`` is set, so unchanged prompts cost nothing.
+    """
+    try:
+        data = await request.get_json()
+        prompts = (data or {}).get('prompts')
+        if not prompts or not isinstance(prompts, list) or not all(isinstance(prompt, str) for prompt in prompts):
+            return jsonify({
+                'success': False,
+                'error': 'No prompts provided'
+            }), 400
+        if len(prompts) > LLM_BATCH_MAX_PROMPTS:
+            return jsonify({
+                'success': False,
+                'error': f'At most {LLM_BATCH_MAX_PROMPTS} prompts per batch'
+            }), 400
+
+        processor = AsyncLLMProcessor(session=app.backend_pool.session)
+        bypass_cache = bool(data.get('bypass_cache')) or cache_bypassed({})
+        results = processor.process_many(prompts, cache=app.llm_cache, bypass_cache=bypass_cache)
+        if data.get('stream') or 'text/event-stream' in request.headers.get('Accept', ''):
+            response = await make_response(stream_llm_batch(results), {
+                'Content-Type': 'text/event-stream',
+                'Cache-Control': 'no-cache',
+                'X-Accel-Buffering': 'no'
+            })
+            response.timeout = None
+            return response
+
+        ordered = [None] * len(prompts)
+        async for result in results:
+            ordered[result['index']] = result
+        return jsonify({
+            'success': all(result['success'] for result in ordered),
+            'results': ordered,
+            'cached': sum(result['cached'] for result in ordered)
+        })
+
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e)
+        }), 500
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port)
@@ -1,44 +1,87 @@
+import asyncio
 import uuid
-import json
 import os
-import aiohttp
-import websockets
 import random
-import base64
+import io
 import time
 import urllib.request
-import urllib.parse
-from typing import BinaryIO, Dict, Any, List, Union
+from typing import Awaitable, BinaryIO, Callable, Dict, Any, List, Optional
 from datetime import datetime
 import logging
-from supabase_client import SupabaseClient
+from persistence import ImagePersister, PERSIST_IN_BACKGROUND, get_persister
+from comfyui_client import ComfyUIClient
+from comfyui_events import PromptWatcher
+from workflow_registry import WorkflowRegistry, get_registry
+from workflow_optimizer import get_optimizer
+from upload_cache import get_upload_cache
+from image_stream import SpooledImage, encode_thumbnail
+from metrics import current_labels, observe_stage, time_stage
+from node_profiler import PromptProfile, get_profiler
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Workflow templates used by the processors, see workflow/*.slots.json
+PROMPT_TEMPLATE = "MiniCPMV-Prompt-Inference-Ali"
+FLUX_LORA_TEMPLATE = "Flux_GGUF_Lora_Basic_Ali"
+
+# How often to poll /history for a prompt while the websocket is down
+HISTORY_POLL_INTERVAL = float(os.environ.get("COMFYUI_HISTORY_POLL_INTERVAL", 1.0))
+# How often to refresh a waiting prompt's queue position for progress listeners
+QUEUE_POLL_INTERVAL = float(os.environ.get("COMFYUI_QUEUE_POLL_INTERVAL", 2.0))
+
+def bind_flux_lora_workflow(registry: WorkflowRegistry, width: int, height: int, lora_name: str,
+                            positive_prompt: str, negative_prompt: str, batch_size: int, seed: int) -> Dict[str, Any]:
+    """Bind the Flux LoRA template's parameters into a request-ready, optimized workflow"""
+    template = registry.get(FLUX_LORA_TEMPLATE)
+    return get_optimizer().optimize(template, template.bind(
+        width=width,
+        height=height,
+        batch_size=batch_size,
+        lora_name=lora_name,
+        positive=positive_prompt,
+        negative=negative_prompt,
+        seed=seed
+    ))
+
 class AsyncImageProcessor:
     #def __init__(self, server_address="127.0.0.1:8188", output_dir=None):
-    def __init__(self, server_address="kv-g.1240865249176120.ap-southeast-1.pai-eas.aliyuncs.com", output_dir=None):
-        self.server_address = server_address.rstrip('/')  # Remove trailing slash if present
-        self.client_id = str(uuid.uuid4())
-        self.session = None
+    def __init__(self, server_address="kv-g.1240865249176120.ap-southeast-1.pai-eas.aliyuncs.com", output_dir=None,
+                 client: ComfyUIClient = None, registry: WorkflowRegistry = None,
+                 on_event: Callable[[Dict[str, Any]], Awaitable[None]] = None,
+                 persister: ImagePersister = None):
         self.output_dir = output_dir or os.path.join("D:", "ComfyUI", "ComfyUI", "output")
-        self.headers = {
-            'Content-Type': 'application/json',
-            'Authorization': 'MjA0YWI0Y2RlZWQ2ZGUyYWZlYjdlNGYyNDFhN2E3Y2MxYmFjNmEwZQ=='
-        }
+        self.registry = registry or get_registry()
+        # Optional async callback receiving progress events (queue position, nodes, steps, previews)
+        self.on_event = on_event
+        # Shared Supabase persistence stage for generated images
+        self.persister = persister or get_persister()
+        # A shared ComfyUIClient supplies the pooled session and websocket; otherwise we own a private one
+        self.owns_client = client is None
+        self.client = client or ComfyUIClient(server_address)
+        self.server_address = self.client.server_address
+        self.client_id = self.client.client_id
+        self.headers = self.client.headers
+
+    @property
+    def session(self):
+        return self.client.session
         
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        if self.owns_client:
+            await self.client.start()
         return self
         
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
-            await self.session.close()
+        # The shared client outlives the request and is closed at shutdown
+        if self.owns_client:
+            await self.client.close()
             
-    async def queue_prompt(self, prompt) -> Dict[str, Any]:
+    async def queue_prompt(self, prompt, prompt_id: str = None) -> Dict[str, Any]:
         """Queue a prompt with the ComfyUI server"""
         try:
             data = {"prompt": prompt, "client_id": self.client_id}
+            if prompt_id:
+                data["prompt_id"] = prompt_id
             async with self.session.post(
                 f"http://{self.server_address}/prompt",
                 json=data,
@@ -62,6 +105,209 @@ class AsyncImageProcessor:
                 "error": str(e)
             }
 
+    async def execute_prompt(self, prompt, on_output: Optional[Callable[[str, Dict[str, Any]], None]] = None
+                             ) -> Dict[str, Any]:
+        """Queue a prompt and wait until ComfyUI has finished executing it.
+
+        The watcher is registered under a client-generated prompt_id before the
+        prompt is queued, so even a job that finishes instantly is observed.
+        ``on_output(node_id, output)`` is called as each ``executed`` event
+        arrives, before the rest of the workflow has finished. If the caller
+        is cancelled, e.g. by a deadline or a client disconnect, the prompt is
+        taken off the ComfyUI queue or interrupted.
+        """
+        events = self.client.events
+        watcher = events.watch(str(uuid.uuid4()))
+        try:
+            with time_stage("queue_prompt", backend=self.server_address):
+                queue_result = await self.queue_prompt(prompt, prompt_id=watcher.prompt_id)
+            if not queue_result["success"]:
+                return queue_result
+            # Older servers ignore our prompt_id and assign their own
+            events.rekey(watcher, queue_result["data"]["prompt_id"])
+            await self._emit("queued", {"prompt_id": watcher.prompt_id})
+            # Per-node wall time from the same events, aggregated per template and backend
+            profile = PromptProfile(prompt, current_labels().get("template"), self.server_address)
+            result = await self.wait_for_prompt(watcher, on_output, profile)
+            if result["success"]:
+                get_profiler().record(profile)
+            return result
+        except asyncio.CancelledError:
+            # Nobody is waiting for the images any more; free the GPU for the next job
+            try:
+                await asyncio.shield(self.cancel_prompt(watcher.prompt_id))
+            except asyncio.CancelledError:
+                pass
+            raise
+        finally:
+            events.unwatch(watcher)
+
+    async def cancel_prompt(self, prompt_id: str) -> Dict[str, Any]:
+        """Remove a prompt from the ComfyUI queue, or interrupt it if it is already running"""
+        try:
+            async with self.session.post(
+                f"http://{self.server_address}/queue",
+                json={"delete": [prompt_id]},
+                headers=self.headers
+            ) as response:
+                if response.status != 200:
+                    raise Exception(f"Server returned status {response.status}")
+
+            # Checked after the delete, so a prompt that started meanwhile is still caught
+            queue_result = await self.get_queue()
+            if not queue_result["success"]:
+                raise Exception(queue_result["error"])
+            running = [item[1] for item in queue_result["data"].get("queue_running", [])]
+            if prompt_id not in running:
+                logger.info(f"Removed prompt {prompt_id} from the queue")
+                return {"success": True, "step": "cancel_prompt", "data": {"interrupted": False}}
+
+            # Older servers ignore the prompt_id and interrupt whatever runs, which is this prompt
+            async with self.session.post(
+                f"http://{self.server_address}/interrupt",
+                json={"prompt_id": prompt_id},
+                headers=self.headers
+            ) as response:
+                if response.status != 200:
+                    raise Exception(f"Server returned status {response.status}")
+            logger.info(f"Interrupted prompt {prompt_id}")
+            return {"success": True, "step": "cancel_prompt", "data": {"interrupted": True}}
+        except Exception as e:
+            logger.warning(f"Could not cancel prompt {prompt_id}: {e}")
+            return {
+                "success": False,
+                "step": "cancel_prompt",
+                "error": str(e)
+            }
+
+    async def wait_for_prompt(self, watcher: PromptWatcher,
+                              on_output: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+                              profile: Optional[PromptProfile] = None) -> Dict[str, Any]:
+        """Wait for a prompt's completion events, polling /history while the websocket is down"""
+        prompt_id = watcher.prompt_id
+        polling = not self.client.events.connected.is_set()
+        started = False
+        outputs = {}
+        # Queue wait ends when ComfyUI starts on the prompt; execution runs from there
+        queued_at = time.monotonic()
+        running_since = None
+        while True:
+            if polling:
+                timeout = HISTORY_POLL_INTERVAL
+            elif self.on_event is not None and not started:
+                timeout = QUEUE_POLL_INTERVAL
+            else:
+                timeout = None
+            try:
+                event = await asyncio.wait_for(watcher.get(), timeout)
+            except asyncio.TimeoutError:
+                event = None
+
+            if event is None and not polling:
+                await self._report_queue_position(prompt_id)
+                continue
+
+            if event is None or event["type"] == "disconnected":
+                polling = True
+                if profile is not None:
+                    profile.incomplete = True
+                history_result = await self.get_history(prompt_id)
+                if history_result["success"] and prompt_id in history_result["data"]:
+                    entry = history_result["data"][prompt_id]
+                    if entry.get("status", {}).get("status_str") == "error":
+                        return {
+                            "success": False,
+                            "step": "execute_prompt",
+                            "error": f"Prompt {prompt_id} failed on the server"
+                        }
+                    # Polled results can't tell queueing from execution
+                    observe_stage("execute_workflow", time.monotonic() - (running_since or queued_at),
+                                  backend=self.server_address)
+                    return {
+                        "success": True,
+                        "step": "execute_prompt",
+                        "data": {"prompt_id": prompt_id, "outputs": entry.get("outputs", {})}
+                    }
+                continue
+
+            data = event["data"]
+            if profile is not None:
+                profile.observe(event["type"], data)
+            if event["type"] in ("execution_start", "executing", "progress"):
+                started = True
+                if running_since is None:
+                    running_since = time.monotonic()
+                    observe_stage("queue_wait", running_since - queued_at, backend=self.server_address)
+            await self._emit(event["type"], data)
+            if event["type"] == "executing":
+                logger.debug(f"Executing node: {data.get('node')}")
+                if data.get("node") is None:
+                    observe_stage("execute_workflow", time.monotonic() - (running_since or queued_at),
+                                  backend=self.server_address)
+                    return {
+                        "success": True,
+                        "step": "execute_prompt",
+                        "data": {"prompt_id": prompt_id, "outputs": outputs}
+                    }
+            elif event["type"] == "executed":
+                outputs[data["node"]] = data.get("output")
+                if on_output is not None and data.get("output"):
+                    on_output(data["node"], data["output"])
+            elif event["type"] == "execution_error":
+                return {
+                    "success": False,
+                    "step": "execute_prompt",
+                    "error": f"Node {data.get('node_id')} ({data.get('node_type')}) failed: {data.get('exception_message')}"
+                }
+            elif event["type"] == "execution_interrupted":
+                return {
+                    "success": False,
+                    "step": "execute_prompt",
+                    "error": "Execution was interrupted"
+                }
+
+    async def _emit(self, event_type: str, data: Dict[str, Any]):
+        if self.on_event is not None:
+            try:
+                await self.on_event({"type": event_type, "data": data})
+            except Exception as e:
+                logger.warning(f"Progress listener failed: {e}")
+
+    async def _report_queue_position(self, prompt_id: str):
+        queue_result = await self.get_queue()
+        if not queue_result["success"]:
+            return
+        running = queue_result["data"].get("queue_running", [])
+        pending = sorted(queue_result["data"].get("queue_pending", []), key=lambda item: item[0])
+        pending_ids = [item[1] for item in pending]
+        if prompt_id in pending_ids:
+            await self._emit("queue", {"prompt_id": prompt_id, "position": len(running) + pending_ids.index(prompt_id)})
+
+    async def get_queue(self) -> Dict[str, Any]:
+        """Get the running and pending prompts of the ComfyUI server"""
+        try:
+            async with self.session.get(
+                f"http://{self.server_address}/queue",
+                headers=self.headers
+            ) as response:
+                if response.status != 200:
+                    return {
+                        "success": False,
+                        "step": "get_queue",
+                        "error": f"Server returned status {response.status}"
+                    }
+                return {
+                    "success": True,
+                    "step": "get_queue",
+                    "data": await response.json()
+                }
+        except Exception as e:
+            return {
+                "success": False,
+                "step": "get_queue",
+                "error": str(e)
+            }
+
     async def get_history(self, prompt_id) -> Dict[str, Any]:
         """Get the history of a prompt execution"""
         try:
@@ -107,6 +353,26 @@ class AsyncImageProcessor:
             print(f"Error getting image: {str(e)}")
             return None
 
+    async def stream_image(self, filename, subfolder, folder_type) -> Optional[SpooledImage]:
+        """Get an image from the server into a spooled file without holding it all in memory"""
+        try:
+            params = {
+                "filename": filename,
+                "subfolder": subfolder,
+                "type": folder_type
+            }
+            async with self.session.get(
+                f"http://{self.server_address}/view",
+                params=params,
+                headers=self.headers
+            ) as response:
+                if response.status != 200:
+                    raise Exception(f"Server returned status {response.status}")
+                return await SpooledImage.from_response(response)
+        except Exception as e:
+            print(f"Error getting image: {str(e)}")
+            return None
+
     '''
     def get_history(prompt_id):
         req = urllib.request.Request("http://{}/history/{}".format(server_address, prompt_id))
@@ -116,41 +382,23 @@ class AsyncImageProcessor:
     '''        
 
     async def upload_file(self, file_data: BinaryIO, subfolder="", overwrite=False) -> Dict[str, Any]:
-        """Upload a file to the ComfyUI server"""
-        try:
-            data = aiohttp.FormData()
-            data.add_field('image', file_data)
-            
-            params = {}
-            if overwrite:
-                params["overwrite"] = "true"
-            if subfolder:
-                params["subfolder"] = subfolder
+        """Upload a file to the ComfyUI server, skipped if this backend already has the same bytes.
 
-            # For file upload, we only need the Authorization header
-            headers = {'Authorization': self.headers['Authorization']}
-
-            async with self.session.post(
-                f"http://{self.server_address}/upload/image",
-                data=data,
-                params=params,
-                headers=headers
-            ) as response:
-                if response.status != 200:
-                    return {
-                        "success": False,
-                        "step": "upload_file",
-                        "error": f"Server returned status {response.status}"
-                    }
-                data = await response.json()
-                path = data["name"]
-                if "subfolder" in data and data["subfolder"]:
-                    path = f"{data['subfolder']}/{path}"
-                return {
-                    "success": True,
-                    "step": "upload_file",
-                    "data": path
-                }
+        Uploads are content-addressed, so ``overwrite`` no longer changes anything.
+        """
+        try:
+            data = file_data.read()
+            filename = getattr(file_data, "filename", None) or getattr(file_data, "name", None)
+            if not isinstance(filename, str):
+                filename = None
+            with time_stage("upload_image", backend=self.server_address):
+                entry = await get_upload_cache().upload(self.session, self.server_address,
+                                                        self.headers['Authorization'], data, filename, subfolder)
+            return {
+                "success": True,
+                "step": "upload_file",
+                "data": entry["path"]
+            }
         except Exception as e:
             return {
                 "success": False,
@@ -158,42 +406,17 @@ class AsyncImageProcessor:
                 "error": str(e)
             }
 
-    async def get_prompt_result(self, prompt) -> Dict[str, Any]:
+    async def get_prompt_result(self, prompt, output_node: str = "19") -> Dict[str, Any]:
         """Get the result of a prompt execution using websockets"""
         try:
-            queue_result = await self.queue_prompt(prompt)
-            if not queue_result["success"]:
-                return queue_result
+            execute_result = await self.execute_prompt(prompt)
+            if not execute_result["success"]:
+                return execute_result
                 
-            prompt_id = queue_result["data"]["prompt_id"]
+            prompt_id = execute_result["data"]["prompt_id"]
             generated_prompt = None
             
             try:
-                ws_url = f"ws://{self.server_address}/ws?clientId={self.client_id}"
-                print(f"Connecting to websocket at: {ws_url}")
-                
-                async with websockets.connect(ws_url, extra_headers={'Authorization': self.headers['Authorization']}) as websocket:
-                    while True:
-                        try:
-                            message = await websocket.recv()
-                            if isinstance(message, str):
-                                try:
-                                    data = json.loads(message)
-                                    print(f"Received message type: {data.get('type')}")
-                                    
-                                    if data['type'] == 'executing':
-                                        execution_data = data['data']
-                                        print(f"Executing node: {execution_data.get('node')}")
-                                        if execution_data.get('node') is None and execution_data.get('prompt_id') == prompt_id:
-                                            print("Workflow execution completed")
-                                            break
-                                except json.JSONDecodeError as e:
-                                    print(f"Failed to decode JSON message: {e}")
-                                    continue
-                        except Exception as e:
-                            print(f"Error receiving message: {e}")
-                            continue
-
                 # Get the final result from history
                 history_result = await self.get_history(prompt_id)
                 if history_result["success"] and prompt_id in history_result["data"]:
@@ -202,11 +425,11 @@ class AsyncImageProcessor:
                     
                     # Extract prompt from the result
                     if ('outputs' in result and 
-                        '19' in result['outputs'] and 
-                        'text' in result['outputs']['19'] and    
-                        isinstance(result['outputs']['19']['text'], list) and 
-                        len(result['outputs']['19']['text']) > 0):
-                        generated_prompt = result['outputs']['19']['text'][0]
+                        output_node in result['outputs'] and 
+                        'text' in result['outputs'][output_node] and    
+                        isinstance(result['outputs'][output_node]['text'], list) and 
+                        len(result['outputs'][output_node]['text']) > 0):
+                        generated_prompt = result['outputs'][output_node]['text'][0]
                         print(f"Found prompt in final result: {generated_prompt}")
                         return {
                             'success': True,
@@ -228,7 +451,7 @@ class AsyncImageProcessor:
             except Exception as e:
                 return {
                     'success': False,
-                    'error': f"WebSocket error: {str(e)}"
+                    'error': f"History error: {str(e)}"
                 }
         except Exception as e:
             return {
@@ -249,11 +472,14 @@ class AsyncImageProcessor:
         try:
             # Upload the image
             logger.debug("Uploading image")
+            # Each step records how long it took, on the monotonic clock
+            stage_started = time.monotonic()
             upload_result = await self.upload_file(image_data)
             
             if not upload_result["success"]:
                 status["steps"].append({
                     "name": "upload_image",
+                    "seconds": round(time.monotonic() - stage_started, 3),
                     "success": False,
                     "error": upload_result["error"]
                 })
@@ -264,39 +490,41 @@ class AsyncImageProcessor:
             logger.debug(f"Image uploaded successfully to: {image_path}")
             status["steps"].append({
                 "name": "upload_image",
+                "seconds": round(time.monotonic() - stage_started, 3),
                 "success": True
             })
             
             try:
-                # Load the workflow template
-                workflow_path = os.path.join(os.path.dirname(__file__), "workflow", "MiniCPMV-Prompt-Inference-Ali.json")
-                if not os.path.exists(workflow_path):
-                    error_msg = f"Workflow file not found: {workflow_path}"
+                # Bind the preloaded workflow template
+                stage_started = time.monotonic()
+                try:
+                    template = self.registry.get(PROMPT_TEMPLATE)
+                except KeyError as e:
+                    error_msg = str(e)
                     logger.error(error_msg)
                     status["steps"].append({
                         "name": "load_workflow",
+                        "seconds": round(time.monotonic() - stage_started, 3),
                         "success": False,
                         "error": error_msg
                     })
                     status["error"] = error_msg
                     return status
 
-                with open(workflow_path, "r") as f:
-                    workflow = json.load(f)
-                logger.debug("Workflow loaded successfully")
-                    
-                # Update the workflow with our parameters
-                workflow["3"]["inputs"]["image"] = image_path  # Update LoadImage node with our image
+                workflow = template.bind(image=image_path)  # Update LoadImage node with our image
+                workflow = get_optimizer().optimize(template, workflow)
                 logger.debug("Workflow updated with image path and parameters")
                 
                 status["steps"].append({
                     "name": "update_workflow",
+                    "seconds": round(time.monotonic() - stage_started, 3),
                     "success": True
                 })
                 
                 # Execute the workflow
                 logger.debug("Requesting prompt generation")
-                result = await self.get_prompt_result(workflow)
+                stage_started = time.monotonic()
+                result = await self.get_prompt_result(workflow, output_node=template.outputs["prompt"])
                 logger.debug(f"Prompt generation result: {result}")
                 
                 if result["success"]:
@@ -308,6 +536,7 @@ class AsyncImageProcessor:
                         status["final_prompt"] = prompt_text  # Store the full prompt
                         status["steps"].append({
                             "name": "generate_prompt",
+                            "seconds": round(time.monotonic() - stage_started, 3),
                             "success": True
                         })
                         return status
@@ -316,6 +545,7 @@ class AsyncImageProcessor:
                         logger.error(error_msg)
                         status["steps"].append({
                             "name": "generate_prompt",
+                            "seconds": round(time.monotonic() - stage_started, 3),
                             "success": False,
                             "error": error_msg
                         })
@@ -325,6 +555,7 @@ class AsyncImageProcessor:
                     logger.error(error_msg)
                     status["steps"].append({
                         "name": "generate_prompt",
+                        "seconds": round(time.monotonic() - stage_started, 3),
                         "success": False,
                         "error": error_msg
                     })
@@ -335,6 +566,7 @@ class AsyncImageProcessor:
                 logger.error(error_msg)
                 status["steps"].append({
                     "name": "generate_prompt",
+                    "seconds": round(time.monotonic() - stage_started, 3),
                     "success": False,
                     "error": error_msg
                 })
@@ -347,324 +579,182 @@ class AsyncImageProcessor:
             
         return status
 
-    async def process_flux_lora(self, width: int, height: int, lora_name: str, 
-                              positive_prompt: str, negative_prompt: str, batch_size: int) -> Dict[str, Any]:
-                              
-        """Process a Flux GGUF Lora request and return the generated images"""
-        print(f"Starting process_flux_lora with parameters:")
-        print(f"- width: {width}")
-        print(f"- height: {height}")
-        print(f"- lora_name: {lora_name}")
-        #print(f"- model_name: {model_name}")
-        print(f"- batch_size: {batch_size}")
-        
-        status = {
-            "steps": [],
-            "success": False,
-            "images": [],
-            "error": None
-        }
-        
+    async def process_flux_gguf_lora_basic(self, width: int, height: int, lora_name: str, 
+                    positive_prompt: str, negative_prompt: str, batch_size: int,
+                    style: str = "dummy", product: str = "dummy", seed: int = None):
         try:
-            # Load the workflow template
-            workflow_path = os.path.join(os.path.dirname(__file__), "workflow", "Flux_GGUF_Lora_Basic_Ali.json")
-            if not os.path.exists(workflow_path):
-                logger.error(f"Workflow file not found: {workflow_path}")
-                return {
-                    'success': False,
-                    'error': f"Workflow file not found: {workflow_path}"
-                }
+            generation = await self.generate_flux_gguf_lora_basic(
+                width=width,
+                height=height,
+                lora_name=lora_name,
+                positive_prompt=positive_prompt,
+                negative_prompt=negative_prompt,
+                batch_size=batch_size,
+                seed=seed
+            )
+            if generation is None:
+                return None
+            return await self.save_flux_gguf_lora_basic_images(
+                generation['images'],
+                seed=generation['seed'],
+                width=width,
+                height=height,
+                lora_name=lora_name,
+                positive_prompt=positive_prompt,
+                negative_prompt=negative_prompt,
+                style=style,
+                product=product
+            )
+            
+        except Exception as e:
+            print(f"Error in main: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            return None
 
-            with open(workflow_path, 'r') as f:
-                workflow = json.load(f)
+    async def generate_flux_gguf_lora_basic(self, width: int, height: int, lora_name: str,
+                    positive_prompt: str, negative_prompt: str, batch_size: int, seed: int = None,
+                    workflow: Dict[str, Any] = None):
+        """Run the Flux LoRA workflow and return {'seed', 'images': {node_id: [SpooledImage]}}, or None.
 
-            # Generate a random seed
-            random_seed = random.randint(0, 2**32 - 1)
-            print(f"Using random seed: {random_seed}")
-            
-            try:
-                # Update the workflow with our parameters
-                # Update KSampler parameters
-                workflow["3"]["inputs"]["seed"] = random_seed
-                
-                # Update Empty Latent Image parameters
-                workflow["5"]["inputs"]["width"] = width
-                workflow["5"]["inputs"]["height"] = height
-                workflow["5"]["inputs"]["batch_size"] = batch_size
+        ``workflow``, when the caller already bound these parameters with
+        ``seed``, is queued as is rather than bound and optimized again.
+        """
+        # Randomize seed for filename
+        if seed is None:
+            seed = random.randint(0, 2**32 - 1)
+        
+        if workflow is None:
+            workflow = bind_flux_lora_workflow(self.registry, width, height, lora_name,
+                                               positive_prompt, negative_prompt, batch_size, seed)
+        
+        print("Getting images...")
+        images = await self.process_flux_gguf_lora_basic_result(workflow)
+        if images is None:
+            return None
+        return {'seed': seed, 'images': images}
 
-                # Update prompts
-                workflow["6"]["inputs"]["text"] = positive_prompt
-                workflow["7"]["inputs"]["text"] = negative_prompt
+    async def save_flux_gguf_lora_basic_images(self, images, seed: int, width: int, height: int, lora_name: str,
+                    positive_prompt: str, negative_prompt: str, style: str = "dummy", product: str = "dummy",
+                    batch_offset: int = 0, background: bool = None, inline_thumbnails: bool = False):
+        """Upload generated images to Supabase and record their metadata.
 
-                # Update model and lora
-                # workflow["10"]["inputs"]["unet_name"] = model_name
-                workflow["15"]["inputs"]["lora_name"] = lora_name
+        ``batch_offset`` is the position of these images within a merged batch,
+        keeping filenames unique when several requests share one seed. With
+        ``background`` the metadata is returned before the uploads finish.
+        Images are returned by URL; ``inline_thumbnails`` adds a small JPEG
+        data URL per image under ``thumbnail``.
+        """
+        await self._emit("stage", {"stage": "saving"})
 
-                status["steps"].append({
-                    "name": "update_workflow",
-                    "success": True
-                })
-            except Exception as e:
-                error_msg = f"Failed to update workflow: {str(e)}"
-                print(error_msg)
-                status["steps"].append({
-                    "name": "update_workflow",
-                    "success": False,
-                    "error": error_msg
+        # Name every image and describe it before anything is sent
+        uploads = []
+        rows = []
+        for node_id in images:
+            for index, image_data in enumerate(images[node_id]):
+                if image_data is None:
+                    print(f"Error processing image: no data for image {index} of node {node_id}")
+                    continue
+                # Generate unique filename
+                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                filename = f"generated_image_{timestamp}_{seed}.png"
+                if batch_offset or len(images[node_id]) > 1:
+                    filename = f"generated_image_{timestamp}_{seed}_{batch_offset + index}.png"
+                uploads.append((filename, image_data))
+                rows.append({
+                    "filename": filename,
+                    "prompt": positive_prompt,
+                    "negative_prompt": negative_prompt,
+                    "style": style,
+                    "product": product,
+                    "resolution": f"{width}x{height}",
+                    "lora_model": lora_name,
+                    "generated_at": datetime.now().isoformat(),
+                    "image_url": self.persister.public_url(filename),
+                    "seed": seed,
+                    "node_id": node_id
                 })
-                status["error"] = error_msg
-                return status
+                # WebP/AVIF master and thumbnail URLs, when post-processing is on
+                variants = self.persister.variant_urls(filename)
+                if variants:
+                    rows[-1]["variants"] = variants
 
-            try:
-                print(f"Executing workflow with seed {random_seed}")
-                result = await self.get_flux_lora_result(workflow)  # Using the new dedicated method
-                
-                status["steps"].append({
-                    "name": "execute_workflow",
-                    "success": result["success"],
-                    "error": result.get("error")
-                })
+        thumbnails = {}
+        if inline_thumbnails:
+            # Taken before persisting, which closes the spooled images
+            for (filename, image_data), row in zip(uploads, rows):
+                try:
+                    if isinstance(image_data, SpooledImage):
+                        thumbnails[filename] = await asyncio.to_thread(image_data.thumbnail)
+                    else:
+                        thumbnails[filename] = await asyncio.to_thread(encode_thumbnail, io.BytesIO(image_data))
+                except Exception as e:
+                    print(f"Error creating thumbnail for {filename}: {str(e)}")
 
-                if not result["success"]:
-                    error_msg = f"Workflow execution failed: {result.get('error')}"
-                    print(error_msg)
-                    status["error"] = error_msg
-                    return status
+        if background is None:
+            background = PERSIST_IN_BACKGROUND
+        stored = await self.persister.persist(uploads, rows, background=background)
 
-                print("Processing results...")
-                if "images" in result:
-                    status["success"] = True
-                    status["images"] = result["images"]
-                    status["steps"].append({
-                        "name": "process_results",
-                        "success": True
-                    })
-                else:
-                    error_msg = "No images were found in the output"
-                    print(error_msg)
-                    status["error"] = error_msg
-                    return status
+        processed_images = {node_id: [] for node_id in images}
+        for metadata in stored:
+            if metadata["filename"] in thumbnails:
+                # A copy, so the thumbnail never reaches the database row
+                metadata = {**metadata, "thumbnail": thumbnails[metadata["filename"]]}
+            processed_images[metadata["node_id"]].append(metadata)
+        return processed_images
+            
+    async def process_flux_gguf_lora_basic_result(self, prompt):
+        # Downloads per output node, started as soon as the node's executed event arrives
+        downloads: Dict[str, List[asyncio.Task]] = {}
+        output_images = None
 
-            except Exception as e:
-                error_msg = f"Failed to execute workflow: {str(e)}"
-                print(error_msg)
-                status["steps"].append({
-                    "name": "execute_workflow",
-                    "success": False,
-                    "error": error_msg
-                })
-                status["error"] = error_msg
-                return status
+        def start_downloads(node_id: str, node_output: Dict[str, Any]):
+            if node_id in downloads or 'images' not in node_output:
+                return
+            downloads[node_id] = [
+                asyncio.create_task(self.stream_image(image['filename'], image['subfolder'], image['type']))
+                for image in node_output['images']
+            ]
 
-        except Exception as e:
-            error_msg = f"General error in process_flux_lora: {str(e)}"
-            print(error_msg)
-            status["error"] = error_msg
-            
-        return status
+        def close_download(task: asyncio.Task):
+            if not task.cancelled() and task.result() is not None:
+                task.result().close()
 
-    async def get_flux_lora_result(self, prompt) -> Dict[str, Any]:
-        """Get the result of a Flux Lora workflow execution using websockets"""
         try:
-            queue_result = await self.queue_prompt(prompt)
-            if not queue_result["success"]:
-                return queue_result
-                
-            prompt_id = queue_result["data"]["prompt_id"]
-            images = []
-            
-            try:
-                ws_url = f"ws://{self.server_address}/ws?clientId={self.client_id}"
-                print(f"Connecting to websocket at: {ws_url}")
-                
-                async with websockets.connect(ws_url, extra_headers={'Authorization': self.headers['Authorization']}) as websocket:
-                    while True:
-                        try:
-                            message = await websocket.recv()
-                            if isinstance(message, str):
-                                try:
-                                    data = json.loads(message)
-                                    print(f"Received message type: {data.get('type')}")
-                                    
-                                    if data['type'] == 'executing':
-                                        execution_data = data['data']
-                                        print(f"Executing node: {execution_data.get('node')}")
-                                        if execution_data['node'] == "9" and execution_data['prompt_id'] == prompt_id:  # Wait for SaveImage node
-                                            print("Save image node completed")
-                                            break
-                                    elif data['type'] == 'executed':
-                                        execution_data = data['data']
-                                        if 'output' in execution_data:
-                                            output = execution_data['output']
-                                            if 'images' in output:
-                                                # Process each image and convert to base64 with data URL prefix
-                                                for img_path in output['images']:
-                                                    try:
-                                                        full_path = os.path.join(self.output_dir, img_path)
-                                                        if os.path.exists(full_path):
-                                                            with open(full_path, 'rb') as img_file:
-                                                                img_data = img_file.read()
-                                                                base64_data = base64.b64encode(img_data).decode('utf-8')
-                                                                images.append(f"data:image/png;base64,{base64_data}")
-                                                        else:
-                                                            print(f"Image file not found: {full_path}")
-                                                    except Exception as e:
-                                                        print(f"Error processing image {img_path}: {e}")
-                                                print(f"Processed {len(output['images'])} images")
-                                except json.JSONDecodeError as e:
-                                    print(f"Failed to decode JSON message: {e}")
-                                    continue
-                        except Exception as e:
-                            print(f"Error receiving message: {e}")
-                            continue
-
-                if images:
-                    return {
-                        'success': True,
-                        'images': images
-                    }
-                else:
-                    return {
-                        'success': False,
-                        'error': 'No images were generated'
-                    }
-                    
-            except Exception as e:
-                return {
-                    'success': False,
-                    'error': f"WebSocket error: {str(e)}"
-                }
-        except Exception as e:
-            return {
-                'success': False,
-                'error': str(e)
-            }
+            # Queue the prompt and wait for it to finish, downloading images on the way
+            execute_result = await self.execute_prompt(prompt, on_output=start_downloads)
+            if not execute_result['success']:
+                print(f"Error executing prompt: {execute_result.get('error')}")
+                return None
+            prompt_id = execute_result['data']['prompt_id']
 
-    async def process_flux_gguf_lora_basic(self, width: int, height: int, lora_name: str, 
-                    positive_prompt: str, negative_prompt: str, batch_size: int,
-                    style: str = "dummy", product: str = "dummy"):
-        try:
-            # Load the workflow
-            print("Loading workflow...")
-            workflow_path = os.path.join(os.path.dirname(__file__), "workflow", "Flux_GGUF_Lora_Basic_Ali.json")
-            with open(workflow_path, "r", encoding="utf-8") as f:
-                workflow = json.loads(f.read())
-            
-            # Update workflow parameters
-            workflow["5"]["inputs"]["width"] = width
-            workflow["5"]["inputs"]["height"] = height
-            workflow["5"]["inputs"]["batch_size"] = batch_size
-            workflow["15"]["inputs"]["lora_name"] = lora_name
-            workflow["6"]["inputs"]["text"] = positive_prompt
-            workflow["7"]["inputs"]["text"] = negative_prompt
-            
-            # Randomize seed for filename
-            import random
-            seed = random.randint(0, 2**32 - 1)
-            workflow["3"]["inputs"]["seed"] = seed
-            
-            # Connect to websocket
-            print("Connecting to ComfyUI server...")
-            ws = await websockets.connect(
-                "ws://{}/ws?clientId={}".format(self.server_address, self.client_id),
-                extra_headers={"Authorization": "MjA0YWI0Y2RlZWQ2ZGUyYWZlYjdlNGYyNDFhN2E3Y2MxYmFjNmEwZQ=="}
-            )
-            
-            print("Getting images...")
-            images = await self.process_flux_gguf_lora_basic_result(ws, workflow)
-
-            # Process and save the output images
-            processed_images = {}
-            for node_id in images:
-                processed_images[node_id] = []
-                for image_data in images[node_id]:
-                    try:
-                        # Generate unique filename
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        filename = f"generated_image_{timestamp}_{seed}.png"
-                        
-                        # Upload to Supabase storage
-                        supabase = SupabaseClient()
-                        image_url = supabase.upload_image(image_data, filename)
-                        
-                        # Prepare metadata
-                        metadata = {
-                            "filename": filename,
-                            "prompt": positive_prompt,
-                            "negative_prompt": negative_prompt,
-                            "style": style,
-                            "product": product,
-                            "resolution": f"{width}x{height}",
-                            "lora_model": lora_name,
-                            "generated_at": datetime.now().isoformat(),
-                            "image_url": image_url,
-                            "seed": seed,
-                            "node_id": node_id
-                        }
-                        
-                        # Save metadata to database
-                        db_record = supabase.save_generation_metadata(metadata)
-                        print(f"Image uploaded and metadata saved: {filename}")
-                        print("Database record:", json.dumps(db_record, indent=2))
-                        
-                        processed_images[node_id].append(metadata)
-                        
-                    except Exception as e:
-                        print(f"Error processing image: {str(e)}")
-            
-            await ws.close()
-            return processed_images
-            
-        except Exception as e:
-            await ws.close()
-            print(f"Error in main: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            return None
-            
-    async def process_flux_gguf_lora_basic_result(self, ws, prompt):
-        try:
-            # Queue the prompt and get prompt_id
-            queue_result = await self.queue_prompt(prompt)
-            prompt_id = queue_result['data']['prompt_id']
-            output_images = {}
-            
-            while True:
-                try:
-                    out = await ws.recv()
-                    if isinstance(out, str):
-                        message = json.loads(out)
-                        print(message)
-                        if message['type'] == 'executing':
-                            data = message['data']
-                            if data['node'] is None and data['prompt_id'] == prompt_id:
-                                break  # Execution is done
-                    else:
-                        continue  # previews are binary data
-                except Exception as e:
-                    print(f"Error receiving websocket message: {str(e)}")
-                    break
+            for node_id, node_output in execute_result['data']['outputs'].items():
+                if node_output:
+                    start_downloads(node_id, node_output)
+            if not downloads:
+                # Cached nodes send no executed event, so their outputs are only in /history
+                history_result = await self.get_history(prompt_id)
+                if not history_result.get('success'):
+                    print(f"Error getting history: {history_result.get('error')}")
+                    return None
+                history = history_result['data'][prompt_id]
+                for node_id, node_output in history['outputs'].items():
+                    start_downloads(node_id, node_output)
 
-            history_result = await self.get_history(prompt_id)
-            if not history_result.get('success'):
-                print(f"Error getting history: {history_result.get('error')}")
-                return None
-                
-            history = history_result['data'][prompt_id]
-            print(history)
-            
-            for node_id in history['outputs']:
-                node_output = history['outputs'][node_id]
-                if 'images' in node_output:
-                    images_output = []
-                    for image in node_output['images']:
-                        image_data = await self.get_image(image['filename'], image['subfolder'], image['type'])
-                        images_output.append(image_data)
-                    output_images[node_id] = images_output
-                    
+            # Most downloads started during execution; this is what is left after it
+            with time_stage("download_images", backend=self.server_address):
+                await asyncio.gather(*(task for tasks in downloads.values() for task in tasks))
+            output_images = {node_id: [task.result() for task in tasks] for node_id, tasks in downloads.items()}
             return output_images
         except Exception as e:
             print(f"Error in process_flux_gguf_lora_basic_result: {str(e)}")
             import traceback
             traceback.print_exc()
-            return None
\ No newline at end of file
+            return None
+        finally:
+            # Downloads of a failed or cancelled run must not leak their spools
+            if output_images is None:
+                for tasks in downloads.values():
+                    for task in tasks:
+                        task.cancel()
+                        task.add_done_callback(close_download)
\ No newline at end of file
@@ -1,17 +1,83 @@
 import asyncio
+import json
 import os
+import random
+import time
 import aiohttp
+from typing import Any, AsyncIterator, Dict, List, Optional
 from dotenv import load_dotenv
+from llm_cache import LLMCache
+from metrics import observe_stage
+import logging
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
 
+DEEPSEEK_API_BASE = os.environ.get("DEEPSEEK_API_BASE", "https://api.deepseek.com/v1")
+LLM_MODEL = os.environ.get("LLM_MODEL", "deepseek-chat")
+LLM_TEMPERATURE = float(os.environ.get("LLM_TEMPERATURE", 0.7))
+LLM_MAX_TOKENS = int(os.environ.get("LLM_MAX_TOKENS", 150))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 30))
+# DeepSeek calls in flight at once per worker; the rest wait their turn
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 8))
+# Retries of rate-limited, failed or unreachable calls, with jittered exponential backoff
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 3))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", 0.5))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", 8))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_semaphore: Optional[asyncio.Semaphore] = None
+
+
+def llm_semaphore() -> asyncio.Semaphore:
+    """Worker-wide cap on concurrent DeepSeek calls, created on the serving loop"""
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+    return _semaphore
+
+
+def backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Seconds to wait before retry ``attempt``: the server's Retry-After if it sent one, else full jitter"""
+    if retry_after:
+        try:
+            return min(float(retry_after), LLM_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+
+class LLMError(Exception):
+    """DeepSeek answered with an error status"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"DeepSeek API error: {status} - {message}")
+        self.status = status
+
+
 class AsyncLLMProcessor:
-    def __init__(self):
-        """Initialize the LLM processor with DeepSeek configuration"""
+    """DeepSeek chat completions, whole or streamed token by token.
+
+    Calls share the session they are given, at most LLM_MAX_CONCURRENCY run
+    at once per worker, and rate limits, 5xx answers and connection errors
+    are retried with backoff. A stream is only retried before its first
+    token, so callers never see text repeated.
+    """
+
+    def __init__(self, session: Optional[aiohttp.ClientSession] = None):
+        """Initialize the LLM processor with DeepSeek configuration.
+
+        Args:
+            session: Optional shared pooled session; a temporary one is used when omitted
+        """
         self.api_key = os.getenv("DEEPSEEK_API_KEY")
-        self.api_base = "https://api.deepseek.com/v1"
-        
+        self.api_base = DEEPSEEK_API_BASE
+        self.model = LLM_MODEL
+        self.temperature = LLM_TEMPERATURE
+        self.max_tokens = LLM_MAX_TOKENS
+        self.session = session
+
     async def process(self, prompt: str) -> str:
         """
         Process a single prompt and return the response content.
@@ -23,32 +89,132 @@ class AsyncLLMProcessor:
             The response content as a string
         """
         try:
+            if self.session is not None:
+                return await self._complete(self.session, prompt)
             async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.api_base}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": "deepseek-chat",
-                        "messages": [{"role": "user", "content": prompt}],
-                        "temperature": 0.7,
-                        "max_tokens": 150
-                    },
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        raise Exception(f"DeepSeek API error: {response.status} - {error_text}")
-                        
-                    data = await response.json()
-                    return data["choices"][0]["message"]["content"].strip()
+                return await self._complete(session, prompt)
                     
         except Exception as e:
             print(f"Error generating response: {str(e)}")
             raise
 
+    async def stream(self, prompt: str) -> AsyncIterator[str]:
+        """Yield the response to ``prompt`` piece by piece as DeepSeek generates it"""
+        if self.session is not None:
+            async for text in self._stream(self.session, prompt):
+                yield text
+            return
+        async with aiohttp.ClientSession() as session:
+            async for text in self._stream(session, prompt):
+                yield text
+
+    async def process_many(self, prompts: List[str], cache: Optional[LLMCache] = None,
+                           bypass_cache: bool = False) -> AsyncIterator[Dict[str, Any]]:
+        """Run many prompts concurrently and yield each result as it finishes.
+
+        Results carry the ``index`` of their prompt. With a cache, known
+        responses are returned without an API call (unless ``bypass_cache``)
+        and new ones are stored.
+        """
+        async def run(index: int, prompt: str) -> Dict[str, Any]:
+            key = cache.key(self.model, self.temperature, self.max_tokens, prompt) if cache else None
+            if key is not None and not bypass_cache:
+                cached = await cache.get(key)
+                if cached is not None:
+                    return {"index": index, "success": True, "response": cached, "cached": True}
+            try:
+                response = await self.process(prompt)
+            except Exception as e:
+                return {"index": index, "success": False, "error": str(e), "cached": False}
+            if key is not None:
+                await cache.put(key, response)
+            return {"index": index, "success": True, "response": response, "cached": False}
+
+        # The worker-wide semaphore bounds how many of these reach DeepSeek at once
+        tasks = [asyncio.create_task(run(index, prompt)) for index, prompt in enumerate(prompts)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield await finished
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _request(self, prompt: str, stream: bool = False) -> Dict[str, Any]:
+        body = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": self.temperature,
+            "max_tokens": self.max_tokens
+        }
+        if stream:
+            body["stream"] = True
+        return {
+            "headers": {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            },
+            "json": body,
+            # A stream may run longer than LLM_TIMEOUT overall, but never stalls that long
+            "timeout": aiohttp.ClientTimeout(sock_read=LLM_TIMEOUT) if stream else aiohttp.ClientTimeout(total=LLM_TIMEOUT)
+        }
+
+    async def _post(self, session: aiohttp.ClientSession, prompt: str, stream: bool = False) -> aiohttp.ClientResponse:
+        """POST a completion request, retrying what is worth retrying; the caller releases the response"""
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            retry_after = None
+            try:
+                response = await session.post(f"{self.api_base}/chat/completions", **self._request(prompt, stream))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == LLM_MAX_RETRIES:
+                    raise
+                logger.warning(f"DeepSeek unreachable ({e!r}), retrying")
+            else:
+                if response.status == 200:
+                    return response
+                error_text = await response.text()
+                response.release()
+                if response.status not in RETRY_STATUSES or attempt == LLM_MAX_RETRIES:
+                    raise LLMError(response.status, error_text)
+                retry_after = response.headers.get("Retry-After")
+                logger.warning(f"DeepSeek returned {response.status}, retrying")
+            await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+    async def _complete(self, session: aiohttp.ClientSession, prompt: str) -> str:
+        async with llm_semaphore():
+            started = time.monotonic()
+            response = await self._post(session, prompt)
+            try:
+                data = await response.json()
+            finally:
+                response.release()
+            observe_stage("llm_completion", time.monotonic() - started)
+        return data["choices"][0]["message"]["content"].strip()
+
+    async def _stream(self, session: aiohttp.ClientSession, prompt: str) -> AsyncIterator[str]:
+        async with llm_semaphore():
+            started = time.monotonic()
+            response = await self._post(session, prompt, stream=True)
+            first_token = True
+            try:
+                # Server-sent events: one "data: {chunk}" line per delta, then "data: [DONE]"
+                async for line in response.content:
+                    line = line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    payload = line[len(b"data:"):].strip()
+                    if payload == b"[DONE]":
+                        observe_stage("llm_completion", time.monotonic() - started)
+                        return
+                    chunk = json.loads(payload)
+                    text = chunk["choices"][0].get("delta", {}).get("content")
+                    if text:
+                        if first_token:
+                            first_token = False
+                            observe_stage("llm_first_token", time.monotonic() - started)
+                        yield text
+            finally:
+                response.release()
+
 # Example usage:
 if __name__ == "__main__":
     async def test_llm():
@@ -0,0 +1,341 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+import aiohttp
+from comfyui_client import ComfyUIClient, DEFAULT_SERVER_ADDRESS, create_pooled_session
+from disk_cache import DiskCache
+from metrics import observe_stage
+import logging
+logger = logging.getLogger(__name__)
+
+HEALTH_CHECK_INTERVAL = float(os.environ.get("COMFYUI_HEALTH_CHECK_INTERVAL", 5))
+HEALTH_CHECK_TIMEOUT = float(os.environ.get("COMFYUI_HEALTH_CHECK_TIMEOUT", 3))
+# Consecutive failed checks before a backend stops receiving jobs
+MAX_FAILURES = int(os.environ.get("COMFYUI_MAX_FAILURES", 3))
+# Longest extra queueing (in estimated seconds) a job accepts to land on a backend
+# that already has its model and LoRA loaded
+AFFINITY_MAX_WAIT = float(os.environ.get("COMFYUI_AFFINITY_MAX_WAIT", 30))
+# Starting estimate of one job's duration, refined from observed jobs
+DEFAULT_JOB_SECONDS = 30.0
+# Generations sent to one backend at a time; further jobs wait for a slot here, where
+# the fair scheduler can still reorder them, instead of in ComfyUI's own FIFO queue
+BACKEND_MAX_INFLIGHT = int(os.environ.get("SCHEDULER_BACKEND_MAX_INFLIGHT", 2))
+# Slots are leases in a store every hypercorn worker shares, so that limit holds per backend
+# across all workers. A lease outlives any generation deadline; one whose worker died is
+# taken over at once.
+SLOT_LEASE_SECONDS = float(os.environ.get("SCHEDULER_SLOT_LEASE_SECONDS", 900))
+# How often a job waiting for a slot looks for one another worker freed
+SLOT_POLL_SECONDS = 0.25
+
+
+def configured_backends() -> List[str]:
+    """Backend addresses from COMFYUI_BACKENDS (comma separated), else the single default server"""
+    backends = os.environ.get("COMFYUI_BACKENDS", "")
+    addresses = [address.strip() for address in backends.split(",") if address.strip()]
+    return addresses or [os.environ.get("COMFYUI_SERVER_ADDRESS", DEFAULT_SERVER_ADDRESS)]
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Backend:
+    """One ComfyUI instance and the load we last observed on it"""
+
+    def __init__(self, client: ComfyUIClient):
+        self.client = client
+        self.healthy = True
+        self.failures = 0
+        self.queue_running = 0
+        self.queue_pending = 0
+        # Jobs sent here since the last /queue poll, not yet visible in its depth
+        self.assigned_since_check = 0
+        self.inflight = 0
+        self.vram_free = 0
+        self.last_checked: Optional[float] = None
+        # Model and LoRA of the last job sent here; ComfyUI runs its queue in order,
+        # so that is what will be loaded when the next job starts
+        self.last_model: Optional[str] = None
+        self.last_lora: Optional[str] = None
+        self.avg_job_seconds = DEFAULT_JOB_SECONDS
+
+    @property
+    def address(self) -> str:
+        return self.client.server_address
+
+    @property
+    def load(self) -> int:
+        return self.queue_running + self.queue_pending + self.assigned_since_check
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "address": self.address,
+            "healthy": self.healthy,
+            "failures": self.failures,
+            "queue_running": self.queue_running,
+            "queue_pending": self.queue_pending,
+            "inflight": self.inflight,
+            "load": self.load,
+            "vram_free": self.vram_free,
+            "last_model": self.last_model,
+            "last_lora": self.last_lora,
+            "avg_job_seconds": round(self.avg_job_seconds, 2),
+            "websocket_connected": self.client.events.connected.is_set(),
+            "last_checked": self.last_checked
+        }
+
+
+class BackendPool:
+    """Routes each job to the least-loaded healthy ComfyUI backend.
+
+    A background task polls every backend's ``/queue`` and ``/system_stats``;
+    backends failing MAX_FAILURES checks in a row are ejected until a check
+    succeeds again. All backends share one pooled HTTP session.
+
+    Jobs prefer a backend whose last job used the same model and LoRA, which
+    saves a GGUF/LoRA reload, as long as the extra estimated wait there stays
+    within AFFINITY_MAX_WAIT. No backend runs more than ``max_inflight`` jobs
+    at once, counting every worker's: ``acquire`` leases a slot in a shared
+    DiskCache and waits for one when every candidate is full.
+    """
+
+    def __init__(self, addresses: Optional[List[str]] = None, authorization: Optional[str] = None,
+                 max_inflight: int = BACKEND_MAX_INFLIGHT, slots: Optional[DiskCache] = None):
+        self.addresses = addresses or configured_backends()
+        self.authorization = authorization
+        self.max_inflight = max_inflight
+        self.slots = slots or DiskCache("backend_slots", 1024, SLOT_LEASE_SECONDS)
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.backends: List[Backend] = []
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+        self.affinity_skipped = 0
+        self.slot_waits = 0
+        self._task: Optional[asyncio.Task] = None
+        # Jobs waiting for a backend slot, woken whenever one may have opened
+        self._waiters: List[asyncio.Future] = []
+
+    async def start(self):
+        self.session = create_pooled_session()
+        self.backends = [Backend(ComfyUIClient(address, self.authorization, session=self.session))
+                         for address in self.addresses]
+        await asyncio.gather(*(backend.client.start() for backend in self.backends))
+        # Pids are reused, e.g. by a restarted container's workers
+        await asyncio.to_thread(self._clear_stale_leases)
+        await self.check_all()
+        self._task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.gather(*(backend.client.close() for backend in self.backends))
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        self.slots.close()
+
+    def candidates(self) -> List[Backend]:
+        """Backends that may take a job now: healthy ones this worker isn't filling; empty when they are all full"""
+        healthy = [backend for backend in self.backends if backend.healthy]
+        if healthy:
+            return [backend for backend in healthy if backend.inflight < self.max_inflight]
+        # Better to try a struggling backend than to refuse every request
+        least_failed = min(self.backends, key=lambda backend: backend.failures)
+        if least_failed.inflight >= self.max_inflight:
+            return []
+        logger.warning("No healthy ComfyUI backends; routing to the least-failed one")
+        return [least_failed]
+
+    def _choose(self, candidates: List[Backend], model: Optional[str],
+                lora: Optional[str]) -> Tuple[Backend, Optional[str]]:
+        """The backend with the shallowest queue, most free VRAM breaking ties, and the affinity outcome.
+
+        When ``model`` is given, a backend already holding that model and LoRA
+        wins unless it would make the job wait more than AFFINITY_MAX_WAIT
+        longer than the least-loaded choice; the outcome is then "hit",
+        "skipped" for that, or "miss".
+        """
+        least_loaded = min(candidates, key=lambda backend: (backend.load, -backend.vram_free))
+        if model is None:
+            return least_loaded, None
+
+        affine = [backend for backend in candidates
+                  if backend.last_model == model and backend.last_lora == lora]
+        if affine:
+            best = min(affine, key=lambda backend: (backend.load, -backend.vram_free))
+            extra_wait = (best.load - least_loaded.load) * best.avg_job_seconds
+            if extra_wait <= AFFINITY_MAX_WAIT:
+                return best, "hit"
+            return least_loaded, "skipped"
+        return least_loaded, "miss"
+
+    def _record(self, outcome: Optional[str]):
+        if outcome == "hit":
+            self.affinity_hits += 1
+            return
+        if outcome == "skipped":
+            self.affinity_skipped += 1
+        if outcome is not None:
+            self.affinity_misses += 1
+
+    def _lease(self, backends: List[Backend]) -> Optional[Tuple[Backend, str, Dict[str, Any]]]:
+        """Take a free slot on the first of ``backends`` that has one left across all workers"""
+        lease = {"pid": os.getpid(), "id": uuid4().hex}
+        for backend in backends:
+            for index in range(self.max_inflight):
+                key = f"{backend.address}/{index}"
+                if self.slots.claim(key, lease, SLOT_LEASE_SECONDS):
+                    return backend, key, lease
+                holder = self.slots.get(key)
+                if holder is not None and not process_alive(holder["pid"]) \
+                        and self.slots.replace(key, holder, lease):
+                    logger.info(f"Took over slot {key} from exited worker {holder['pid']}")
+                    return backend, key, lease
+        return None
+
+    def _abandon_lease(self, leasing: asyncio.Future):
+        if not leasing.cancelled() and leasing.exception() is None and leasing.result() is not None:
+            _, key, lease = leasing.result()
+            asyncio.get_running_loop().run_in_executor(None, self.slots.delete, key, lease)
+
+    def _clear_stale_leases(self):
+        """Drop leases left under this process's pid, which a previous worker may have died holding"""
+        for address in self.addresses:
+            for index in range(self.max_inflight):
+                key = f"{address}/{index}"
+                holder = self.slots.get(key)
+                if holder is not None and holder["pid"] == os.getpid():
+                    self.slots.delete(key, holder)
+
+    @asynccontextmanager
+    async def acquire(self, model: Optional[str] = None, lora: Optional[str] = None):
+        """Reserve a backend for the duration of one job, waiting while every backend is full; see ``_choose``"""
+        started = None
+        while True:
+            candidates = self.candidates()
+            if candidates:
+                chosen, outcome = self._choose(candidates, model, lora)
+                # The pick first, then the rest by load, in case other workers hold the pick's slots
+                others = sorted((backend for backend in candidates if backend is not chosen),
+                                key=lambda backend: (backend.load, -backend.vram_free))
+                leasing = asyncio.ensure_future(asyncio.to_thread(self._lease, [chosen] + others))
+                try:
+                    leased = await asyncio.shield(leasing)
+                except asyncio.CancelledError:
+                    # The lease may still be taken after we have gone; hand it straight back
+                    leasing.add_done_callback(self._abandon_lease)
+                    raise
+                if leased is not None:
+                    break
+            if started is None:
+                self.slot_waits += 1
+                started = time.monotonic()
+            # Woken by this worker's releases; the other workers' are found by polling
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, SLOT_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        if started is not None:
+            observe_stage("backend_wait", time.monotonic() - started)
+        backend, key, lease = leased
+        self._record(outcome if backend is chosen or outcome is None else "miss")
+        backend.assigned_since_check += 1
+        backend.inflight += 1
+        if model is not None:
+            backend.last_model = model
+            backend.last_lora = lora
+        started = time.monotonic()
+        try:
+            yield backend
+        finally:
+            backend.inflight -= 1
+            # Exponential moving average of how long a job keeps a backend busy
+            backend.avg_job_seconds += 0.2 * (time.monotonic() - started - backend.avg_job_seconds)
+            await asyncio.to_thread(self.slots.delete, key, lease)
+            self._wake()
+
+    def _wake(self):
+        """Let every job waiting for a slot look again"""
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @property
+    def affinity_hit_rate(self) -> Optional[float]:
+        total = self.affinity_hits + self.affinity_misses
+        return self.affinity_hits / total if total else None
+
+    async def check_all(self):
+        await asyncio.gather(*(self.check(backend) for backend in self.backends))
+
+    async def check(self, backend: Backend):
+        client = backend.client
+        timeout = aiohttp.ClientTimeout(total=HEALTH_CHECK_TIMEOUT)
+        try:
+            async with self.session.get(f"http://{backend.address}/queue", headers=client.headers,
+                                        timeout=timeout) as response:
+                if response.status != 200:
+                    raise Exception(f"/queue returned status {response.status}")
+                queue = await response.json()
+            async with self.session.get(f"http://{backend.address}/system_stats", headers=client.headers,
+                                        timeout=timeout) as response:
+                stats = await response.json() if response.status == 200 else {}
+        except Exception as e:
+            backend.failures += 1
+            if backend.healthy and backend.failures >= MAX_FAILURES:
+                backend.healthy = False
+                logger.warning(f"Ejecting ComfyUI backend {backend.address}: {e}")
+            return
+
+        backend.queue_running = len(queue.get("queue_running", []))
+        backend.queue_pending = len(queue.get("queue_pending", []))
+        backend.assigned_since_check = 0
+        backend.vram_free = sum(device.get("vram_free", 0) for device in stats.get("devices", []))
+        backend.last_checked = time.time()
+        backend.failures = 0
+        if not backend.healthy:
+            logger.info(f"ComfyUI backend {backend.address} is healthy again")
+            backend.healthy = True
+            self._wake()
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+            try:
+                await self.check_all()
+            except Exception as e:
+                logger.warning(f"Backend health check failed: {e}")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "backends": [backend.to_dict() for backend in self.backends],
+            "max_inflight": self.max_inflight,
+            "waiting_for_slot": len(self._waiters),
+            "slot_waits": self.slot_waits,
+            "affinity": {
+                "hits": self.affinity_hits,
+                "misses": self.affinity_misses,
+                "skipped_for_wait": self.affinity_skipped,
+                "hit_rate": self.affinity_hit_rate
+            }
+        }
@@ -0,0 +1,417 @@
+"""CPU-time benchmarks of the server's hot paths outside the GPU.
+
+Covers what every generation costs the worker: decoding the websocket event
+stream, loading and binding workflows, hashing them for the generation
+cache, spooling, thumbnailing and re-encoding 1280x1024 PNG batches,
+building multipart uploads, and the Supabase calls of supabase_client.py
+and the save path of async_image_processor.py. The Supabase benchmarks run
+against loadtest/fake_services.py, started as a subprocess, so they measure
+this process's share of the work: request building, serialization, parsing.
+
+Each benchmark is run in rounds of at least MIN_ROUND_SECONDS; the figure
+kept is the lowest process CPU time per call over the rounds, which is the
+least noisy. Compare a run against the committed baseline to spot
+regressions (exit status 1 when any benchmark got slower than --threshold):
+
+    python benchmarks/run.py                       # compare with benchmarks/baseline.json
+    python benchmarks/run.py --save                # record a new baseline
+    python benchmarks/run.py --filter workflow --rounds 10
+
+Baselines only compare on the same machine; re-record one after changing hardware.
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import io
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+import aiohttp
+import PIL
+from PIL import Image, ImageFilter
+from async_image_processor import AsyncImageProcessor, bind_flux_lora_workflow
+from comfyui_events import PREVIEW_IMAGE, ComfyUIEventStream
+from generation_cache import canonical_hash
+from image_postprocess import THUMBNAIL_SIZES, available_master_format, render_variants
+from image_stream import CHUNK_SIZE, SpooledImage, encode_thumbnail
+from persistence import ImagePersister
+from workflow_registry import WorkflowRegistry
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+MIN_ROUND_SECONDS = 0.2
+SERVICES_PORT = 8199
+
+# Realistic payloads: a Flux batch at the largest size the frontend offers, and long prompts
+IMAGE_SIZE = (1280, 1024)
+BATCH_SIZE = 4
+SAMPLER_STEPS = 30
+LONG_PROMPT = ", ".join(["a luxurious product shot of a chocolate bar on marble, soft rim light, "
+                         "shallow depth of field, 85mm, studio backdrop"] * 12)
+
+BENCHMARKS: Dict[str, Callable[["Context"], Callable[[], Any]]] = {}
+NEEDS_SERVICES = set()
+
+
+def benchmark(name: str, services: bool = False):
+    """Register a setup function; it prepares a payload and returns the callable to time"""
+    def register(setup):
+        BENCHMARKS[name] = setup
+        if services:
+            NEEDS_SERVICES.add(name)
+        return setup
+    return register
+
+
+def photo_png(seed: int, size=IMAGE_SIZE) -> bytes:
+    """A PNG that compresses like a generated photo: smooth colour fields with a little grain"""
+    rng = random.Random(seed)
+    width, height = size
+    channels = [Image.frombytes("L", (width // 4, height // 4), rng.randbytes(width * height // 16))
+                .resize(size, Image.BICUBIC).filter(ImageFilter.GaussianBlur(3)) for _ in range(3)]
+    grain = Image.frombytes("L", size, rng.randbytes(width * height))
+    buffer = io.BytesIO()
+    Image.merge("RGB", [Image.blend(channel, grain, 0.08) for channel in channels]).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class Context:
+    """Payloads shared by the benchmarks, built once"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.images = [photo_png(seed) for seed in range(BATCH_SIZE)]
+        self.registry = WorkflowRegistry().load()
+        self.counter = 0
+
+    def unique(self) -> int:
+        self.counter += 1
+        return self.counter
+
+    def session(self) -> aiohttp.ClientSession:
+        """An HTTP session on the benchmark loop; call from inside it"""
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    def run(self, coroutine_function: Callable[[], Any]) -> Callable[[], Any]:
+        return lambda: self.loop.run_until_complete(coroutine_function())
+
+    def close(self):
+        if self._session is not None:
+            self.loop.run_until_complete(self._session.close())
+        self.loop.close()
+
+
+def event_stream(prompt_ids: List[str], workflow: Dict[str, Any]) -> List[Any]:
+    """The websocket messages of a batch of prompts, as ComfyUI sends them with previews on"""
+    preview = io.BytesIO()
+    Image.new("RGB", (IMAGE_SIZE[0] // 8, IMAGE_SIZE[1] // 8), (120, 90, 60)).save(preview, "JPEG", quality=90)
+    preview_frame = struct.pack(">II", PREVIEW_IMAGE, 1) + preview.getvalue()
+    messages = []
+    for number, prompt_id in enumerate(prompt_ids):
+        messages.append(json.dumps({"type": "status", "data": {"status": {"exec_info": {
+            "queue_remaining": len(prompt_ids) - number}}, "sid": "bench"}}))
+        messages.append(json.dumps({"type": "execution_start", "data": {"prompt_id": prompt_id,
+                                                                       "timestamp": 1700000000000}}))
+        messages.append(json.dumps({"type": "execution_cached", "data": {
+            "nodes": ["10", "11", "12"], "prompt_id": prompt_id, "timestamp": 1700000000001}}))
+        for node_id, node in workflow.items():
+            if node_id in ("10", "11", "12"):
+                continue
+            messages.append(json.dumps({"type": "executing", "data": {
+                "node": node_id, "display_node": node_id, "prompt_id": prompt_id}}))
+            if node["class_type"] == "KSampler":
+                for step in range(SAMPLER_STEPS):
+                    messages.append(json.dumps({"type": "progress", "data": {
+                        "value": step + 1, "max": SAMPLER_STEPS, "prompt_id": prompt_id, "node": node_id}}))
+                    messages.append(preview_frame)
+            if node["class_type"] == "SaveImage":
+                messages.append(json.dumps({"type": "executed", "data": {
+                    "node": node_id, "display_node": node_id, "prompt_id": prompt_id, "output": {"images": [
+                        {"filename": f"ComfyUI_{number:05d}_{index}_.png", "subfolder": "", "type": "output"}
+                        for index in range(BATCH_SIZE)]}}}))
+        messages.append(json.dumps({"type": "execution_success", "data": {"prompt_id": prompt_id,
+                                                                         "timestamp": 1700000000002}}))
+        messages.append(json.dumps({"type": "executing", "data": {"node": None, "prompt_id": prompt_id}}))
+    return messages
+
+
+def bound_workflow(context: Context, seed: int = 42) -> Dict[str, Any]:
+    return bind_flux_lora_workflow(context.registry, IMAGE_SIZE[0], IMAGE_SIZE[1], "product_v3.safetensors",
+                                   LONG_PROMPT, LONG_PROMPT[:400], BATCH_SIZE, seed)
+
+
+@benchmark("websocket_events")
+def websocket_events(context: Context):
+    """Decode and route one prompt's events while three other clients' prompts run"""
+    prompt_ids = [f"prompt-{index}" for index in range(4)]
+    messages = event_stream(prompt_ids, bound_workflow(context))
+
+    def run():
+        stream = ComfyUIEventStream("127.0.0.1:0", "bench", {})
+        stream.watch(prompt_ids[0])
+        for message in messages:
+            stream._dispatch(message)
+    return run
+
+
+@benchmark("workflow_load")
+def workflow_load(context: Context):
+    return lambda: WorkflowRegistry().load()
+
+
+@benchmark("workflow_bind")
+def workflow_bind(context: Context):
+    return lambda: bound_workflow(context, context.unique())
+
+
+@benchmark("workflow_hash")
+def workflow_hash(context: Context):
+    workflow = bound_workflow(context)
+    return lambda: canonical_hash(workflow)
+
+
+@benchmark("image_spool")
+def image_spool(context: Context):
+    """Spool a batch as it arrives from /view, then read it back for upload"""
+    async def run():
+        for data in context.images:
+            image = SpooledImage()
+            for start in range(0, len(data), CHUNK_SIZE):
+                image.write(data[start:start + CHUNK_SIZE])
+            async for _ in image.chunks():
+                pass
+            image.close()
+    return context.run(run)
+
+
+@benchmark("inline_thumbnails")
+def inline_thumbnails(context: Context):
+    """JPEG thumbnails of a batch as base64 data URLs"""
+    return lambda: [encode_thumbnail(io.BytesIO(data)) for data in context.images]
+
+
+@benchmark("image_variants")
+def image_variants(context: Context):
+    """Master and thumbnails of one image, as the post-processing worker encodes them"""
+    master_format = available_master_format()
+    return lambda: render_variants(context.images[0], master_format, THUMBNAIL_SIZES)
+
+
+@benchmark("multipart_upload")
+def multipart_upload(context: Context):
+    """The /upload/image form for a reference image, serialized"""
+    class Sink:
+        async def write(self, chunk):
+            pass
+
+    async def run():
+        form = aiohttp.FormData()
+        form.add_field("image", context.images[0], filename="reference.png")
+        form.add_field("overwrite", "true")
+        await form().write(Sink())
+    return context.run(run)
+
+
+@benchmark("supabase_upload", services=True)
+def supabase_upload(context: Context):
+    """SupabaseClient.upload_image of a batch, through supabase-py"""
+    from supabase_client import SupabaseClient
+    client = SupabaseClient()
+
+    def run():
+        number = context.unique()
+        for index, data in enumerate(context.images):
+            client.upload_image(data, f"bench_{number}_{index}.png")
+    return run
+
+
+@benchmark("supabase_upload_stream", services=True)
+def supabase_upload_stream(context: Context):
+    """SupabaseClient.upload_image_stream of a spooled batch"""
+    from supabase_client import SupabaseClient
+    client = SupabaseClient()
+
+    async def run():
+        session = context.session()
+        number = context.unique()
+        for index, data in enumerate(context.images):
+            image = SpooledImage()
+            image.write(data)
+            await client.upload_image_stream(session, image.chunks(), image.size, f"bench_{number}_{index}.png")
+            image.close()
+    return context.run(run)
+
+
+@benchmark("supabase_metadata", services=True)
+def supabase_metadata(context: Context):
+    """One bulk insert of a batch's history rows"""
+    from supabase_client import SupabaseClient
+    client = SupabaseClient()
+    rows = [{
+        "filename": f"generated_image_20240101_000000_42_{index}.png", "prompt": LONG_PROMPT,
+        "negative_prompt": LONG_PROMPT[:400], "style": "studio", "product": "chocolate",
+        "resolution": "1280x1024", "lora_model": "product_v3.safetensors",
+        "generated_at": "2024-01-01T00:00:00", "image_url": client.get_public_url(f"generated_{index}.png"),
+        "seed": 42, "node_id": "9",
+        "variants": {variant: client.get_public_url(f"generated_{index}_{variant}.webp")
+                     for variant in ("master", "256", "512")}
+    } for index in range(BATCH_SIZE)]
+    return lambda: client.save_generation_metadata_bulk(rows)
+
+
+@benchmark("save_images", services=True)
+def save_images(context: Context):
+    """AsyncImageProcessor.save_flux_gguf_lora_basic_images for a batch: rows, URLs, uploads, insert"""
+    processor = AsyncImageProcessor(server_address="127.0.0.1:0", persister=ImagePersister())
+
+    async def run():
+        await processor.save_flux_gguf_lora_basic_images(
+            {"9": context.images}, context.unique(), IMAGE_SIZE[0], IMAGE_SIZE[1], "product_v3.safetensors",
+            LONG_PROMPT, LONG_PROMPT[:400], "studio", "chocolate", background=False)
+    return context.run(run)
+
+
+def measure(function: Callable[[], Any], rounds: int) -> Dict[str, Any]:
+    function()
+    # Enough calls per round that the timers' resolution does not matter
+    calls = 1
+    while True:
+        started = time.process_time()
+        for _ in range(calls):
+            function()
+        if time.process_time() - started >= MIN_ROUND_SECONDS:
+            break
+        calls *= 2
+    cpu, wall = [], []
+    # As timeit does: a collection landing in one round but not another is noise
+    gc.collect()
+    gc.disable()
+    try:
+        for _ in range(rounds):
+            cpu_started, wall_started = time.process_time(), time.perf_counter()
+            for _ in range(calls):
+                function()
+            cpu.append((time.process_time() - cpu_started) / calls)
+            wall.append((time.perf_counter() - wall_started) / calls)
+    finally:
+        gc.enable()
+    return {"cpu_seconds": min(cpu), "cpu_median_seconds": statistics.median(cpu),
+            "wall_median_seconds": statistics.median(wall), "calls_per_round": calls}
+
+
+def start_services() -> subprocess.Popen:
+    script = os.path.join(SERVER_DIR, "loadtest", "fake_services.py")
+    process = subprocess.Popen([sys.executable, script, "--port", str(SERVICES_PORT), "--storage-seconds", "0",
+                                "--table-seconds", "0", "--keep", "100"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", SERVICES_PORT), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The Supabase stand-in did not start")
+
+
+def machine() -> Dict[str, str]:
+    return {"python": platform.python_version(), "platform": platform.platform(), "processor": platform.machine(),
+            "pillow": PIL.__version__, "cpus": str(os.cpu_count())}
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    """Print each benchmark against the baseline and return the names that regressed"""
+    regressed = []
+    if baseline.get("machine") != machine():
+        print("Note: the baseline was recorded on a different machine or Python; ratios are indicative only")
+    print(f"\n{'benchmark':<24} {'cpu ms':>10} {'baseline':>10} {'ratio':>7}")
+    for name, result in results.items():
+        before = baseline.get("benchmarks", {}).get(name)
+        now = result["cpu_seconds"] * 1000
+        if before is None:
+            print(f"{name:<24} {now:>10.3f} {'-':>10} {'new':>7}")
+            continue
+        ratio = result["cpu_seconds"] / before["cpu_seconds"]
+        flag = "  REGRESSED" if ratio > 1 + threshold else ""
+        print(f"{name:<24} {now:>10.3f} {before['cpu_seconds'] * 1000:>10.3f} {ratio:>7.2f}{flag}")
+        if flag:
+            regressed.append(name)
+    return regressed
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="CPU-time benchmarks of the server's hot paths")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--rounds", type=int, default=7)
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="CPU time increase over the baseline counted as a regression")
+    parser.add_argument("--no-services", action="store_true", help="skip the Supabase benchmarks")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    options = parse_args(argv)
+    # The server modules log every request at DEBUG, which would be timed too
+    logging.getLogger().setLevel(logging.WARNING)
+    names = [name for name in BENCHMARKS if options.filter in name and
+             not (options.no_services and name in NEEDS_SERVICES)]
+    services = None
+    if any(name in NEEDS_SERVICES for name in names):
+        services = start_services()
+        os.environ["SUPABASE_URL"] = f"http://127.0.0.1:{SERVICES_PORT}"
+    context = Context()
+    results = {}
+    try:
+        for name in names:
+            # The save path prints progress for every batch
+            with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                results[name] = measure(BENCHMARKS[name](context), options.rounds)
+            result = results[name]
+            print(f"{name:<24} cpu {result['cpu_seconds'] * 1000:9.3f} ms  "
+                  f"wall {result['wall_median_seconds'] * 1000:9.3f} ms  ({result['calls_per_round']} calls/round)")
+    finally:
+        context.close()
+        if services is not None:
+            services.terminate()
+            services.wait()
+
+    if options.save:
+        # With --filter, the benchmarks that did not run keep their recorded figures
+        saved = {}
+        if os.path.exists(options.baseline):
+            with open(options.baseline) as f:
+                saved = json.load(f).get("benchmarks", {})
+        with open(options.baseline, "w") as f:
+            json.dump({"machine": machine(), "benchmarks": {**saved, **results}}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nBaseline written to {options.baseline}")
+        return 0
+    if not os.path.exists(options.baseline):
+        print(f"\nNo baseline at {options.baseline}; record one with --save")
+        return 0
+    with open(options.baseline) as f:
+        baseline = json.load(f)
+    return 1 if compare(results, baseline, options.threshold) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,65 @@
+import os
+import uuid
+import aiohttp
+from comfyui_events import ComfyUIEventStream
+from typing import Dict, Optional
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_SERVER_ADDRESS = "kv-g.1240865249176120.ap-southeast-1.pai-eas.aliyuncs.com"
+DEFAULT_AUTHORIZATION = "MjA0YWI0Y2RlZWQ2ZGUyYWZlYjdlNGYyNDFhN2E3Y2MxYmFjNmEwZQ=="
+
+# Connection pool tuning, overridable per deployment
+POOL_LIMIT = int(os.environ.get("COMFYUI_POOL_LIMIT", 100))
+POOL_LIMIT_PER_HOST = int(os.environ.get("COMFYUI_POOL_LIMIT_PER_HOST", 32))
+DNS_CACHE_TTL = int(os.environ.get("COMFYUI_DNS_CACHE_TTL", 300))
+KEEPALIVE_TIMEOUT = float(os.environ.get("COMFYUI_KEEPALIVE_TIMEOUT", 60))
+
+
+def create_pooled_session() -> aiohttp.ClientSession:
+    """Create a long-lived aiohttp session with keep-alive, per-host limits and DNS caching"""
+    connector = aiohttp.TCPConnector(
+        limit=POOL_LIMIT,
+        limit_per_host=POOL_LIMIT_PER_HOST,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        keepalive_timeout=KEEPALIVE_TIMEOUT
+    )
+    return aiohttp.ClientSession(connector=connector)
+
+
+class ComfyUIClient:
+    """Worker-wide ComfyUI connection shared by every request.
+
+    Created once in Quart's startup hook and closed at shutdown, so requests
+    reuse pooled keep-alive connections instead of paying a TCP/DNS handshake
+    each time. All prompts are queued under this client's clientId and their
+    progress arrives over the single websocket held by ``events``.
+    """
+
+    def __init__(self, server_address: Optional[str] = None, authorization: Optional[str] = None,
+                 session: Optional[aiohttp.ClientSession] = None):
+        server_address = server_address or os.environ.get("COMFYUI_SERVER_ADDRESS", DEFAULT_SERVER_ADDRESS)
+        self.server_address = server_address.rstrip('/')
+        self.client_id = str(uuid.uuid4())
+        self.headers: Dict[str, str] = {
+            'Content-Type': 'application/json',
+            'Authorization': authorization or os.environ.get("COMFYUI_AUTHORIZATION", DEFAULT_AUTHORIZATION)
+        }
+        # A session passed in is shared with other clients and closed by its owner
+        self.session: Optional[aiohttp.ClientSession] = session
+        self.owns_session = session is None
+        self.events = ComfyUIEventStream(self.server_address, self.client_id, self.headers)
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            self.session = create_pooled_session()
+            logger.debug(f"Opened pooled ComfyUI session for {self.server_address}")
+        # Subscribe before any prompt is queued so no event can be missed
+        await self.events.start()
+
+    async def close(self):
+        await self.events.close()
+        if self.owns_session:
+            if self.session is not None and not self.session.closed:
+                await self.session.close()
+            self.session = None
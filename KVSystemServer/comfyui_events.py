@@ -0,0 +1,192 @@
+import asyncio
+import json
+import os
+import struct
+import websockets
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+import logging
+logger = logging.getLogger(__name__)
+
+RECONNECT_MIN_DELAY = float(os.environ.get("COMFYUI_WS_RECONNECT_MIN_DELAY", 0.5))
+RECONNECT_MAX_DELAY = float(os.environ.get("COMFYUI_WS_RECONNECT_MAX_DELAY", 10))
+CONNECT_WAIT = float(os.environ.get("COMFYUI_WS_CONNECT_WAIT", 5))
+
+# Events that arrive before anyone watches their prompt_id are kept briefly
+MAX_UNCLAIMED_PROMPTS = 256
+MAX_UNCLAIMED_EVENTS = 512
+
+# Binary frame types sent by ComfyUI's websocket
+PREVIEW_IMAGE = 1
+PREVIEW_IMAGE_WITH_METADATA = 4
+PREVIEW_FORMATS = {1: "JPEG", 2: "PNG"}
+
+# Event types routed to the watcher of the prompt they belong to
+PROMPT_EVENTS = {
+    "execution_start", "execution_cached", "executing", "executed", "progress",
+    "execution_success", "execution_error", "execution_interrupted"
+}
+
+
+class PromptWatcher:
+    """Receives the websocket events of a single prompt_id"""
+
+    def __init__(self, prompt_id: str):
+        self.prompt_id = prompt_id
+        self.queue: asyncio.Queue = asyncio.Queue()
+
+    def put(self, event: Dict[str, Any]):
+        self.queue.put_nowait(event)
+
+    async def get(self) -> Dict[str, Any]:
+        return await self.queue.get()
+
+
+class ComfyUIEventStream:
+    """One persistent, auto-reconnecting ComfyUI websocket per worker.
+
+    Every prompt is queued with this stream's clientId, and incoming events
+    are dispatched to the PromptWatcher registered for their prompt_id. When
+    the socket drops, watchers receive a ``disconnected`` event so they can
+    fall back to polling ``/history/{prompt_id}`` until it comes back.
+    """
+
+    def __init__(self, server_address: str, client_id: str, headers: Dict[str, str]):
+        self.server_address = server_address
+        self.client_id = client_id
+        self.headers = headers
+        self.watchers: Dict[str, PromptWatcher] = {}
+        self.unclaimed: "OrderedDict[str, list]" = OrderedDict()
+        self.connected = asyncio.Event()
+        self.reconnects = 0
+        # Previews carry no prompt_id; they belong to whichever prompt is executing
+        self.running_prompt_id: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+        try:
+            await asyncio.wait_for(self.connected.wait(), CONNECT_WAIT)
+        except asyncio.TimeoutError:
+            logger.warning(f"ComfyUI websocket not connected yet; prompts will poll /history until it is")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.connected.clear()
+
+    def watch(self, prompt_id: str) -> PromptWatcher:
+        """Register interest in a prompt, replaying anything that arrived before"""
+        watcher = PromptWatcher(prompt_id)
+        self.watchers[prompt_id] = watcher
+        for event in self.unclaimed.pop(prompt_id, []):
+            watcher.put(event)
+        return watcher
+
+    def rekey(self, watcher: PromptWatcher, prompt_id: str):
+        """Move a watcher to the prompt_id the server actually assigned"""
+        if watcher.prompt_id == prompt_id:
+            return
+        self.watchers.pop(watcher.prompt_id, None)
+        watcher.prompt_id = prompt_id
+        self.watchers[prompt_id] = watcher
+        for event in self.unclaimed.pop(prompt_id, []):
+            watcher.put(event)
+
+    def unwatch(self, watcher: PromptWatcher):
+        if self.watchers.get(watcher.prompt_id) is watcher:
+            del self.watchers[watcher.prompt_id]
+
+    async def _run(self):
+        ws_url = f"ws://{self.server_address}/ws?clientId={self.client_id}"
+        delay = RECONNECT_MIN_DELAY
+        while True:
+            try:
+                async with websockets.connect(ws_url, extra_headers={'Authorization': self.headers['Authorization']},
+                                              max_size=None) as websocket:
+                    logger.debug(f"Connected to websocket at: {ws_url}")
+                    self.connected.set()
+                    delay = RECONNECT_MIN_DELAY
+                    async for message in websocket:
+                        self._dispatch(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"ComfyUI websocket error: {e}")
+
+            if self.connected.is_set():
+                self.connected.clear()
+                self.reconnects += 1
+                self.running_prompt_id = None
+                for watcher in list(self.watchers.values()):
+                    watcher.put({"type": "disconnected", "data": {}})
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+    def _dispatch(self, message):
+        if not isinstance(message, str):
+            self._dispatch_preview(message)
+            return
+        try:
+            event = json.loads(message)
+        except json.JSONDecodeError as e:
+            logger.warning(f"Failed to decode JSON message: {e}")
+            return
+
+        if event.get("type") not in PROMPT_EVENTS:
+            return
+        data = event.get("data") or {}
+        prompt_id = data.get("prompt_id")
+        if prompt_id is None:
+            return
+
+        finished = event["type"] in ("execution_success", "execution_error", "execution_interrupted") or \
+            (event["type"] == "executing" and data.get("node") is None)
+        if finished:
+            if self.running_prompt_id == prompt_id:
+                self.running_prompt_id = None
+        elif event["type"] in ("execution_start", "executing"):
+            self.running_prompt_id = prompt_id
+
+        watcher = self.watchers.get(prompt_id)
+        if watcher is not None:
+            watcher.put(event)
+            return
+
+        events = self.unclaimed.setdefault(prompt_id, [])
+        self.unclaimed.move_to_end(prompt_id)
+        if len(events) < MAX_UNCLAIMED_EVENTS:
+            events.append(event)
+        while len(self.unclaimed) > MAX_UNCLAIMED_PROMPTS:
+            self.unclaimed.popitem(last=False)
+
+    def _dispatch_preview(self, message: bytes):
+        """Route a binary latent preview frame to the watcher of the running prompt"""
+        if len(message) < 8:
+            return
+        frame_type = struct.unpack(">I", message[:4])[0]
+        prompt_id = self.running_prompt_id
+        if frame_type == PREVIEW_IMAGE:
+            image_format = PREVIEW_FORMATS.get(struct.unpack(">I", message[4:8])[0], "JPEG")
+            image = message[8:]
+        elif frame_type == PREVIEW_IMAGE_WITH_METADATA:
+            metadata_length = struct.unpack(">I", message[4:8])[0]
+            try:
+                metadata = json.loads(message[8:8 + metadata_length])
+            except ValueError:
+                return
+            prompt_id = metadata.get("prompt_id") or prompt_id
+            image_format = "PNG" if metadata.get("image_type") == "image/png" else "JPEG"
+            image = message[8 + metadata_length:]
+        else:
+            return
+
+        watcher = self.watchers.get(prompt_id) if prompt_id else None
+        if watcher is not None:
+            watcher.put({"type": "preview", "data": {"prompt_id": prompt_id, "format": image_format, "image": image}})
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+import logging
+logger = logging.getLogger(__name__)
+
+# Shared by every hypercorn worker on the host, so results survive restarts
+CACHE_DIR = os.environ.get("KV_CACHE_DIR", os.path.join(os.path.dirname(__file__), "cache"))
+
+
+class DiskCache:
+    """A small persistent key/value store with LRU and TTL eviction.
+
+    Values are JSON-serialisable and live in one SQLite file per cache name
+    under CACHE_DIR. WAL mode lets several worker processes share the file.
+    The blocking methods are fine from threads; coroutines should use the
+    ``a``-prefixed variants, which run them off the event loop.
+    """
+
+    def __init__(self, name: str, max_entries: int, ttl: float, directory: str = CACHE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.name = name
+        self.path = os.path.join(directory, f"{name}.sqlite3")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] + self.ttl < now:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        payload = json.dumps(value)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, payload, now, now)
+            )
+            self._writes += 1
+            # Evicting on every write would scan the table for nothing most of the time
+            if self._writes % 64 == 1:
+                self._evict(now)
+
+    def claim(self, key: str, value: Any, ttl: float) -> bool:
+        """Store ``value`` only if ``key`` is absent or older than ``ttl``; True if this call stored it.
+
+        Atomic across the processes sharing the file, so exactly one of them
+        wins, e.g. the right to run a computation the others then wait for.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.execute("DELETE FROM entries WHERE key = ? AND created_at < ?", (key, now - ttl))
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO entries (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now)
+            )
+        return cursor.rowcount == 1
+
+    def replace(self, key: str, expected: Any, value: Any) -> bool:
+        """Store ``value`` only while ``key`` still holds ``expected``; True if this call stored it"""
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE entries SET value = ?, created_at = ?, accessed_at = ? WHERE key = ? AND value = ?",
+                (json.dumps(value), now, now, key, json.dumps(expected))
+            )
+        return cursor.rowcount == 1
+
+    def delete(self, key: str, expected: Any = None):
+        """Remove ``key``; with ``expected``, only while it still holds that value"""
+        with self._lock:
+            if expected is None:
+                self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            else:
+                self._db.execute("DELETE FROM entries WHERE key = ? AND value = ?", (key, json.dumps(expected)))
+
+    def _evict(self, now: float):
+        self._db.execute("DELETE FROM entries WHERE created_at < ?", (now - self.ttl,))
+        self._db.execute(
+            "DELETE FROM entries WHERE key IN ("
+            " SELECT key FROM entries ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    async def aget(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: str, value: Any):
+        await asyncio.to_thread(self.set, key, value)
+
+    async def aclaim(self, key: str, value: Any, ttl: float) -> bool:
+        return await asyncio.to_thread(self.claim, key, value, ttl)
+
+    async def adelete(self, key: str, expected: Any = None):
+        await asyncio.to_thread(self.delete, key, expected)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "entries": entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None
+        }
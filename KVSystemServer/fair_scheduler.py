@@ -0,0 +1,200 @@
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from backend_pool import BackendPool
+from metrics import observe_stage
+import logging
+logger = logging.getLogger(__name__)
+
+# Waiting generations, across all users, before new ones are turned away with a 429
+MAX_QUEUE_DEPTH = int(os.environ.get("SCHEDULER_MAX_QUEUE_DEPTH", 32))
+# Waiting generations of one user before that user is turned away
+MAX_USER_QUEUE_DEPTH = int(os.environ.get("SCHEDULER_MAX_USER_QUEUE_DEPTH", 8))
+# Requests for at most this many images count as interactive unless they say otherwise
+INTERACTIVE_MAX_IMAGES = int(os.environ.get("SCHEDULER_INTERACTIVE_MAX_IMAGES", 1))
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+# Dispatch order: every waiting interactive request goes before any bulk one
+PRIORITIES = (INTERACTIVE, BULK)
+
+
+def configured_weights() -> Dict[str, float]:
+    """Per-user shares from SCHEDULER_USER_WEIGHTS, e.g. ``studio=2,intern=0.5``; others weigh 1"""
+    weights = {}
+    for item in os.environ.get("SCHEDULER_USER_WEIGHTS", "").split(","):
+        if "=" in item:
+            user, weight = item.split("=", 1)
+            weights[user.strip()] = float(weight)
+    return weights
+
+
+def default_priority(images: int) -> str:
+    return INTERACTIVE if images <= INTERACTIVE_MAX_IMAGES else BULK
+
+
+class SchedulerFull(Exception):
+    """The queue is too deep to take another request; try again after ``retry_after`` seconds"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """One request waiting for a generation slot"""
+
+    def __init__(self, user: str, priority: str, cost: float, finish: float):
+        self.user = user
+        self.priority = priority
+        self.cost = cost
+        self.finish = finish
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+class FairScheduler:
+    """Admission control and weighted fair queuing in front of the backend pool.
+
+    A slot is one backend job, so a merged batch of several callers' requests
+    holds a single slot. At most the pool's ``max_inflight`` jobs per healthy
+    backend run at once, so ComfyUI's own FIFO queue stays short; the pool
+    enforces that limit on each backend across every hypercorn worker, the
+    scheduler the total within its worker (admitted jobs whose slots other
+    workers hold wait in the pool). The others wait here: interactive
+    requests first, then bulk, and within a class users take turns in
+    proportion to their weight (start-time fair queuing over the images each
+    request asks for). One user's pile of batch jobs therefore only delays
+    other users by its fair share. Past MAX_QUEUE_DEPTH waiting requests, or
+    MAX_USER_QUEUE_DEPTH for one user, ``slot`` raises SchedulerFull at once.
+    """
+
+    def __init__(self, pool: BackendPool, max_queue_depth: int = MAX_QUEUE_DEPTH,
+                 max_user_queue_depth: int = MAX_USER_QUEUE_DEPTH, weights: Optional[Dict[str, float]] = None):
+        self.pool = pool
+        self.max_queue_depth = max_queue_depth
+        self.max_user_queue_depth = max_user_queue_depth
+        self.weights = configured_weights() if weights is None else weights
+        self.queues: Dict[str, List[Tuple[float, int, Ticket]]] = {priority: [] for priority in PRIORITIES}
+        self.virtual_time = {priority: 0.0 for priority in PRIORITIES}
+        # Virtual finish tag of each user's last request, per priority class
+        self.last_finish: Dict[Tuple[str, str], float] = {}
+        self.waiting: Counter = Counter()
+        self.inflight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._sequence = itertools.count()
+
+    @property
+    def capacity(self) -> int:
+        """Backend jobs that may run at once"""
+        healthy = sum(1 for backend in self.pool.backends if backend.healthy)
+        return max(healthy, 1) * self.pool.max_inflight
+
+    @property
+    def depth(self) -> int:
+        return sum(self.waiting.values())
+
+    def retry_after(self) -> int:
+        """Seconds until the queue has likely drained by one capacity's worth"""
+        backends = self.pool.backends
+        job_seconds = sum(backend.avg_job_seconds for backend in backends) / len(backends) if backends else 30
+        return max(1, min(300, math.ceil((self.depth + 1) / self.capacity * job_seconds)))
+
+    def check(self, user: str):
+        """Raise SchedulerFull if a new request from ``user`` would have to wait in an over-full queue"""
+        if self.inflight < self.capacity and not self.depth:
+            return
+        if self.depth >= self.max_queue_depth:
+            self.rejected += 1
+            raise SchedulerFull(f"Too many queued generations; retry in {self.retry_after()}s", self.retry_after())
+        if self.waiting[user] >= self.max_user_queue_depth:
+            self.rejected += 1
+            raise SchedulerFull(f"You already have {self.waiting[user]} generations queued; "
+                                f"retry in {self.retry_after()}s", self.retry_after())
+
+    @asynccontextmanager
+    async def slot(self, user: str, priority: str = INTERACTIVE, cost: float = 1, check: bool = True):
+        """Hold one backend job's slot, waiting for a fair turn if the backends are busy.
+
+        ``cost`` is the number of images the job makes. ``check=False`` skips the
+        depth limits, for work that was already admitted, e.g. a queued job.
+        """
+        if priority not in self.queues:
+            priority = BULK
+        if check:
+            self.check(user)
+        self.admitted += 1
+        if self.inflight < self.capacity and not self.depth:
+            self.inflight += 1
+        else:
+            started = time.monotonic()
+            await self._wait(user, priority, cost)
+            observe_stage("scheduler_wait", time.monotonic() - started)
+        try:
+            yield
+        finally:
+            self.inflight -= 1
+            self._dispatch()
+
+    async def _wait(self, user: str, priority: str, cost: float):
+        key = (user, priority)
+        start = max(self.virtual_time[priority], self.last_finish.get(key, 0.0))
+        ticket = Ticket(user, priority, cost, start + cost / self.weights.get(user, 1.0))
+        self.last_finish[key] = ticket.finish
+        heapq.heappush(self.queues[priority], (ticket.finish, next(self._sequence), ticket))
+        self.waiting[user] += 1
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.cancelled():
+                # Left while waiting; _dispatch skips the ticket and nobody holds its slot
+                self.waiting[user] -= 1
+                self._forget(user)
+            else:
+                # Granted a slot in the same tick we were cancelled; hand it on
+                self.inflight -= 1
+                self._dispatch()
+            raise
+
+    def _dispatch(self):
+        """Grant free slots to the waiting tickets with the smallest finish tags, by priority class"""
+        for priority in PRIORITIES:
+            queue = self.queues[priority]
+            while queue and self.inflight < self.capacity:
+                finish, _, ticket = heapq.heappop(queue)
+                if ticket.future.done():
+                    continue
+                self.virtual_time[priority] = max(self.virtual_time[priority], finish - ticket.cost /
+                                                  self.weights.get(ticket.user, 1.0))
+                self.waiting[ticket.user] -= 1
+                self._forget(ticket.user)
+                self.inflight += 1
+                ticket.future.set_result(None)
+            if not queue:
+                # An idle class restarts its clock, so old tags don't linger
+                self.virtual_time[priority] = 0.0
+                for key in [key for key in self.last_finish if key[1] == priority]:
+                    del self.last_finish[key]
+
+    def _forget(self, user: str):
+        if self.waiting[user] <= 0:
+            del self.waiting[user]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "inflight": self.inflight,
+            "queued": {priority: sum(1 for _, _, ticket in queue if not ticket.future.done())
+                       for priority, queue in self.queues.items()},
+            "queued_by_user": dict(self.waiting),
+            "max_queue_depth": self.max_queue_depth,
+            "max_user_queue_depth": self.max_user_queue_depth,
+            "admitted": self.admitted,
+            "rejected": self.rejected
+        }
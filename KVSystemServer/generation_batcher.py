@@ -0,0 +1,148 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+import logging
+logger = logging.getLogger(__name__)
+
+# How long the first request of a batch waits for compatible company
+BATCH_WINDOW_MS = float(os.environ.get("GENERATION_BATCH_WINDOW_MS", 300))
+# Upper bound on the merged EmptyLatentImage batch_size
+MAX_BATCH_SIZE = int(os.environ.get("GENERATION_MAX_BATCH_SIZE", 4))
+
+
+class PendingBatch:
+    """Requests collected under one key while its window is open"""
+
+    def __init__(self, key: Hashable):
+        self.key = key
+        self.requests: List[Any] = []
+        self.sizes: List[int] = []
+        self.futures: List[asyncio.Future] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def size(self) -> int:
+        return sum(self.sizes)
+
+
+class GenerationBatcher:
+    """Coalesces concurrent compatible generations into one ComfyUI prompt.
+
+    ``submit`` parks a request under its batch key for up to the batching
+    window; everything sharing the key is then handed to
+    ``run_batch(requests, sizes)`` at once, which must return one result per
+    request in order. A key of None, a zero window, or a request that alone
+    fills MAX_BATCH_SIZE runs immediately on its own.
+    """
+
+    def __init__(self, run_batch: Callable[[List[Any], List[int]], Awaitable[List[Any]]],
+                 window_ms: float = BATCH_WINDOW_MS, max_batch_size: int = MAX_BATCH_SIZE):
+        self.run_batch = run_batch
+        self.window = window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.pending: Dict[Hashable, PendingBatch] = {}
+        self.batches = 0
+        self.merged_requests = 0
+        self._tasks = set()
+
+    async def submit(self, key: Optional[Hashable], request: Any, size: int = 1) -> Any:
+        if key is None or self.window <= 0 or size >= self.max_batch_size:
+            results = await self.run_batch([request], [size])
+            return results[0]
+
+        batch = self.pending.get(key)
+        if batch is not None and batch.size + size > self.max_batch_size:
+            # No room left; send what we have and start a fresh batch
+            self._flush(batch)
+            batch = None
+        if batch is None:
+            batch = PendingBatch(key)
+            self.pending[key] = batch
+            batch.timer = asyncio.get_running_loop().call_later(self.window, self._flush, batch)
+
+        future = asyncio.get_running_loop().create_future()
+        batch.requests.append(request)
+        batch.sizes.append(size)
+        batch.futures.append(future)
+        if batch.size >= self.max_batch_size:
+            self._flush(batch)
+        # Shielded so one caller giving up does not cancel its batch-mates' generation
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            future.cancel()
+            self._abandon(batch)
+            raise
+
+    def _abandon(self, batch: PendingBatch):
+        """Drop a batch whose callers have all gone away"""
+        if not all(future.cancelled() for future in batch.futures):
+            return
+        if self.pending.get(batch.key) is batch:
+            del self.pending[batch.key]
+            batch.timer.cancel()
+        elif batch.task is not None:
+            batch.task.cancel()
+
+    def _flush(self, batch: PendingBatch):
+        if self.pending.get(batch.key) is batch:
+            del self.pending[batch.key]
+        if batch.timer is not None:
+            batch.timer.cancel()
+            batch.timer = None
+        batch.task = asyncio.create_task(self._run(batch))
+        self._tasks.add(batch.task)
+        batch.task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: PendingBatch):
+        # Callers cancelled while the window was open don't get images generated
+        live = [index for index, future in enumerate(batch.futures) if not future.cancelled()]
+        batch.requests = [batch.requests[index] for index in live]
+        batch.sizes = [batch.sizes[index] for index in live]
+        batch.futures = [batch.futures[index] for index in live]
+        if not batch.futures:
+            return
+        self.batches += 1
+        if len(batch.requests) > 1:
+            self.merged_requests += len(batch.requests)
+            logger.info(f"Running {len(batch.requests)} requests as one batch of {batch.size} images")
+        try:
+            results = await self.run_batch(batch.requests, batch.sizes)
+        except asyncio.CancelledError:
+            for future in batch.futures:
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in batch.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(batch.futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def close(self):
+        for batch in list(self.pending.values()):
+            self._flush(batch)
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "window_ms": self.window * 1000,
+            "max_batch_size": self.max_batch_size,
+            "batches": self.batches,
+            "merged_requests": self.merged_requests,
+            "pending": sum(len(batch.requests) for batch in self.pending.values())
+        }
+
+
+def split_batch(images: Dict[str, List[Any]], sizes: List[int]) -> List[Dict[str, List[Any]]]:
+    """Cut each output node's image list back into per-request slices, in submission order"""
+    slices = []
+    offset = 0
+    for size in sizes:
+        slices.append({node_id: node_images[offset:offset + size] for node_id, node_images in images.items()})
+        offset += size
+    return slices
@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import json
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional
+from disk_cache import DiskCache
+import logging
+logger = logging.getLogger(__name__)
+
+CACHE_MAX_ENTRIES = int(os.environ.get("GENERATION_CACHE_MAX_ENTRIES", 1024))
+# Cached results point at public Supabase URLs, which stay valid long after generation
+CACHE_TTL_SECONDS = float(os.environ.get("GENERATION_CACHE_TTL_SECONDS", 24 * 3600))
+# A worker's claim on a running generation lapses after this long, should the worker die
+# mid-run; it should outlast GENERATION_DEADLINE_SECONDS
+CLAIM_SECONDS = float(os.environ.get("GENERATION_CACHE_CLAIM_SECONDS", 900))
+# How often a request waiting on another worker's generation looks for its result
+CLAIM_POLL_SECONDS = 0.5
+
+
+def canonical_hash(value: Any) -> str:
+    """sha256 of a JSON value with sorted keys, so equal workflows hash equally"""
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class InFlight:
+    """A running computation and the number of callers waiting on it"""
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class GenerationCache:
+    """Generation results shared by every worker, with single-flight execution across them.
+
+    ``get_or_run(key, factory)`` returns a stored result for ``key``; failing
+    that, it joins a computation already running under the same key in this
+    worker, or waits for one another worker has claimed, and only otherwise
+    starts ``factory()``. Results live in a DiskCache, so a retry reaching
+    any worker finds them. The computation runs in its own task, so it is
+    only cancelled once every caller waiting on it has gone away. Results
+    that are None are never stored.
+    """
+
+    def __init__(self, cache: Optional[DiskCache] = None):
+        self.cache = cache or DiskCache("generations", CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+        self.inflight: Dict[str, InFlight] = {}
+        self.hits = 0
+        self.misses = 0
+        self.joined = 0
+        self.waited = 0
+
+    async def get_or_run(self, key: Optional[str], factory: Callable[[], Awaitable[Any]]) -> Any:
+        if key is None:
+            return await factory()
+        flight = self.inflight.get(key)
+        if flight is None:
+            cached = await self.cache.aget(key)
+            if cached is not None:
+                self.hits += 1
+                return cached
+            # Checked again, as another caller may have started it during the lookup
+            flight = self.inflight.get(key)
+        if flight is None:
+            flight = InFlight(asyncio.create_task(self._run(key, factory)))
+            self.inflight[key] = flight
+        else:
+            self.joined += 1
+            logger.info(f"Joining in-flight generation {key[:16]}")
+        flight.waiters += 1
+        try:
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+            raise
+
+    async def _run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            pending = f"pending:{key}"
+            waited = False
+            # Another worker already running the same generation is waited for rather than repeated
+            while not await self.cache.aclaim(pending, os.getpid(), CLAIM_SECONDS):
+                waited = True
+                await asyncio.sleep(CLAIM_POLL_SECONDS)
+                cached = await self.cache.aget(key)
+                if cached is not None:
+                    self.waited += 1
+                    return cached
+            if waited:
+                logger.info(f"Generation {key[:16]} was not finished elsewhere; running it here")
+            self.misses += 1
+            try:
+                result = await factory()
+                if result is not None:
+                    await self.cache.aset(key, result)
+                return result
+            finally:
+                await asyncio.shield(self.cache.adelete(pending))
+        finally:
+            self.inflight.pop(key, None)
+
+    def to_dict(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses + self.joined + self.waited
+        return {
+            **self.cache.to_dict(),
+            "inflight": len(self.inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "joined_inflight": self.joined,
+            "waited_for_other_worker": self.waited,
+            "hit_rate": (self.hits + self.joined + self.waited) / lookups if lookups else None
+        }
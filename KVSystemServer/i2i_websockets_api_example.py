@@ -6,8 +6,8 @@ import uuid
 import json
 import urllib.request
 import urllib.parse
-import requests
 import os
+from upload_cache import get_upload_cache
 
 server_address = "kv-g.1240865249176120.ap-southeast-1.pai-eas.aliyuncs.com"
 client_id = str(uuid.uuid4())
@@ -92,34 +92,10 @@ def get_images(ws, prompt):
 
 def upload_file(file, subfolder="", overwrite=False):
     try:
-        # Wrap file in formdata so it includes filename
-        body = {"image": file}
-        data = {}
-        
-        if overwrite:
-            data["overwrite"] = "true"
-  
-        if subfolder:
-            data["subfolder"] = subfolder
-
-        headers = {
-            'Authorization': 'MjA0YWI0Y2RlZWQ2ZGUyYWZlYjdlNGYyNDFhN2E3Y2MxYmFjNmEwZQ=='
-        }
-        resp = requests.post(f"http://{server_address}/upload/image", files=body, data=data, headers=headers)
-        
-        if resp.status_code == 200:
-            data = resp.json()
-            # Add the file to the dropdown list and update the widget value
-            path = data["name"]
-            if "subfolder" in data:
-                if data["subfolder"] != "":
-                    path = data["subfolder"] + "/" + path
-            return path
-        else:
-            error_msg = f"Image upload failed: {resp.status_code} - {resp.reason}"
-            if resp.text:
-                error_msg += f"\n{resp.text}"
-            raise Exception(error_msg)
+        # Skipped when the server still has this exact image from an earlier run
+        entry = get_upload_cache().upload_sync(server_address, 'MjA0YWI0Y2RlZWQ2ZGUyYWZlYjdlNGYyNDFhN2E3Y2MxYmFjNmEwZQ==',
+                                               file.read(), getattr(file, "name", None), subfolder)
+        return entry["path"]
     except Exception as error:
         raise Exception(f"Image upload error: {str(error)}")
 
@@ -0,0 +1,124 @@
+import asyncio
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple, Union
+from PIL import Image
+import logging
+logger = logging.getLogger(__name__)
+
+# Encode a compressed master and thumbnails next to every generated PNG
+IMAGE_VARIANTS = os.environ.get("IMAGE_VARIANTS", "1") == "1"
+# "webp", or "avif" where Pillow has an AVIF encoder (pillow-avif-plugin)
+IMAGE_MASTER_FORMAT = os.environ.get("IMAGE_MASTER_FORMAT", "webp").upper()
+IMAGE_MASTER_QUALITY = int(os.environ.get("IMAGE_MASTER_QUALITY", 90))
+IMAGE_MASTER_LOSSLESS = os.environ.get("IMAGE_MASTER_LOSSLESS", "0") == "1"
+THUMBNAIL_SIZES = tuple(int(size) for size in os.environ.get("IMAGE_THUMBNAIL_SIZES", "256,512").split(","))
+THUMBNAIL_QUALITY = int(os.environ.get("IMAGE_THUMBNAIL_QUALITY", 80))
+# Encoder threads per hypercorn worker
+POSTPROCESS_WORKERS = int(os.environ.get("IMAGE_POSTPROCESS_WORKERS", 1))
+
+CONTENT_TYPES = {"WEBP": "image/webp", "AVIF": "image/avif"}
+EXTENSIONS = {"WEBP": ".webp", "AVIF": ".avif"}
+
+
+def available_master_format() -> str:
+    if IMAGE_MASTER_FORMAT == "AVIF":
+        try:
+            import pillow_avif  # noqa: F401  registers the AVIF plugin
+        except ImportError:
+            pass
+        if "AVIF" in Image.SAVE:
+            return "AVIF"
+        logger.warning("AVIF encoding is not available; writing WebP masters instead")
+    return "WEBP"
+
+
+def render_variants(source: Union[str, bytes], master_format: str,
+                    thumbnail_sizes: Tuple[int, ...]) -> Dict[str, bytes]:
+    """Encode the master and every thumbnail of one image, given its path or bytes; runs in an encoder thread"""
+    variants = {}
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as image:
+        image.load()
+        buffer = io.BytesIO()
+        if IMAGE_MASTER_LOSSLESS:
+            image.save(buffer, format=master_format, lossless=True)
+        else:
+            image.save(buffer, format=master_format, quality=IMAGE_MASTER_QUALITY)
+        variants["master"] = buffer.getvalue()
+
+        rgb = image.convert("RGB")
+        for size in sorted(thumbnail_sizes, reverse=True):
+            # Shrinking the previous, larger thumbnail is cheaper and looks the same
+            rgb.thumbnail((size, size), Image.LANCZOS)
+            buffer = io.BytesIO()
+            rgb.save(buffer, format="WEBP", quality=THUMBNAIL_QUALITY)
+            variants[str(size)] = buffer.getvalue()
+    return variants
+
+
+class ImagePostprocessor:
+    """Produces a WebP/AVIF master and fixed-size WebP thumbnails of generated images.
+
+    Pillow work runs in a thread pool, off the event loop; Pillow releases
+    the GIL while it decodes, resizes and encodes, so the threads run in
+    parallel with request handling. Hypercorn's workers are daemon processes
+    and may not start a process pool of their own.
+    """
+
+    def __init__(self, workers: int = POSTPROCESS_WORKERS, thumbnail_sizes: Tuple[int, ...] = THUMBNAIL_SIZES):
+        self.workers = workers
+        self.thumbnail_sizes = thumbnail_sizes
+        self.master_format = available_master_format()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="image-postprocess")
+        return self._executor
+
+    async def check(self):
+        """Encode a small image end to end, raising RuntimeError if variants cannot be produced here"""
+        buffer = io.BytesIO()
+        Image.new("RGB", (64, 64), (128, 128, 128)).save(buffer, format="PNG")
+        try:
+            variants = await self.render(buffer.getvalue())
+        except Exception as e:
+            raise RuntimeError(f"Image variants are enabled but cannot be encoded: {e}; "
+                               f"fix the encoder or set IMAGE_VARIANTS=0") from e
+        missing = set(self.filenames("check.png")) - set(variants)
+        if missing:
+            raise RuntimeError(f"Image variant encoding produced no {', '.join(sorted(missing))}")
+
+    def filenames(self, filename: str) -> Dict[str, str]:
+        """Storage names of every variant of ``filename``"""
+        stem = os.path.splitext(filename)[0]
+        names = {"master": stem + EXTENSIONS[self.master_format]}
+        for size in self.thumbnail_sizes:
+            names[str(size)] = f"{stem}_{size}.webp"
+        return names
+
+    def content_type(self, variant: str) -> str:
+        return CONTENT_TYPES[self.master_format] if variant == "master" else "image/webp"
+
+    async def render(self, source: Union[str, bytes]) -> Dict[str, bytes]:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, render_variants, source, self.master_format,
+                                          self.thumbnail_sizes)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+
+_postprocessor: Optional[ImagePostprocessor] = None
+
+
+def get_postprocessor() -> Optional[ImagePostprocessor]:
+    """Process-wide post-processor, or None when IMAGE_VARIANTS is off"""
+    global _postprocessor
+    if _postprocessor is None and IMAGE_VARIANTS:
+        _postprocessor = ImagePostprocessor()
+    return _postprocessor
@@ -3,8 +3,8 @@ import uuid
 import json
 import urllib.request
 import urllib.parse
-import requests
-import os
+from workflow_registry import get_registry
+from upload_cache import get_upload_cache
 
 class ImageProcessor:
     def __init__(self, server_address="127.0.0.1:8188"):
@@ -23,24 +23,12 @@ class ImageProcessor:
 
     def upload_file(self, file_data, subfolder="", overwrite=False):
         try:
-            body = {"image": file_data}
-            data = {}
-            
-            if overwrite:
-                data["overwrite"] = "true"
-            if subfolder:
-                data["subfolder"] = subfolder
-
-            resp = requests.post(f"http://{self.server_address}/upload/image", files=body, data=data)
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                path = data["name"]
-                if "subfolder" in data and data["subfolder"]:
-                    path = f"{data['subfolder']}/{path}"
-                return path
-            else:
-                raise Exception(f"{resp.status_code} - {resp.reason}")
+            # Repeat uploads of the same image are skipped while the server still has it
+            data = file_data.read()
+            filename = getattr(file_data, "filename", None) or getattr(file_data, "name", None)
+            entry = get_upload_cache().upload_sync(self.server_address, None, data,
+                                                   filename if isinstance(filename, str) else None, subfolder)
+            return entry["path"]
         except Exception as error:
             raise Exception(f"Upload failed: {str(error)}")
 
@@ -64,23 +52,17 @@ class ImageProcessor:
             # Upload the image
             uploaded_path = self.upload_file(image_data, "", True)
             
-            # Load the workflow
-            workflow_path = os.path.join("workflow", "MiniCPMV Prompt Creator.json")
-            with open(workflow_path, "r", encoding="utf-8") as f:
-                workflow = json.loads(f.read())
-
-            # Update the workflow with our image
-            workflow["3"]["inputs"]["image"] = uploaded_path
-
-            # Configure parameters
-            workflow["1"]["inputs"].update({
-                "caption_method": "long_prompt",
-                "max_new_tokens": 2048,
-                "num_beams": 3,
-                "prefix_caption": "",
-                "suffix_caption": "",
-                "replace_tags": ""
-            })
+            # Bind the preloaded workflow with our image and parameters
+            template = get_registry().get("MiniCPMV Prompt Creator")
+            workflow = template.bind(
+                image=uploaded_path,
+                caption_method="long_prompt",
+                max_new_tokens=2048,
+                num_beams=3,
+                prefix_caption="",
+                suffix_caption="",
+                replace_tags=""
+            )
 
             # Connect to websocket and execute
             ws = websocket.WebSocket()
@@ -93,7 +75,7 @@ class ImageProcessor:
             # Extract the generated prompt
             if "outputs" in result:
                 for node_id in result["outputs"]:
-                    if node_id == "4":  # ShowText node
+                    if node_id == template.outputs["prompt"]:  # ShowText node
                         text_output = result["outputs"][node_id].get("text", "")
                         if text_output:
                             return text_output
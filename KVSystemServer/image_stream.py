@@ -0,0 +1,100 @@
+import asyncio
+import base64
+import io
+import os
+import tempfile
+from typing import AsyncIterator, BinaryIO, Optional, Union
+import aiohttp
+from PIL import Image
+import logging
+logger = logging.getLogger(__name__)
+
+# Images up to this size stay in memory; larger ones spill to a temporary file
+SPOOL_MAX_MEMORY = int(os.environ.get("IMAGE_SPOOL_MAX_MEMORY", 512 * 1024))
+CHUNK_SIZE = 64 * 1024
+# Inline thumbnails are opt-in and capped, so responses stay small
+INLINE_THUMBNAIL_SIZE = min(int(os.environ.get("INLINE_THUMBNAIL_SIZE", 128)), 256)
+INLINE_THUMBNAIL_QUALITY = int(os.environ.get("INLINE_THUMBNAIL_QUALITY", 70))
+
+
+def encode_thumbnail(source: BinaryIO, max_size: int = INLINE_THUMBNAIL_SIZE,
+                     quality: int = INLINE_THUMBNAIL_QUALITY) -> str:
+    """Downscale an image and return it as a JPEG data URL"""
+    with Image.open(source) as image:
+        image.draft("RGB", (max_size, max_size))
+        image = image.convert("RGB")
+        image.thumbnail((max_size, max_size))
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=quality)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class SpooledImage:
+    """An image held in memory up to SPOOL_MAX_MEMORY, then in a temporary file.
+
+    Lets a generated image travel from ComfyUI's ``/view`` to storage in
+    CHUNK_SIZE pieces, so memory per image stays around SPOOL_MAX_MEMORY
+    however large the image or the batch. A spilled image keeps its file's
+    path, so an encoder can open the image alongside the upload.
+    """
+
+    def __init__(self, content_type: str = "image/png"):
+        self.file: BinaryIO = io.BytesIO()
+        self.path: Optional[str] = None
+        self.content_type = content_type
+        self.size = 0
+
+    @classmethod
+    async def from_response(cls, response: aiohttp.ClientResponse) -> "SpooledImage":
+        image = cls(response.headers.get("Content-Type", "image/png"))
+        try:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                image.write(chunk)
+        except BaseException:
+            image.close()
+            raise
+        return image
+
+    def write(self, chunk: bytes):
+        if self.path is None and self.size + len(chunk) > SPOOL_MAX_MEMORY:
+            self._spill()
+        self.file.write(chunk)
+        self.size += len(chunk)
+
+    def _spill(self):
+        fd, path = tempfile.mkstemp(prefix="kv-image-")
+        spilled = os.fdopen(fd, "w+b")
+        spilled.write(self.file.getvalue())
+        self.file, self.path = spilled, path
+
+    def source(self) -> Union[str, bytes]:
+        """What an encoder should open: the spilled file's path, or the few bytes still held in memory"""
+        return self.path if self.path is not None else self.file.getvalue()
+
+    def _read_at(self, offset: int) -> bytes:
+        self.file.seek(offset)
+        return self.file.read(CHUNK_SIZE)
+
+    async def chunks(self) -> AsyncIterator[bytes]:
+        """The image in CHUNK_SIZE pieces, read in a thread so a spilled spool never blocks the event loop"""
+        offset = 0
+        while True:
+            chunk = await asyncio.to_thread(self._read_at, offset)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk
+
+    def thumbnail(self, max_size: int = INLINE_THUMBNAIL_SIZE) -> str:
+        """Small JPEG data URL of the image, decoded straight from the spool"""
+        self.file.seek(0)
+        return encode_thumbnail(self.file, max_size)
+
+    def close(self):
+        self.file.close()
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                logger.warning(f"Could not remove spooled image {self.path}: {e}")
+            self.path = None
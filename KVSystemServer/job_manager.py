@@ -0,0 +1,298 @@
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union
+from disk_cache import DiskCache
+import logging
+logger = logging.getLogger(__name__)
+
+# Finished jobs are kept this long so clients can still fetch their results
+JOB_TTL_SECONDS = float(os.environ.get("JOB_TTL_SECONDS", 3600))
+MAX_JOBS = int(os.environ.get("JOB_REGISTRY_MAX", 1000))
+# Events buffered per progress subscriber before the oldest are dropped
+SUBSCRIBER_QUEUE_SIZE = 64
+# How often job state is mirrored to the store every worker reads, and how
+# often a worker looks there for cancellations of the jobs it runs
+JOB_SYNC_SECONDS = float(os.environ.get("JOB_SYNC_SECONDS", 0.5))
+
+
+class JobFailed(Exception):
+    """Raised by a job runner to mark the job failed with a readable message"""
+
+
+class Job:
+    """A generation running in the background of a worker"""
+
+    def __init__(self, kind: str, params: Dict[str, Any], idempotency_key: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.idempotency_key = idempotency_key
+        self.status = "queued"
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.progress: Dict[str, Any] = {"stage": "queued"}
+        self.subscribers: List[asyncio.Queue] = []
+        # Called on every change of status or progress, so the registry can share it
+        self.on_change: Optional[Callable[["Job"], None]] = None
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "type": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error
+        }
+
+    def update_progress(self, **fields):
+        """Merge fields into the job's progress and notify subscribers"""
+        self.progress.update(fields)
+        self.publish("progress", dict(self.progress))
+
+    def publish(self, event_type: str, data: Dict[str, Any]):
+        for queue in self.subscribers:
+            _put_dropping_oldest(queue, (event_type, data))
+        if event_type != "preview" and self.on_change is not None:
+            self.on_change(self)
+
+    def subscribe(self) -> asyncio.Queue:
+        """Return a queue of (event_type, data) tuples, ending with None when the job finishes"""
+        queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        if self.done:
+            queue.put_nowait(("status", self.to_dict()))
+            queue.put_nowait(None)
+        else:
+            self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        if queue in self.subscribers:
+            self.subscribers.remove(queue)
+
+    def _finish(self):
+        self.finished_at = time.time()
+        self.progress["stage"] = self.status
+        self.publish("status", self.to_dict())
+        for queue in self.subscribers:
+            _put_dropping_oldest(queue, None)
+        self.subscribers = []
+
+
+class SharedJob:
+    """A job as another worker last mirrored it to the shared store.
+
+    Answers status polls like a Job; its progress can only be polled, and
+    previews are not shared.
+    """
+
+    def __init__(self, state: Dict[str, Any]):
+        self.state = state
+
+    @property
+    def id(self) -> str:
+        return self.state["job_id"]
+
+    @property
+    def status(self) -> str:
+        return self.state["status"]
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    @property
+    def progress(self) -> Dict[str, Any]:
+        return self.state["progress"]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self.state
+
+
+def _put_dropping_oldest(queue: asyncio.Queue, item):
+    # A slow listener loses old frames rather than stalling the job
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(item)
+
+
+class JobRegistry:
+    """Registry of background jobs, shared by every hypercorn worker on the host.
+
+    Jobs outlive the request that submitted them, so clients poll by id
+    instead of holding a connection open for the whole generation. A job
+    runs in the worker that accepted it; its status, progress and result are
+    mirrored to a DiskCache every JOB_SYNC_SECONDS, so polls, cancellations
+    and retries with the same idempotency key can reach any worker.
+    """
+
+    def __init__(self, shared: Optional[DiskCache] = None):
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        # Idempotency key -> id of the job it created
+        self.idempotency: Dict[str, str] = {}
+        # Holds a state row per job, plus rows for idempotency keys and cancel requests
+        self.shared = shared or DiskCache("jobs", 3 * MAX_JOBS, JOB_TTL_SECONDS)
+        self._changed: Dict[str, Job] = {}
+        self._sync_task: Optional[asyncio.Task] = None
+
+    async def submit(self, kind: str, params: Dict[str, Any], runner: Callable[[Job], Awaitable[Any]],
+                     idempotency_key: Optional[str] = None) -> Union[Job, SharedJob]:
+        """Start ``runner(job)`` in the background and return the job immediately.
+
+        A repeated ``idempotency_key`` returns the job it first created, in
+        whichever worker, unless that job failed or was cancelled, in which
+        case it runs again.
+        """
+        self._prune()
+        if idempotency_key is not None:
+            job = await self.find(idempotency_key)
+            if job is not None and job.status not in ("failed", "cancelled"):
+                return job
+        job = Job(kind, params, idempotency_key)
+        self.jobs[job.id] = job
+        if idempotency_key is not None:
+            self.idempotency[idempotency_key] = job.id
+        # Shared before the id is handed out, so the first poll finds it on any worker
+        await asyncio.to_thread(self._write, [job])
+        job.on_change = self._mark_changed
+        if self._sync_task is None:
+            self._sync_task = asyncio.create_task(self._sync())
+        job.task = asyncio.create_task(self._run(job, runner))
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """A job running or kept in this worker"""
+        return self.jobs.get(job_id)
+
+    async def lookup(self, job_id: str) -> Optional[Union[Job, SharedJob]]:
+        """A job of this worker, or of any other as last shared"""
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        state = await self.shared.aget(f"job:{job_id}")
+        return SharedJob(state) if state is not None else None
+
+    async def find(self, idempotency_key: str) -> Optional[Union[Job, SharedJob]]:
+        """The job a previous submission with ``idempotency_key`` created, if it is still known"""
+        job_id = self.idempotency.get(idempotency_key) or await self.shared.aget(f"key:{idempotency_key}")
+        return await self.lookup(job_id) if job_id is not None else None
+
+    async def cancel(self, job_id: str) -> Optional[Union[Job, SharedJob]]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return await self._cancel_shared(job_id)
+        if job.done:
+            return job
+        job.task.cancel()
+        await asyncio.wait([job.task])
+        return job
+
+    async def _cancel_shared(self, job_id: str) -> Optional[SharedJob]:
+        """Ask the worker running ``job_id`` to cancel it, and wait briefly for it to do so"""
+        job = await self.lookup(job_id)
+        if job is None or job.done:
+            return job
+        await self.shared.aset(f"cancel:{job_id}", True)
+        for _ in range(4):
+            await asyncio.sleep(JOB_SYNC_SECONDS)
+            job = await self.lookup(job_id) or job
+            if job.done:
+                break
+        return job
+
+    async def close(self):
+        for job in list(self.jobs.values()):
+            if not job.done:
+                job.task.cancel()
+        tasks = [job.task for job in self.jobs.values() if job.task is not None]
+        if tasks:
+            await asyncio.wait(tasks)
+        if self._sync_task is not None:
+            self._sync_task.cancel()
+            await asyncio.wait([self._sync_task])
+        # Final states of the cancelled jobs
+        await asyncio.to_thread(self._write, list(self._changed.values()))
+        self.shared.close()
+
+    def _mark_changed(self, job: Job):
+        self._changed[job.id] = job
+
+    def _write(self, jobs: List[Job]):
+        for job in jobs:
+            self.shared.set(f"job:{job.id}", job.to_dict())
+            if job.idempotency_key is not None:
+                self.shared.set(f"key:{job.idempotency_key}", job.id)
+
+    def _cancel_requested(self, job_ids: List[str]) -> List[str]:
+        return [job_id for job_id in job_ids if self.shared.get(f"cancel:{job_id}")]
+
+    async def _sync(self):
+        """Mirror changed jobs to the shared store and act on cancellations asked of other workers"""
+        while True:
+            await asyncio.sleep(JOB_SYNC_SECONDS)
+            # Progress arriving faster than this is coalesced into its latest state
+            changed, self._changed = self._changed, {}
+            try:
+                if changed:
+                    await asyncio.to_thread(self._write, list(changed.values()))
+                running = [job.id for job in self.jobs.values() if not job.done]
+                if running:
+                    for job_id in await asyncio.to_thread(self._cancel_requested, running):
+                        job = self.jobs.get(job_id)
+                        if job is not None and not job.done:
+                            logger.info(f"Cancelling job {job_id} at another worker's request")
+                            job.task.cancel()
+            except Exception as e:
+                logger.error(f"Failed to share job state: {e}")
+                # Retried on the next pass, unless the job has changed again since
+                self._changed = {**changed, **self._changed}
+
+    async def _run(self, job: Job, runner: Callable[[Job], Awaitable[Any]]):
+        job.status = "running"
+        job.started_at = time.time()
+        job.publish("status", job.to_dict())
+        try:
+            job.result = await runner(job)
+            job.status = "succeeded"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        except JobFailed as e:
+            job.status = "failed"
+            job.error = str(e)
+        except Exception as e:
+            logger.exception(f"Job {job.id} ({job.kind}) crashed")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job._finish()
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self.jobs.items()):
+            if job.done and now - job.finished_at > JOB_TTL_SECONDS:
+                self._forget(job)
+        # Over capacity, forget the oldest finished jobs first
+        for job_id, job in list(self.jobs.items()):
+            if len(self.jobs) < MAX_JOBS:
+                break
+            if job.done:
+                self._forget(job)
+
+    def _forget(self, job: Job):
+        del self.jobs[job.id]
+        if job.idempotency_key is not None and self.idempotency.get(job.idempotency_key) == job.id:
+            del self.idempotency[job.idempotency_key]
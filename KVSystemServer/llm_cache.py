@@ -0,0 +1,32 @@
+import hashlib
+import os
+from typing import Any, Dict, Optional
+from disk_cache import DiskCache
+
+LLM_CACHE_MAX_ENTRIES = int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 20000))
+LLM_CACHE_TTL_SECONDS = float(os.environ.get("LLM_CACHE_TTL_SECONDS", 30 * 24 * 3600))
+
+
+class LLMCache:
+    """DeepSeek responses keyed by model, sampling settings and prompt content.
+
+    Regenerating a catalog of prompts only calls the API for prompts that
+    changed; changing the model, temperature or max_tokens starts afresh.
+    """
+
+    def __init__(self, cache: Optional[DiskCache] = None):
+        self.cache = cache or DiskCache("llm_responses", LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL_SECONDS)
+
+    @staticmethod
+    def key(model: str, temperature: float, max_tokens: int, prompt: str) -> str:
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return f"{model}:{temperature}:{max_tokens}:{digest}"
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self.cache.aget(key)
+
+    async def put(self, key: str, response: str):
+        await self.cache.aset(key, response)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self.cache.to_dict()
@@ -0,0 +1,307 @@
+"""A stand-in ComfyUI server for load tests and local development without a GPU.
+
+Runs prompts one at a time like ComfyUI does, sending the same websocket
+events (status, execution_start, execution_cached, executing, progress with
+binary preview frames, executed, execution_success/error/interrupted) and
+serving /prompt, /ws, /history/{id}, /view, /upload/image, /queue,
+/interrupt and /system_stats. Node delays follow the node's class_type;
+model loaders are only slow when their inputs changed since the last prompt,
+as ComfyUI caches them.
+
+    python loadtest/fake_comfyui.py --port 8188 --step-seconds 0.05 --failure-rate 0.02
+"""
+import argparse
+import asyncio
+import io
+import json
+import random
+import struct
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+from aiohttp import web
+from PIL import Image
+
+# Seconds a node of each class takes, before --speed scaling; anything else takes OTHER_SECONDS
+NODE_SECONDS = {
+    "UnetLoaderGGUF": 4.0,
+    "DualCLIPLoaderGGUF": 3.0,
+    "VAELoader": 0.5,
+    "LoraLoader": 1.0,
+    "Qwen2_ModelLoader_Zho": 3.0,
+    "CLIPTextEncode": 0.1,
+    "VAEDecode": 0.3,
+    "SaveImage": 0.05,
+    "Qwen2_Zho": 2.0,
+    "Prompt_Generator": 1.0,
+}
+LOADERS = {"UnetLoaderGGUF", "DualCLIPLoaderGGUF", "VAELoader", "LoraLoader", "Qwen2_ModelLoader_Zho"}
+OTHER_SECONDS = 0.02
+# Binary websocket frame: PREVIEW_IMAGE, JPEG
+PREVIEW_HEADER = struct.pack(">II", 1, 1)
+
+
+def encode_image(width: int, height: int, image_format: str, seed: int) -> bytes:
+    rng = random.Random(seed)
+    color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+    buffer = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+class FakeComfyUI:
+    def __init__(self, options: argparse.Namespace):
+        self.options = options
+        self.sockets: Dict[str, web.WebSocketResponse] = {}
+        self.history: Dict[str, Dict[str, Any]] = {}
+        self.pending: List[Dict[str, Any]] = []
+        self.running: Optional[Dict[str, Any]] = None
+        self.uploads: Dict[str, bytes] = {}
+        self.outputs: Dict[str, bytes] = {}
+        # Inputs each loader node ran with last, to decide what ComfyUI would have cached
+        self.loaded: Dict[str, str] = {}
+        self.wakeup = asyncio.Event()
+        self.interrupted = False
+        self.counter = 0
+        self.preview = encode_image(64, 64, "JPEG", 0)
+        self.stats = {"prompts": 0, "completed": 0, "failed": 0, "interrupted": 0, "deleted": 0,
+                      "uploads": 0, "views": 0, "websockets": 0}
+
+    def seconds(self, class_type: str) -> float:
+        return NODE_SECONDS.get(class_type, OTHER_SECONDS) * self.options.speed
+
+    async def send(self, client_id: Optional[str], message):
+        ws = self.sockets.get(client_id)
+        if ws is None or ws.closed:
+            return
+        try:
+            if isinstance(message, bytes):
+                await ws.send_bytes(message)
+            else:
+                await ws.send_str(json.dumps(message))
+        except ConnectionError:
+            pass
+
+    async def send_status(self, client_id: Optional[str] = None):
+        remaining = len(self.pending) + (1 if self.running else 0)
+        message = {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": remaining}}}}
+        for target in ([client_id] if client_id else list(self.sockets)):
+            await self.send(target, message)
+
+    async def worker(self):
+        while True:
+            while not self.pending:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+            self.running = self.pending.pop(0)
+            self.interrupted = False
+            try:
+                await self.execute(self.running)
+            except Exception as e:
+                print(f"Fake execution crashed: {e}")
+            finally:
+                self.running = None
+                await self.send_status()
+
+    async def execute(self, item: Dict[str, Any]):
+        prompt_id, prompt, client_id = item["prompt_id"], item["prompt"], item["client_id"]
+        await self.send(client_id, {"type": "execution_start", "data": {"prompt_id": prompt_id}})
+        cached = [node_id for node_id, node in prompt.items()
+                  if node["class_type"] in LOADERS and
+                  self.loaded.get(node_id) == json.dumps(node["inputs"], sort_keys=True)]
+        await self.send(client_id, {"type": "execution_cached", "data": {"nodes": cached, "prompt_id": prompt_id}})
+
+        outputs = {}
+        fail_at = random.choice(list(prompt)) if random.random() < self.options.failure_rate else None
+        for node_id, node in prompt.items():
+            if node_id in cached:
+                continue
+            class_type = node["class_type"]
+            await self.send(client_id, {"type": "executing",
+                                        "data": {"node": node_id, "display_node": node_id, "prompt_id": prompt_id}})
+            if class_type == "KSampler":
+                steps = int(node["inputs"].get("steps", 20))
+                for step in range(steps):
+                    await asyncio.sleep(self.options.step_seconds)
+                    if self.interrupted:
+                        break
+                    await self.send(client_id, {"type": "progress", "data": {
+                        "value": step + 1, "max": steps, "prompt_id": prompt_id, "node": node_id}})
+                    if self.options.previews:
+                        await self.send(client_id, PREVIEW_HEADER + self.preview)
+            else:
+                await asyncio.sleep(self.seconds(class_type))
+
+            if self.interrupted:
+                self.stats["interrupted"] += 1
+                await self.send(client_id, {"type": "execution_interrupted", "data": {
+                    "prompt_id": prompt_id, "node_id": node_id, "node_type": class_type, "executed": []}})
+                self.history[prompt_id] = {"prompt": [0, prompt_id, prompt, {}, []], "outputs": outputs,
+                                           "status": {"status_str": "error", "completed": False}}
+                return
+            if node_id == fail_at:
+                self.stats["failed"] += 1
+                await self.send(client_id, {"type": "execution_error", "data": {
+                    "prompt_id": prompt_id, "node_id": node_id, "node_type": class_type,
+                    "exception_message": "Injected failure", "exception_type": "RuntimeError"}})
+                self.history[prompt_id] = {"prompt": [0, prompt_id, prompt, {}, []], "outputs": outputs,
+                                           "status": {"status_str": "error", "completed": False}}
+                return
+            if class_type in LOADERS:
+                self.loaded[node_id] = json.dumps(node["inputs"], sort_keys=True)
+
+            output = self.output(prompt, node_id, node)
+            if output is not None:
+                outputs[node_id] = output
+                await self.send(client_id, {"type": "executed", "data": {
+                    "node": node_id, "display_node": node_id, "output": output, "prompt_id": prompt_id}})
+
+        self.history[prompt_id] = {"prompt": [0, prompt_id, prompt, {}, []], "outputs": outputs,
+                                   "status": {"status_str": "success", "completed": True}}
+        self.stats["completed"] += 1
+        await self.send(client_id, {"type": "execution_success", "data": {"prompt_id": prompt_id}})
+        await self.send(client_id, {"type": "executing", "data": {"node": None, "prompt_id": prompt_id}})
+
+    def output(self, prompt: Dict[str, Any], node_id: str, node: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """What an output node reports in its executed event and in /history"""
+        class_type = node["class_type"]
+        if class_type == "SaveImage":
+            latent = next((other["inputs"] for other in prompt.values()
+                           if other["class_type"] == "EmptyLatentImage"), {})
+            width, height = int(latent.get("width", 512)), int(latent.get("height", 512))
+            images = []
+            for index in range(int(latent.get("batch_size", 1))):
+                self.counter += 1
+                filename = f"ComfyUI_{self.counter:05d}_.png"
+                self.outputs[filename] = encode_image(width, height, "PNG", self.counter)
+                images.append({"filename": filename, "subfolder": "", "type": "output"})
+            return {"images": images}
+        if class_type == "ShowText|pysssss":
+            return {"text": [f"a studio photograph of a product, soft light, detailed, variation {self.counter}"]}
+        return None
+
+    async def post_prompt(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        prompt_id = body.get("prompt_id") or str(uuid.uuid4())
+        self.stats["prompts"] += 1
+        self.pending.append({"prompt_id": prompt_id, "prompt": body["prompt"], "client_id": body.get("client_id"),
+                             "number": self.stats["prompts"]})
+        self.wakeup.set()
+        await self.send_status()
+        return web.json_response({"prompt_id": prompt_id, "number": self.stats["prompts"], "node_errors": {}})
+
+    async def websocket(self, request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        client_id = request.query.get("clientId") or uuid.uuid4().hex
+        self.sockets[client_id] = ws
+        self.stats["websockets"] += 1
+        await self.send_status(client_id)
+        async for _ in ws:
+            pass
+        if self.sockets.get(client_id) is ws:
+            del self.sockets[client_id]
+        return ws
+
+    async def get_history(self, request: web.Request) -> web.Response:
+        prompt_id = request.match_info["prompt_id"]
+        entry = self.history.get(prompt_id)
+        return web.json_response({prompt_id: entry} if entry else {})
+
+    async def view(self, request: web.Request) -> web.Response:
+        filename = request.query.get("filename", "")
+        source = self.uploads if request.query.get("type") == "input" else self.outputs
+        if filename not in source:
+            return web.Response(status=404)
+        self.stats["views"] += 1
+        content_type = "image/png" if filename.endswith(".png") else "image/jpeg"
+        return web.Response(body=source[filename], content_type=content_type)
+
+    async def upload(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        image = form["image"]
+        name = getattr(image, "filename", None) or "upload.png"
+        subfolder = form.get("subfolder", "")
+        self.uploads[name] = image.file.read()
+        self.stats["uploads"] += 1
+        return web.json_response({"name": name, "subfolder": subfolder, "type": "input"})
+
+    async def get_queue(self, request: web.Request) -> web.Response:
+        running = [[self.running["number"], self.running["prompt_id"], {}, {}, []]] if self.running else []
+        pending = [[item["number"], item["prompt_id"], {}, {}, []] for item in self.pending]
+        return web.json_response({"queue_running": running, "queue_pending": pending})
+
+    async def post_queue(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if body.get("clear"):
+            self.stats["deleted"] += len(self.pending)
+            self.pending.clear()
+        for prompt_id in body.get("delete", []):
+            for item in list(self.pending):
+                if item["prompt_id"] == prompt_id:
+                    self.pending.remove(item)
+                    self.stats["deleted"] += 1
+        return web.json_response({})
+
+    async def interrupt(self, request: web.Request) -> web.Response:
+        try:
+            body = await request.json()
+        except ValueError:
+            body = {}
+        target = body.get("prompt_id")
+        if self.running and (target is None or target == self.running["prompt_id"]):
+            self.interrupted = True
+        return web.json_response({})
+
+    async def system_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "system": {"os": "fake", "python_version": "", "embedded_python": False},
+            "devices": [{"name": "fake:0", "type": "cuda", "index": 0,
+                         "vram_total": 24 * 1024 ** 3, "vram_free": 16 * 1024 ** 3}]
+        })
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "pending": len(self.pending), "running": bool(self.running)})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+
+        async def start_worker(app):
+            app["worker"] = asyncio.create_task(self.worker())
+
+        app.on_startup.append(start_worker)
+        app.add_routes([
+            web.post("/prompt", self.post_prompt),
+            web.get("/ws", self.websocket),
+            web.get("/history/{prompt_id}", self.get_history),
+            web.get("/view", self.view),
+            web.post("/upload/image", self.upload),
+            web.get("/queue", self.get_queue),
+            web.post("/queue", self.post_queue),
+            web.post("/interrupt", self.interrupt),
+            web.get("/system_stats", self.system_stats),
+            web.get("/fake/stats", self.get_stats),
+        ])
+        return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fake ComfyUI server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--step-seconds", type=float, default=0.05, help="time per KSampler step")
+    parser.add_argument("--speed", type=float, default=0.1,
+                        help="scale applied to every other node's delay (1 is roughly a real GPU)")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of prompts failing on a random node")
+    parser.add_argument("--no-previews", dest="previews", action="store_false",
+                        help="don't send binary preview frames during sampling")
+    parser.add_argument("--seed", type=int, default=None, help="seed for injected failures")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    if options.seed is not None:
+        random.seed(options.seed)
+    print(f"Fake ComfyUI listening on {options.host}:{options.port} at {time.strftime('%H:%M:%S')}")
+    web.run_app(FakeComfyUI(options).app(), host=options.host, port=options.port, print=None)
@@ -0,0 +1,145 @@
+"""Stand-ins for the Supabase and DeepSeek APIs the server calls, for load tests.
+
+Supabase: storage uploads to /storage/v1/object/{bucket}/{path}, public
+downloads from /storage/v1/object/public/{bucket}/{path}, and inserts into
+/rest/v1/{table}, answered the way PostgREST does with return=representation.
+DeepSeek: /v1/chat/completions, plain or streamed as server-sent events.
+Objects and rows are kept in memory, up to --keep of each.
+
+    python loadtest/fake_services.py --port 8191 --llm-seconds 0.5
+    SUPABASE_URL=http://127.0.0.1:8191 DEEPSEEK_API_BASE=http://127.0.0.1:8191/v1 hypercorn app:app ...
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import OrderedDict
+from aiohttp import web
+
+
+class FakeServices:
+    def __init__(self, options: argparse.Namespace):
+        self.options = options
+        self.objects: "OrderedDict[str, tuple]" = OrderedDict()
+        self.rows: "OrderedDict[int, dict]" = OrderedDict()
+        self.next_id = 1
+        self.stats = {"uploads": 0, "upload_bytes": 0, "downloads": 0, "rows": 0, "llm_calls": 0,
+                      "llm_streams": 0, "llm_throttled": 0, "failed": 0}
+
+    def fail(self) -> bool:
+        if random.random() < self.options.failure_rate:
+            self.stats["failed"] += 1
+            return True
+        return False
+
+    def remember(self, store: OrderedDict, key, value):
+        store[key] = value
+        while len(store) > self.options.keep:
+            store.popitem(last=False)
+
+    async def upload(self, request: web.Request) -> web.Response:
+        bucket, path = request.match_info["bucket"], request.match_info["path"]
+        data = await request.read()
+        await asyncio.sleep(self.options.storage_seconds)
+        if self.fail():
+            return web.json_response({"statusCode": "500", "error": "Internal", "message": "Injected failure"},
+                                     status=500)
+        key = f"{bucket}/{path}"
+        if key in self.objects and request.headers.get("x-upsert", "false") != "true":
+            return web.json_response({"statusCode": "409", "error": "Duplicate",
+                                      "message": "The resource already exists"}, status=409)
+        self.remember(self.objects, key, (data, request.headers.get("Content-Type", "application/octet-stream")))
+        self.stats["uploads"] += 1
+        self.stats["upload_bytes"] += len(data)
+        return web.json_response({"Key": key})
+
+    async def download(self, request: web.Request) -> web.Response:
+        key = f"{request.match_info['bucket']}/{request.match_info['path']}"
+        if key not in self.objects:
+            return web.json_response({"statusCode": "404", "error": "not_found", "message": "Object not found"},
+                                     status=404)
+        self.stats["downloads"] += 1
+        data, content_type = self.objects[key]
+        return web.Response(body=data, content_type=content_type)
+
+    async def insert(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        await asyncio.sleep(self.options.table_seconds)
+        if self.fail():
+            return web.json_response({"code": "XX000", "message": "Injected failure", "details": None,
+                                      "hint": None}, status=500)
+        saved = []
+        for row in body if isinstance(body, list) else [body]:
+            row = {"id": self.next_id, "created_at": time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime()),
+                   **row}
+            self.next_id += 1
+            self.remember(self.rows, row["id"], row)
+            saved.append(row)
+        self.stats["rows"] += len(saved)
+        return web.json_response(saved, status=201)
+
+    async def chat(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        self.stats["llm_calls"] += 1
+        if random.random() < self.options.llm_throttle_rate:
+            self.stats["llm_throttled"] += 1
+            return web.Response(status=429, text="Rate limit reached", headers={"Retry-After": "1"})
+        if self.fail():
+            return web.json_response({"error": {"message": "Injected failure"}}, status=500)
+        prompt = body["messages"][-1]["content"]
+        words = [f" word{index}" for index in range(self.options.llm_tokens)]
+        words[0] = f"Echo of {len(prompt)} characters:"
+        delay = self.options.llm_seconds / len(words)
+        if not body.get("stream"):
+            await asyncio.sleep(self.options.llm_seconds)
+            return web.json_response({
+                "id": f"fake-{self.stats['llm_calls']}", "object": "chat.completion", "model": body.get("model"),
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(words)}}]
+            })
+
+        self.stats["llm_streams"] += 1
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        for word in words:
+            await asyncio.sleep(delay)
+            chunk = {"choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({**self.stats, "objects": len(self.objects)})
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.add_routes([
+            web.get("/storage/v1/object/public/{bucket}/{path:.+}", self.download),
+            web.post("/storage/v1/object/{bucket}/{path:.+}", self.upload),
+            web.put("/storage/v1/object/{bucket}/{path:.+}", self.upload),
+            web.post("/rest/v1/{table}", self.insert),
+            web.post("/v1/chat/completions", self.chat),
+            web.get("/fake/stats", self.get_stats),
+        ])
+        return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fake Supabase and DeepSeek APIs for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8191)
+    parser.add_argument("--storage-seconds", type=float, default=0.02, help="delay per storage upload")
+    parser.add_argument("--table-seconds", type=float, default=0.01, help="delay per table insert")
+    parser.add_argument("--llm-seconds", type=float, default=0.5, help="time to generate a whole completion")
+    parser.add_argument("--llm-tokens", type=int, default=20, help="tokens per completion")
+    parser.add_argument("--llm-throttle-rate", type=float, default=0.0, help="share of LLM calls answered with 429")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="share of calls answered with 500")
+    parser.add_argument("--keep", type=int, default=2000, help="objects and rows kept in memory")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    print(f"Fake Supabase and DeepSeek listening on {options.host}:{options.port}")
+    web.run_app(FakeServices(options).app(), host=options.host, port=options.port, print=None)
@@ -0,0 +1,266 @@
+"""Drive app.py at a series of concurrency levels and report what it sustains.
+
+For each level, ``--concurrency`` clients send requests back to back to
+/generate_flux_lora, /generate_prompt and /run_llm (or a mix), for
+``--requests`` requests or ``--duration`` seconds. Reported per level and
+route: throughput, p50/p95/p99 latency, errors and 429s, and with
+``--server-pid`` the resident memory of each hypercorn worker (sampled from
+/proc, so Linux only). Results go to stdout and, with ``--output``, a JSON file.
+
+Against the stand-ins (see README.md):
+
+    python loadtest/harness.py --url http://127.0.0.1:5000 --scenario mix --concurrency 1,4,16 \\
+        --duration 60 --server-pid $(pgrep -of "hypercorn app:app")
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional
+import aiohttp
+from PIL import Image
+
+SCENARIOS = {
+    "flux": ["flux"],
+    "prompt": ["prompt"],
+    "llm": ["llm"],
+    # Roughly the production mix: mostly LLM calls and generations, some reference images
+    "mix": ["llm", "llm", "flux", "flux", "prompt"],
+}
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def reference_image(seed: int) -> bytes:
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    Image.new("RGB", (256, 256), (rng.randrange(256), rng.randrange(256), rng.randrange(256))).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def is_helper(pid: int) -> bool:
+    """Multiprocessing's resource tracker also runs under hypercorn; it serves no requests"""
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as cmdline:
+            return b"resource_tracker" in cmdline.read()
+    except OSError:
+        return True
+
+
+def worker_pids(server_pid: int) -> List[int]:
+    """The hypercorn workers under ``server_pid``, or the server itself when it runs without children"""
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as stat:
+                # The command name may hold spaces; the parent pid follows its closing parenthesis
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == server_pid and not is_helper(int(entry)):
+            children.append(int(entry))
+    return sorted(children) or [server_pid]
+
+
+def rss_mb(pid: int) -> Optional[float]:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+class MemorySampler:
+    """Resident memory of each worker, sampled every ``interval`` seconds while a level runs"""
+
+    def __init__(self, server_pid: Optional[int], interval: float = 1.0):
+        self.server_pid = server_pid
+        self.interval = interval
+        self.samples: Dict[int, List[float]] = {}
+
+    async def run(self):
+        while self.server_pid:
+            for pid in worker_pids(self.server_pid):
+                value = rss_mb(pid)
+                if value is not None:
+                    self.samples.setdefault(pid, []).append(value)
+            await asyncio.sleep(self.interval)
+
+    def report(self) -> Dict[str, Any]:
+        return {str(pid): {"start_mb": round(values[0], 1), "end_mb": round(values[-1], 1),
+                           "peak_mb": round(max(values), 1)}
+                for pid, values in self.samples.items()}
+
+
+class LoadTest:
+    def __init__(self, options: argparse.Namespace):
+        self.options = options
+        self.counter = itertools.count()
+        self.images = [reference_image(seed) for seed in range(options.distinct_images)]
+
+    async def request(self, session: aiohttp.ClientSession, kind: str, client: int) -> int:
+        """Send one request of ``kind`` and return its status; a body with success false counts as an error"""
+        number = next(self.counter)
+        headers = {"X-User-Id": f"loadtest-{client % self.options.users}"}
+        if self.options.proxy_secret:
+            # The server only believes X-User-Id from its proxy
+            headers["X-Proxy-Secret"] = self.options.proxy_secret
+        if kind == "flux":
+            body = {"width": self.options.width, "height": self.options.height,
+                    "lora_name": self.options.lora_name, "positive_prompt": f"product photo {number}",
+                    "negative_prompt": "", "batch_size": self.options.batch_size,
+                    "product": "loadtest", "style": "loadtest"}
+            async with session.post(f"{self.options.url}/generate_flux_lora", json=body,
+                                    headers=headers) as response:
+                return await self.status(response)
+        if kind == "prompt":
+            form = aiohttp.FormData()
+            form.add_field("image", self.images[number % len(self.images)], filename=f"reference_{number}.png",
+                           content_type="image/png")
+            if not self.options.use_prompt_cache:
+                form.add_field("bypass_cache", "1")
+            async with session.post(f"{self.options.url}/generate_prompt", data=form, headers=headers) as response:
+                return await self.status(response)
+        body = {"prompt": f"Write a product description for item {number}."}
+        async with session.post(f"{self.options.url}/run_llm", json=body, headers=headers) as response:
+            return await self.status(response)
+
+    @staticmethod
+    async def status(response: aiohttp.ClientResponse) -> int:
+        text = await response.text()
+        if response.status == 200:
+            try:
+                if json.loads(text).get("success") is False:
+                    return 500
+            except ValueError:
+                return 502
+        return response.status
+
+    async def client(self, session: aiohttp.ClientSession, client: int, kinds: List[str], stop_at: float,
+                     remaining: List[int], results: Dict[str, Dict[str, list]]):
+        for turn in itertools.count(client):
+            if time.monotonic() >= stop_at or remaining[0] <= 0:
+                return
+            remaining[0] -= 1
+            kind = kinds[turn % len(kinds)]
+            started = time.monotonic()
+            try:
+                status = await self.request(session, kind, client)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print(f"{kind} request failed: {type(e).__name__} {e}")
+                status = 0
+            seconds = time.monotonic() - started
+            entry = results.setdefault(kind, {"ok": [], "errors": [], "throttled": []})
+            if status == 200:
+                entry["ok"].append(seconds)
+            elif status == 429:
+                entry["throttled"].append(seconds)
+            else:
+                entry["errors"].append(status)
+
+    async def level(self, concurrency: int) -> Dict[str, Any]:
+        options = self.options
+        kinds = SCENARIOS[options.scenario]
+        results: Dict[str, Dict[str, list]] = {}
+        sampler = MemorySampler(options.server_pid)
+        sampling = asyncio.create_task(sampler.run())
+        remaining = [options.requests if options.requests else float("inf")]
+        stop_at = time.monotonic() + (options.duration or float("inf"))
+        timeout = aiohttp.ClientTimeout(total=options.timeout)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        started = time.monotonic()
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            await asyncio.gather(*(self.client(session, client, kinds, stop_at, remaining, results)
+                                   for client in range(concurrency)))
+        elapsed = time.monotonic() - started
+        sampling.cancel()
+
+        routes = {}
+        for kind, entry in results.items():
+            ok = entry["ok"]
+            routes[kind] = {
+                "completed": len(ok),
+                "errors": len(entry["errors"]),
+                "error_statuses": sorted(set(entry["errors"])),
+                "throttled": len(entry["throttled"]),
+                "throughput_per_second": round(len(ok) / elapsed, 3),
+                **{f"p{int(fraction * 100)}_seconds": round(value, 3) if value is not None else None
+                   for fraction in (0.5, 0.95, 0.99) for value in [percentile(ok, fraction)]}
+            }
+        return {"concurrency": concurrency, "seconds": round(elapsed, 2), "routes": routes,
+                "workers": sampler.report()}
+
+    async def run(self) -> List[Dict[str, Any]]:
+        report = []
+        for concurrency in self.options.concurrency:
+            print(f"\nConcurrency {concurrency}, scenario {self.options.scenario}")
+            result = await self.level(concurrency)
+            print_level(result)
+            report.append(result)
+            await asyncio.sleep(self.options.pause)
+        return report
+
+
+def print_level(result: Dict[str, Any]):
+    print(f"{'route':<8} {'ok':>6} {'err':>5} {'429':>5} {'req/s':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for kind, route in result["routes"].items():
+        latencies = [route[name] for name in ("p50_seconds", "p95_seconds", "p99_seconds")]
+        print(f"{kind:<8} {route['completed']:>6} {route['errors']:>5} {route['throttled']:>5} "
+              f"{route['throughput_per_second']:>8.2f} " +
+              " ".join(f"{value:>8.3f}" if value is not None else f"{'-':>8}" for value in latencies))
+    for pid, memory in result["workers"].items():
+        print(f"worker {pid}: {memory['start_mb']:.1f} MB -> {memory['end_mb']:.1f} MB, "
+              f"peak {memory['peak_mb']:.1f} MB")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test the KV System server")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mix")
+    parser.add_argument("--concurrency", default="1,4,16",
+                        type=lambda value: [int(level) for level in value.split(",")],
+                        help="comma separated concurrency levels, run in turn")
+    parser.add_argument("--requests", type=int, default=0, help="requests per level (0: until --duration)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per level (0: until --requests)")
+    parser.add_argument("--pause", type=float, default=2, help="seconds between levels")
+    parser.add_argument("--timeout", type=float, default=900, help="seconds before a request is abandoned")
+    parser.add_argument("--users", type=int, default=8, help="distinct X-User-Id values the clients spread over")
+    parser.add_argument("--proxy-secret", default=os.environ.get("KV_PROXY_SECRET", ""),
+                        help="the server's KV_PROXY_SECRET; without it all clients count as one user")
+    parser.add_argument("--server-pid", type=int, default=None,
+                        help="pid of the hypercorn master, to sample the memory of its workers")
+    parser.add_argument("--width", type=int, default=512)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--lora-name", default="loadtest.safetensors")
+    parser.add_argument("--distinct-images", type=int, default=8, help="reference images /generate_prompt cycles through")
+    parser.add_argument("--use-prompt-cache", action="store_true",
+                        help="let /generate_prompt answer from its prompt cache instead of bypassing it")
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    options = parser.parse_args(argv)
+    if not options.requests and not options.duration:
+        parser.error("give --requests or --duration")
+    return options
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    report = asyncio.run(LoadTest(options).run())
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump({"scenario": options.scenario, "levels": report}, output, indent=2)
+        print(f"\nReport written to {options.output}")
@@ -0,0 +1,177 @@
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Stage durations run from tens of milliseconds (uploads) to minutes (queued sampling)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+# Labels describing the work in progress, inherited by tasks it creates
+STAGE_LABELS = ("route", "template", "backend", "lora_name")
+_labels: contextvars.ContextVar = contextvars.ContextVar("metric_labels", default={})
+# Clients choose the LoRA, so lora_name labels are bounded: the first METRICS_MAX_LORA_LABELS
+# distinct names keep their own label and later ones are reported as "other". A comma
+# separated METRICS_LORA_NAMES fixes the labelled set instead.
+METRICS_MAX_LORA_LABELS = int(os.environ.get("METRICS_MAX_LORA_LABELS", 32))
+METRICS_LORA_NAMES = frozenset(name.strip() for name in os.environ.get("METRICS_LORA_NAMES", "").split(",")
+                               if name.strip())
+_lora_labels = set(METRICS_LORA_NAMES)
+
+
+def format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def collect(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, value: float, **labels):
+        """For totals counted elsewhere and copied in at scrape time"""
+        self.values[self.key(labels)] = value
+
+    def collect(self) -> List[str]:
+        return self.header() + [f"{self.name}{format_labels(self.labelnames, key)} {value}"
+                                for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def clear(self):
+        """Forget every series, before setting the current ones at scrape time"""
+        self.values.clear()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: count per bucket (not cumulative), then sum and count
+        self.series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        series[-2] += value
+        series[-1] += 1
+
+    def collect(self) -> List[str]:
+        lines = self.header()
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                labels = format_labels(self.labelnames + ("le",), key + (f"{bound:g}",))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames + ("le",), key + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {series[-2]}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("kv_stage_duration_seconds", "Duration of each processing stage of a request",
+                          STAGE_LABELS + ("stage",))
+INFLIGHT_JOBS = Gauge("kv_inflight_jobs", "Jobs holding a backend, by backend", ("backend",))
+SCHEDULED_JOBS = Gauge("kv_scheduler_jobs", "Generations running or waiting in the fair scheduler", ("state",))
+BACKGROUND_JOBS = Gauge("kv_background_jobs", "Jobs submitted through /jobs, by status", ("status",))
+BACKEND_QUEUE_DEPTH = Gauge("kv_backend_queue_depth", "Prompts in a backend's ComfyUI queue at the last check",
+                            ("backend", "state"))
+BACKEND_HEALTHY = Gauge("kv_backend_healthy", "Whether a backend is receiving jobs", ("backend",))
+WEBSOCKET_RECONNECTS = Counter("kv_websocket_reconnects_total", "ComfyUI websocket reconnects", ("backend",))
+
+REGISTRY: List[Metric] = [STAGE_SECONDS, INFLIGHT_JOBS, SCHEDULED_JOBS, BACKGROUND_JOBS, BACKEND_QUEUE_DEPTH,
+                          BACKEND_HEALTHY, WEBSOCKET_RECONNECTS]
+
+
+@contextmanager
+def labels(**values: Optional[str]):
+    """Attach labels such as route or template to every stage timed inside the block"""
+    token = _labels.set({**_labels.get(), **{name: value for name, value in values.items() if value is not None}})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def set_labels(**values: Optional[str]):
+    """Like ``labels``, for the rest of the current task, e.g. from a before_request hook"""
+    _labels.set({**_labels.get(), **{name: value for name, value in values.items() if value is not None}})
+
+
+def lora_label(lora_name: Optional[str]) -> str:
+    """The lora_name label value for a requested LoRA"""
+    if lora_name in _lora_labels:
+        return lora_name
+    if lora_name and not METRICS_LORA_NAMES and len(_lora_labels) < METRICS_MAX_LORA_LABELS:
+        _lora_labels.add(lora_name)
+        return lora_name
+    return "other"
+
+
+def current_labels() -> Dict[str, str]:
+    return dict(_labels.get())
+
+
+def observe_stage(stage: str, seconds: float, **values: Optional[str]):
+    current = {**_labels.get(), **{name: value for name, value in values.items() if value is not None}}
+    STAGE_SECONDS.observe(seconds, stage=stage, **current)
+
+
+@contextmanager
+def time_stage(stage: str, **values: Optional[str]):
+    """Time the block on the monotonic clock and record it under ``stage``"""
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.monotonic() - started, **values)
+
+
+def render() -> str:
+    """Every metric in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
@@ -2,12 +2,12 @@ import uuid
 import json
 import urllib.request
 import urllib.parse
-import requests
 import argparse
 import os
 import logging
 from websocket import create_connection, WebSocketTimeoutException
 import time
+from upload_cache import get_upload_cache
 
 # Initialize logger
 logger = logging.getLogger(__name__)
@@ -54,33 +54,12 @@ def upload_file(file, subfolder="", overwrite=False):
             return None
             
         with open(file, 'rb') as f:
-            files = {'image': ('image.jpg', f, 'image/jpeg')}
-            data = {}
-            
-            if overwrite:
-                data["overwrite"] = "true"
-            if subfolder:
-                data["subfolder"] = subfolder
-
-            # Create upload-specific headers without Content-Type (requests will set it automatically for multipart/form-data)
-            upload_headers = {
-                'Authorization': headers['Authorization']
-            }
+            data = f.read()
 
-            print(f"Sending request to: http://{server_address}/upload/image")
-            resp = requests.post(f"http://{server_address}/upload/image", files=files, data=data, headers=upload_headers)
-            print(f"Request headers: {upload_headers}")
-            
-            if resp.status_code == 200:
-                data = resp.json()
-                path = data["name"]
-                if "subfolder" in data and data["subfolder"]:
-                    path = f"{data['subfolder']}/{path}"
-                return path
-            else:
-                print(f"{resp.status_code} - {resp.reason}")
-                print("Response content:", resp.text)
-                print("Response headers:", resp.headers)
+        # Skipped when the server still has this exact image from an earlier run
+        entry = get_upload_cache().upload_sync(server_address, headers['Authorization'], data,
+                                               os.path.basename(file), subfolder)
+        return entry["path"]
     except Exception as error:
         print(f"Error: {error}")
         return None
@@ -0,0 +1,147 @@
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+from metrics import Histogram, REGISTRY
+import logging
+logger = logging.getLogger(__name__)
+
+# Recent prompts per template and backend that the rolling figures are computed over
+PROFILE_WINDOW = int(os.environ.get("NODE_PROFILE_WINDOW", 100))
+
+NODE_SECONDS = Histogram("kv_node_duration_seconds", "Wall time of each ComfyUI node",
+                         ("template", "backend", "node", "class_type"))
+REGISTRY.append(NODE_SECONDS)
+
+
+def percentile(values, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class PromptProfile:
+    """Times the nodes of one prompt from its websocket events.
+
+    A node runs from its ``executing`` event until the next one; the last
+    node ends with ``executing`` for node None. Nodes listed by
+    ``execution_cached`` are counted as cached and take no time.
+    """
+
+    def __init__(self, workflow: Dict[str, Any], template: Optional[str], backend: str):
+        self.workflow = workflow
+        self.template = template or "unknown"
+        self.backend = backend
+        self.queued_at = time.monotonic()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.nodes: Dict[str, float] = {}
+        self.cached = set()
+        self._node: Optional[str] = None
+        self._node_started = 0.0
+        # Set when events went missing, e.g. while the websocket was down
+        self.incomplete = False
+
+    def class_type(self, node_id: str) -> str:
+        return self.workflow.get(node_id, {}).get("class_type", "unknown")
+
+    def observe(self, event_type: str, data: Dict[str, Any]):
+        now = time.monotonic()
+        if event_type == "execution_start":
+            self.started_at = now
+        elif event_type == "execution_cached":
+            self.cached.update(str(node) for node in data.get("nodes", []))
+        elif event_type == "executing":
+            if self.started_at is None:
+                self.started_at = now
+            if self._node is not None:
+                self.nodes[self._node] = self.nodes.get(self._node, 0.0) + now - self._node_started
+            self._node = data.get("node")
+            self._node_started = now
+            if self._node is None:
+                self.finished_at = now
+        elif event_type == "disconnected":
+            self.incomplete = True
+
+    @property
+    def complete(self) -> bool:
+        return self.finished_at is not None and not self.incomplete
+
+
+class NodeProfiler:
+    """Rolling per-node timings of recent prompts, per template and backend.
+
+    Shows where a template's time goes on each backend: model loads such as
+    UnetLoaderGGUF, DualCLIPLoaderGGUF, LoraLoader or the Qwen2 loaders
+    against KSampler and VAEDecode, and how often each is served from cache.
+    """
+
+    def __init__(self, window: int = PROFILE_WINDOW):
+        self.window = window
+        # (template, backend) -> recent totals: queue wait and execution time
+        self.prompts: Dict[Tuple[str, str], Deque[Tuple[float, float]]] = {}
+        # (template, backend, node_id) -> class_type and recent (seconds, cached) samples
+        self.nodes: Dict[Tuple[str, str, str], Tuple[str, Deque[Tuple[float, bool]]]] = {}
+
+    def record(self, profile: PromptProfile):
+        if not profile.complete:
+            return
+        key = (profile.template, profile.backend)
+        self.prompts.setdefault(key, deque(maxlen=self.window)).append(
+            (profile.started_at - profile.queued_at, profile.finished_at - profile.started_at))
+        for node_id in set(profile.nodes) | profile.cached:
+            class_type = profile.class_type(node_id)
+            seconds = profile.nodes.get(node_id, 0.0)
+            cached = node_id in profile.cached
+            entry = self.nodes.get(key + (node_id,))
+            if entry is None:
+                entry = self.nodes[key + (node_id,)] = (class_type, deque(maxlen=self.window))
+            entry[1].append((seconds, cached))
+            if not cached:
+                NODE_SECONDS.observe(seconds, template=profile.template, backend=profile.backend,
+                                     node=node_id, class_type=class_type)
+
+    def to_dict(self, template: Optional[str] = None) -> Dict[str, Any]:
+        """Per template and backend: prompt totals, then nodes by mean time, slowest first"""
+        report: Dict[str, Any] = {}
+        for (prompt_template, backend), totals in self.prompts.items():
+            if template is not None and prompt_template != template:
+                continue
+            execution = [seconds for _, seconds in totals]
+            mean_execution = sum(execution) / len(execution)
+            nodes = []
+            for (node_template, node_backend, node_id), (class_type, samples) in self.nodes.items():
+                if (node_template, node_backend) != (prompt_template, backend):
+                    continue
+                ran = [seconds for seconds, cached in samples if not cached]
+                mean = sum(ran) / len(ran) if ran else 0.0
+                nodes.append({
+                    "node": node_id,
+                    "class_type": class_type,
+                    "samples": len(samples),
+                    "cached_rate": round(1 - len(ran) / len(samples), 3),
+                    "mean_seconds": round(mean, 3),
+                    "p50_seconds": round(percentile(ran, 0.5), 3) if ran else None,
+                    "p95_seconds": round(percentile(ran, 0.95), 3) if ran else None,
+                    "max_seconds": round(max(ran), 3) if ran else None,
+                    # Of a prompt's execution time, counting the runs where the node was cached
+                    "share": round(sum(ran) / len(samples) / mean_execution, 3) if mean_execution else None
+                })
+            nodes.sort(key=lambda node: node["mean_seconds"], reverse=True)
+            report.setdefault(prompt_template, {})[backend] = {
+                "prompts": len(totals),
+                "mean_queue_seconds": round(sum(wait for wait, _ in totals) / len(totals), 3),
+                "mean_execution_seconds": round(mean_execution, 3),
+                "nodes": nodes
+            }
+        return report
+
+
+_profiler: Optional[NodeProfiler] = None
+
+
+def get_profiler() -> NodeProfiler:
+    """Process-wide node profiler"""
+    global _profiler
+    if _profiler is None:
+        _profiler = NodeProfiler()
+    return _profiler
@@ -0,0 +1,185 @@
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Tuple, Union
+import aiohttp
+from image_postprocess import ImagePostprocessor, get_postprocessor
+from image_stream import SpooledImage
+from metrics import time_stage
+from supabase_client import SupabaseClient
+import logging
+logger = logging.getLogger(__name__)
+
+# Storage uploads in flight at once, across every generation on the worker
+PERSIST_CONCURRENCY = int(os.environ.get("PERSIST_CONCURRENCY", 8))
+# Return generation results before their uploads finish unless a request says otherwise
+PERSIST_IN_BACKGROUND = os.environ.get("PERSIST_IN_BACKGROUND", "0") == "1"
+
+
+class ImagePersister:
+    """Uploads generated images to Supabase storage and records them in ``image_generations``.
+
+    One SupabaseClient is shared by the worker and its blocking calls run in
+    threads, off the event loop; spooled images are instead streamed to
+    storage over the persister's own HTTP session. Uploads fan out up to
+    PERSIST_CONCURRENCY at a time and the rows of a generation are written in
+    a single insert. In background mode the caller gets its rows back
+    straight away, public URLs included, while persistence finishes behind it.
+
+    With a post-processor, each image's WebP/AVIF master and thumbnails are
+    encoded and uploaded next to the PNG and listed in the row's ``variants``.
+    """
+
+    def __init__(self, concurrency: int = PERSIST_CONCURRENCY, postprocessor: Optional[ImagePostprocessor] = None):
+        self.concurrency = concurrency
+        self.postprocessor = postprocessor
+        self._client: Optional[SupabaseClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._tasks = set()
+
+    @property
+    def client(self) -> SupabaseClient:
+        if self._client is None:
+            self._client = SupabaseClient()
+        return self._client
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so it binds to the serving loop
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
+        return self._session
+
+    def public_url(self, filename: str) -> str:
+        return self.client.get_public_url(filename)
+
+    def variant_urls(self, filename: str) -> Optional[Dict[str, str]]:
+        """Public URLs the variants of ``filename`` will have, or None without post-processing"""
+        if self.postprocessor is None:
+            return None
+        return {variant: self.public_url(name) for variant, name in self.postprocessor.filenames(filename).items()}
+
+    async def persist(self, images: List[Tuple[str, Union[bytes, SpooledImage]]], rows: List[Dict[str, Any]],
+                      background: bool = PERSIST_IN_BACKGROUND) -> List[Dict[str, Any]]:
+        """Upload ``(filename, image)`` pairs and insert their metadata rows.
+
+        ``rows[i]`` describes ``images[i]`` and should already carry its public
+        URL; spooled images are closed once they and their variants are
+        stored. Returns the rows of images that were stored; in background
+        mode, all of them, as upload failures are only logged.
+        """
+        if background:
+            task = asyncio.create_task(self._persist(images, rows))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return rows
+        return await self._persist(images, rows)
+
+    async def _persist(self, images: List[Tuple[str, Union[bytes, SpooledImage]]],
+                       rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        with time_stage("upload_storage"):
+            results = await asyncio.gather(*(self._store(filename, data, row)
+                                             for (filename, data), row in zip(images, rows)),
+                                           return_exceptions=True)
+        stored = []
+        for (filename, _), row, result in zip(images, rows, results):
+            if isinstance(result, BaseException):
+                print(f"Error processing image: {str(result)}")
+                continue
+            stored.append(row)
+        try:
+            with time_stage("save_metadata"):
+                await self._save_rows(stored)
+            print(f"Images uploaded and metadata saved: {', '.join(row['filename'] for row in stored)}")
+        except Exception as e:
+            # The images are in storage and their URLs work; only the history rows are missing
+            logger.error(f"Failed to save metadata for {len(stored)} image(s): {e}")
+        return stored
+
+    async def _save_rows(self, rows: List[Dict[str, Any]]):
+        try:
+            await asyncio.to_thread(self.client.save_generation_metadata_bulk, rows)
+        except Exception as e:
+            if not any("variants" in row for row in rows):
+                raise
+            # A database without the variants column still gets its history rows
+            logger.warning(f"Saving rows without variants after: {e}")
+            rows = [{key: value for key, value in row.items() if key != "variants"} for row in rows]
+            await asyncio.to_thread(self.client.save_generation_metadata_bulk, rows)
+
+    async def _store(self, filename: str, data: Union[bytes, SpooledImage], row: Dict[str, Any]):
+        """Upload one image, and its variants when the row lists them; closes a spooled image when done"""
+        try:
+            await self._store_image(filename, data, row)
+        finally:
+            if isinstance(data, SpooledImage):
+                data.close()
+
+    async def _store_image(self, filename: str, data: Union[bytes, SpooledImage], row: Dict[str, Any]):
+        render = None
+        if self.postprocessor is not None and row.get("variants"):
+            # Encoding runs in an encoder thread while the PNG uploads; a spilled
+            # spool is opened by path rather than read into memory here
+            source = data.source() if isinstance(data, SpooledImage) else data
+            render = asyncio.ensure_future(self.postprocessor.render(source))
+        try:
+            await self._upload(filename, data)
+        except BaseException:
+            if render is not None:
+                render.cancel()
+            raise
+        if render is None:
+            return
+
+        names = self.postprocessor.filenames(filename)
+        try:
+            variants = await render
+        except Exception as e:
+            logger.error(f"Failed to encode variants of {filename}: {e}")
+            row.pop("variants", None)
+            return
+        results = await asyncio.gather(*(
+            self._upload(names[variant], variant_data, self.postprocessor.content_type(variant))
+            for variant, variant_data in variants.items()
+        ), return_exceptions=True)
+        for variant, result in zip(variants, results):
+            if isinstance(result, BaseException):
+                logger.error(f"Failed to upload {names[variant]}: {result}")
+                row["variants"].pop(variant, None)
+
+    async def _upload(self, filename: str, data: Union[bytes, SpooledImage], content_type: str = "image/png") -> str:
+        async with self.semaphore:
+            if not isinstance(data, SpooledImage):
+                return await asyncio.to_thread(self.client.upload_image, data, filename, content_type)
+            return await self.client.upload_image_stream(self.session, data.chunks(), data.size, filename,
+                                                         data.content_type)
+
+    async def drain(self):
+        """Wait for background persistence to finish, e.g. before shutdown"""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def close(self):
+        await self.drain()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self.postprocessor is not None:
+            self.postprocessor.close()
+
+
+_persister: Optional[ImagePersister] = None
+
+
+def get_persister() -> ImagePersister:
+    """Process-wide image persister"""
+    global _persister
+    if _persister is None:
+        _persister = ImagePersister(postprocessor=get_postprocessor())
+    return _persister
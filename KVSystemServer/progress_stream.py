@@ -0,0 +1,109 @@
+import asyncio
+import io
+import json
+import os
+import time
+from typing import Any, Dict
+from image_stream import encode_thumbnail
+from job_manager import JOB_SYNC_SECONDS, Job, JobRegistry, SharedJob
+import logging
+logger = logging.getLogger(__name__)
+
+# Latent previews are throttled per job and downscaled before being streamed
+PREVIEW_FPS = float(os.environ.get("PREVIEW_FPS", 2))
+PREVIEW_MAX_SIZE = int(os.environ.get("PREVIEW_MAX_SIZE", 256))
+PREVIEW_QUALITY = int(os.environ.get("PREVIEW_QUALITY", 70))
+# Idle streams get a comment line this often so proxies keep them open
+KEEPALIVE_SECONDS = 15
+
+
+def encode_preview(image: bytes) -> str:
+    """Downscale a ComfyUI preview frame and return it as a JPEG data URL"""
+    return encode_thumbnail(io.BytesIO(image), PREVIEW_MAX_SIZE, PREVIEW_QUALITY)
+
+
+class JobProgress:
+    """Turns a job's ComfyUI events into progress updates for its listeners.
+
+    Passed to AsyncImageProcessor as ``on_event``; previews beyond
+    PREVIEW_FPS are dropped before they are decoded.
+    """
+
+    def __init__(self, job: Job):
+        self.job = job
+        self.last_preview = 0.0
+
+    async def __call__(self, event: Dict[str, Any]):
+        event_type, data = event["type"], event["data"]
+        if event_type == "queued":
+            self.job.update_progress(stage="queued", prompt_id=data.get("prompt_id"))
+        elif event_type == "queue":
+            self.job.update_progress(queue_position=data["position"])
+        elif event_type == "execution_start":
+            self.job.update_progress(stage="running", queue_position=0)
+        elif event_type == "executing" and data.get("node") is not None:
+            self.job.update_progress(stage="running", queue_position=0, node=data["node"])
+        elif event_type == "progress":
+            self.job.update_progress(step=data.get("value"), max_steps=data.get("max"), node=data.get("node"))
+        elif event_type == "stage":
+            self.job.update_progress(stage=data["stage"])
+        elif event_type == "preview":
+            await self._preview(data)
+
+    async def _preview(self, data: Dict[str, Any]):
+        if not self.job.subscribers or PREVIEW_FPS <= 0:
+            return
+        now = time.monotonic()
+        if now - self.last_preview < 1.0 / PREVIEW_FPS:
+            return
+        self.last_preview = now
+        try:
+            image = await asyncio.to_thread(encode_preview, data["image"])
+        except Exception as e:
+            logger.debug(f"Skipping undecodable preview: {e}")
+            return
+        self.job.publish("preview", {"image": image, "step": self.job.progress.get("step")})
+
+
+def format_sse(event_type: str, data: Any) -> bytes:
+    return f"event: {event_type}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+
+
+async def stream_job_events(job: Job):
+    """Yield a job's progress as server-sent events until it finishes"""
+    queue = job.subscribe()
+    try:
+        yield format_sse("progress", dict(job.progress))
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield b": keepalive\n\n"
+                continue
+            if item is None:
+                return
+            yield format_sse(*item)
+    finally:
+        job.unsubscribe(queue)
+
+
+async def stream_shared_job_events(registry: JobRegistry, job: SharedJob):
+    """Yield the progress of a job another worker runs, polling its shared state, until it finishes"""
+    yield format_sse("progress", job.progress)
+    last_sent = time.monotonic()
+    while not job.done:
+        await asyncio.sleep(JOB_SYNC_SECONDS)
+        latest = await registry.lookup(job.id)
+        if latest is None:
+            # Forgotten by the shared store; the client can still poll for it
+            return
+        if latest.status != job.status:
+            yield format_sse("status", latest.to_dict())
+            last_sent = time.monotonic()
+        elif latest.progress != job.progress:
+            yield format_sse("progress", latest.progress)
+            last_sent = time.monotonic()
+        elif time.monotonic() - last_sent >= KEEPALIVE_SECONDS:
+            yield b": keepalive\n\n"
+            last_sent = time.monotonic()
+        job = latest
@@ -0,0 +1,64 @@
+import hashlib
+import io
+import os
+from typing import Any, Dict, List, Optional
+from PIL import Image
+from disk_cache import DiskCache
+import logging
+logger = logging.getLogger(__name__)
+
+VLM_CACHE_MAX_ENTRIES = int(os.environ.get("VLM_CACHE_MAX_ENTRIES", 5000))
+VLM_CACHE_TTL_SECONDS = float(os.environ.get("VLM_CACHE_TTL_SECONDS", 30 * 24 * 3600))
+# Also match re-encoded or resized copies of an image by its difference hash.
+# Off by default: visually near-identical images would share a prompt.
+VLM_CACHE_PERCEPTUAL = os.environ.get("VLM_CACHE_PERCEPTUAL", "0") == "1"
+
+
+def difference_hash(image_bytes: bytes) -> str:
+    """64-bit dHash: brightness gradients of a 9x8 grayscale thumbnail"""
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        pixels = list(image.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            bits = (bits << 1) | (left > right)
+    return f"{bits:016x}"
+
+
+class PromptCache:
+    """Prompts extracted by the VLM workflow, keyed by image content and workflow version.
+
+    A new template version (any change to the workflow JSON) starts from an
+    empty cache, since its prompts would differ.
+    """
+
+    def __init__(self, cache: Optional[DiskCache] = None, perceptual: bool = VLM_CACHE_PERCEPTUAL):
+        self.cache = cache or DiskCache("vlm_prompts", VLM_CACHE_MAX_ENTRIES, VLM_CACHE_TTL_SECONDS)
+        self.perceptual = perceptual
+
+    def keys(self, image_bytes: bytes, template_version: str) -> List[str]:
+        """Lookup keys for an image, exact content hash first"""
+        keys = [f"{template_version}:sha256:{hashlib.sha256(image_bytes).hexdigest()}"]
+        if self.perceptual:
+            try:
+                keys.append(f"{template_version}:dhash:{difference_hash(image_bytes)}")
+            except Exception as e:
+                logger.debug(f"No perceptual hash for image: {e}")
+        return keys
+
+    async def get(self, keys: List[str]) -> Optional[Dict[str, Any]]:
+        for key in keys:
+            entry = await self.cache.aget(key)
+            if entry is not None:
+                return entry
+        return None
+
+    async def put(self, keys: List[str], final_prompt: str, steps: List[Dict[str, Any]]):
+        entry = {"final_prompt": final_prompt, "steps": steps}
+        for key in keys:
+            await self.cache.aset(key, entry)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**self.cache.to_dict(), "perceptual": self.perceptual}
@@ -0,0 +1,126 @@
+import hashlib
+import os
+from typing import Any, Dict, Optional
+import aiohttp
+import requests
+from disk_cache import DiskCache
+import logging
+logger = logging.getLogger(__name__)
+
+UPLOAD_CACHE_MAX_ENTRIES = int(os.environ.get("UPLOAD_CACHE_MAX_ENTRIES", 20000))
+UPLOAD_CACHE_TTL_SECONDS = float(os.environ.get("UPLOAD_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+
+
+def content_filename(digest: str, filename: Optional[str]) -> str:
+    """Name an upload after its content so the same bytes always land on the same file"""
+    extension = os.path.splitext(filename or "")[1].lower() or ".png"
+    return f"{digest[:32]}{extension}"
+
+
+def server_path(entry: Dict[str, Any]) -> str:
+    """The path LoadImage expects: name, prefixed by the subfolder if there is one"""
+    if entry.get("subfolder"):
+        return f"{entry['subfolder']}/{entry['name']}"
+    return entry["name"]
+
+
+class UploadCache:
+    """Remembers what each ComfyUI backend holds in its input folder, by content hash.
+
+    A repeat upload of the same bytes to the same backend is answered from
+    the cache after a HEAD ``/view?type=input`` confirms the file is still
+    there; if the backend was restarted or its input folder cleared, the
+    image is uploaded again. Uploads are named after their sha256, so
+    re-uploading never creates duplicates on the server.
+    """
+
+    def __init__(self, cache: Optional[DiskCache] = None):
+        self.cache = cache or DiskCache("uploads", UPLOAD_CACHE_MAX_ENTRIES, UPLOAD_CACHE_TTL_SECONDS)
+        self.skipped = 0
+        self.uploaded = 0
+
+    @staticmethod
+    def key(server_address: str, digest: str, subfolder: str) -> str:
+        return f"{server_address}:{subfolder}:{digest}"
+
+    async def upload(self, session: aiohttp.ClientSession, server_address: str, authorization: str,
+                     data: bytes, filename: Optional[str] = None, subfolder: str = "") -> Dict[str, Any]:
+        """Make sure ``data`` is in the backend's input folder; return its name, subfolder and path"""
+        headers = {'Authorization': authorization}
+        digest = hashlib.sha256(data).hexdigest()
+        key = self.key(server_address, digest, subfolder)
+
+        entry = await self.cache.aget(key)
+        if entry is not None:
+            params = {"filename": entry["name"], "subfolder": entry.get("subfolder", ""), "type": "input"}
+            try:
+                async with session.head(f"http://{server_address}/view", params=params,
+                                        headers=headers) as response:
+                    if response.status == 200:
+                        self.skipped += 1
+                        return entry
+            except aiohttp.ClientError as e:
+                logger.debug(f"Could not verify cached upload {entry['name']}: {e}")
+            logger.info(f"{server_address} no longer has {entry['name']}; uploading again")
+
+        form = aiohttp.FormData()
+        form.add_field('image', data, filename=content_filename(digest, filename))
+        form.add_field('overwrite', 'true')
+        if subfolder:
+            form.add_field('subfolder', subfolder)
+        async with session.post(f"http://{server_address}/upload/image", data=form,
+                                headers=headers) as response:
+            if response.status != 200:
+                raise Exception(f"Server returned status {response.status}")
+            result = await response.json()
+        entry = {"name": result["name"], "subfolder": result.get("subfolder", "")}
+        entry["path"] = server_path(entry)
+        await self.cache.aset(key, entry)
+        self.uploaded += 1
+        return entry
+
+    def upload_sync(self, server_address: str, authorization: Optional[str], data: bytes,
+                    filename: Optional[str] = None, subfolder: str = "") -> Dict[str, Any]:
+        """Blocking twin of ``upload`` for the requests-based scripts"""
+        headers = {'Authorization': authorization} if authorization else {}
+        digest = hashlib.sha256(data).hexdigest()
+        key = self.key(server_address, digest, subfolder)
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            params = {"filename": entry["name"], "subfolder": entry.get("subfolder", ""), "type": "input"}
+            try:
+                response = requests.head(f"http://{server_address}/view", params=params, headers=headers)
+                if response.status_code == 200:
+                    self.skipped += 1
+                    return entry
+            except requests.RequestException as e:
+                logger.debug(f"Could not verify cached upload {entry['name']}: {e}")
+
+        files = {"image": (content_filename(digest, filename), data)}
+        form = {"overwrite": "true"}
+        if subfolder:
+            form["subfolder"] = subfolder
+        response = requests.post(f"http://{server_address}/upload/image", files=files, data=form, headers=headers)
+        if response.status_code != 200:
+            raise Exception(f"{response.status_code} - {response.reason}")
+        result = response.json()
+        entry = {"name": result["name"], "subfolder": result.get("subfolder", "")}
+        entry["path"] = server_path(entry)
+        self.cache.set(key, entry)
+        self.uploaded += 1
+        return entry
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**self.cache.to_dict(), "uploads_skipped": self.skipped, "uploads_sent": self.uploaded}
+
+
+_upload_cache: Optional[UploadCache] = None
+
+
+def get_upload_cache() -> UploadCache:
+    """Process-wide upload cache"""
+    global _upload_cache
+    if _upload_cache is None:
+        _upload_cache = UploadCache()
+    return _upload_cache
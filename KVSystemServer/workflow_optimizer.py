@@ -0,0 +1,213 @@
+import json
+import os
+from collections import deque
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from metrics import Counter, REGISTRY
+from workflow_registry import WorkflowTemplate, WorkflowValidationError, validate_graph
+import logging
+logger = logging.getLogger(__name__)
+
+# Rewrite bound workflows before they are queued; 0 sends them exactly as the template has them
+OPTIMIZE_WORKFLOWS = os.environ.get("OPTIMIZE_WORKFLOWS", "1") == "1"
+
+# Samplers that skip the negative conditioning entirely when cfg is 1
+CFG_SAMPLERS = {"KSampler", "KSamplerAdvanced"}
+# Display nodes whose output 0 is the value of this input, unchanged
+PASSTHROUGH_NODES = {"ShowText|pysssss": "text"}
+# Nodes with effects beyond their outputs, never merged even when identical
+SIDE_EFFECT_NODES = {"SaveImage", "PreviewImage", "ShowText|pysssss"}
+
+NODES_REMOVED = Counter("kv_workflow_nodes_removed_total", "Nodes the workflow optimizer removed before queuing",
+                        ("template", "reason"))
+REGISTRY.append(NODES_REMOVED)
+
+
+def is_link(workflow: Dict[str, Any], value: Any) -> bool:
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int) and str(value[0]) in workflow
+
+
+def topological_order(name: str, workflow: Dict[str, Any]) -> List[str]:
+    """Node ids, every node after the nodes it reads from; raises on a cycle"""
+    consumers: Dict[str, List[str]] = {node_id: [] for node_id in workflow}
+    pending = {}
+    for node_id, node in workflow.items():
+        sources = {str(value[0]) for value in node["inputs"].values() if is_link(workflow, value)}
+        pending[node_id] = len(sources)
+        for source in sources:
+            consumers[source].append(node_id)
+    ready = deque(node_id for node_id, count in pending.items() if not count)
+    order = []
+    while ready:
+        node_id = ready.popleft()
+        order.append(node_id)
+        for consumer in consumers[node_id]:
+            pending[consumer] -= 1
+            if not pending[consumer]:
+                ready.append(consumer)
+    if len(order) != len(workflow):
+        raise WorkflowValidationError(f"{name}: workflow has a cycle through nodes "
+                                      f"{', '.join(sorted(set(workflow) - set(order)))}")
+    return order
+
+
+def verify_workflow(name: str, workflow: Dict[str, Any], outputs: Iterable[str]):
+    """Raise WorkflowValidationError unless the workflow is a well-formed, acyclic graph holding ``outputs``"""
+    validate_graph(name, workflow)
+    for node_id in outputs:
+        if node_id not in workflow:
+            raise WorkflowValidationError(f"{name}: output node {node_id} is missing")
+    topological_order(name, workflow)
+
+
+def optimize_workflow(name: str, workflow: Dict[str, Any],
+                      outputs: Iterable[str]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Remove work that cannot change the requested outputs; returns the new workflow and what was removed.
+
+    In order: a sampler running at cfg 1 reads its positive conditioning as
+    the negative too, since it never evaluates the negative; display-only
+    passthrough nodes are bypassed; nodes with the same class and inputs,
+    such as two loaders of one model, are merged; and every node that no
+    requested output depends on is dropped. Nodes are copied before they
+    change, so ``workflow`` and the template it shares nodes with stay intact.
+    """
+    outputs = set(outputs)
+    workflow = dict(workflow)
+    copied = set()
+    report = {"nodes_before": len(workflow), "rewired": [], "bypassed": [], "merged": {}, "pruned": []}
+
+    def editable(node_id: str) -> Dict[str, Any]:
+        if node_id not in copied:
+            node = dict(workflow[node_id])
+            node["inputs"] = dict(node["inputs"])
+            workflow[node_id] = node
+            copied.add(node_id)
+        return workflow[node_id]
+
+    def relink(old: str, new: str):
+        """Point every input reading an output of node ``old`` at the same output of ``new``"""
+        for node_id, node in list(workflow.items()):
+            for input_name, value in node["inputs"].items():
+                if is_link(workflow, value) and str(value[0]) == old:
+                    editable(node_id)["inputs"][input_name] = [new, value[1]]
+
+    def prune():
+        needed = set()
+        stack = [node_id for node_id in outputs if node_id in workflow]
+        while stack:
+            node_id = stack.pop()
+            if node_id in needed:
+                continue
+            needed.add(node_id)
+            stack.extend(str(value[0]) for value in workflow[node_id]["inputs"].values()
+                         if is_link(workflow, value))
+        for node_id in list(workflow):
+            if node_id not in needed:
+                del workflow[node_id]
+                report["pruned"].append(node_id)
+
+    for node_id, node in list(workflow.items()):
+        inputs = node["inputs"]
+        if node["class_type"] in CFG_SAMPLERS and isinstance(inputs.get("cfg"), (int, float)) \
+                and inputs["cfg"] == 1 and is_link(workflow, inputs.get("positive")) \
+                and is_link(workflow, inputs.get("negative")) and inputs["negative"] != inputs["positive"]:
+            editable(node_id)["inputs"]["negative"] = list(inputs["positive"])
+            report["rewired"].append(node_id)
+
+    for node_id in topological_order(name, workflow):
+        node = workflow[node_id]
+        source = node["inputs"].get(PASSTHROUGH_NODES.get(node["class_type"], ""))
+        if node_id in outputs or not is_link(workflow, source):
+            continue
+        # Only output 0 passes through, so any other reader keeps the node
+        readers = [value for other in workflow.values() for value in other["inputs"].values()
+                   if is_link(workflow, value) and str(value[0]) == node_id]
+        if readers and all(value[1] == 0 for value in readers):
+            for other_id, other in list(workflow.items()):
+                for input_name, value in other["inputs"].items():
+                    if is_link(workflow, value) and str(value[0]) == node_id:
+                        editable(other_id)["inputs"][input_name] = list(source)
+            del workflow[node_id]
+            report["bypassed"].append(node_id)
+
+    # Unused duplicates are pruned rather than merged
+    prune()
+    merged = True
+    while merged:
+        merged = False
+        seen: Dict[str, str] = {}
+        for node_id in topological_order(name, workflow):
+            node = workflow[node_id]
+            if node_id in outputs or node["class_type"] in SIDE_EFFECT_NODES:
+                continue
+            signature = node["class_type"] + json.dumps(node["inputs"], sort_keys=True, default=str)
+            kept = seen.setdefault(signature, node_id)
+            if kept != node_id:
+                relink(node_id, kept)
+                del workflow[node_id]
+                report["merged"][node_id] = kept
+                # Consumers of the merged node may now be identical too
+                merged = True
+                break
+
+    prune()
+    report["nodes_after"] = len(workflow)
+    return workflow, report
+
+
+class WorkflowOptimizer:
+    """Runs optimize_workflow on bound workflows and keeps per-template totals of what it saved.
+
+    The graph is verified before the pass, which raises on a malformed
+    workflow, and after it; should the optimized graph ever fail
+    verification, the workflow is queued unchanged instead.
+    """
+
+    def __init__(self, enabled: bool = OPTIMIZE_WORKFLOWS):
+        self.enabled = enabled
+        self.totals: Dict[str, Dict[str, int]] = {}
+
+    def optimize(self, template: WorkflowTemplate, workflow: Dict[str, Any]) -> Dict[str, Any]:
+        outputs = list(template.outputs.values())
+        verify_workflow(template.name, workflow, outputs)
+        if not self.enabled:
+            return workflow
+        optimized, report = optimize_workflow(template.name, workflow, outputs)
+        try:
+            verify_workflow(template.name, optimized, outputs)
+        except WorkflowValidationError as e:
+            logger.error(f"Optimizing {template.name} produced an invalid workflow, queuing it unchanged: {e}")
+            return workflow
+
+        totals = self.totals.setdefault(template.name, {
+            "workflows": 0, "nodes_before": 0, "nodes_after": 0, "rewired": 0, "bypassed": 0, "merged": 0,
+            "pruned": 0})
+        totals["workflows"] += 1
+        for key in ("nodes_before", "nodes_after"):
+            totals[key] += report[key]
+        for reason in ("bypassed", "merged", "pruned"):
+            totals[reason] += len(report[reason])
+            if report[reason]:
+                NODES_REMOVED.inc(len(report[reason]), template=template.name, reason=reason)
+        totals["rewired"] += len(report["rewired"])
+        logger.debug(f"Optimized {template.name}: {report['nodes_before']} -> {report['nodes_after']} nodes "
+                     f"(rewired {report['rewired']}, bypassed {report['bypassed']}, merged {report['merged']}, "
+                     f"pruned {report['pruned']})")
+        return optimized
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "templates": {name: {**totals, "nodes_saved": totals["nodes_before"] - totals["nodes_after"]}
+                          for name, totals in self.totals.items()}
+        }
+
+
+_optimizer: Optional[WorkflowOptimizer] = None
+
+
+def get_optimizer() -> WorkflowOptimizer:
+    """Process-wide workflow optimizer"""
+    global _optimizer
+    if _optimizer is None:
+        _optimizer = WorkflowOptimizer()
+    return _optimizer
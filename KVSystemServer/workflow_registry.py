@@ -0,0 +1,143 @@
+import hashlib
+import json
+import os
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Tuple
+import logging
+logger = logging.getLogger(__name__)
+
+WORKFLOW_DIR = os.path.join(os.path.dirname(__file__), "workflow")
+SLOTS_SUFFIX = ".slots.json"
+
+
+class WorkflowValidationError(ValueError):
+    """Raised when a workflow or its slot manifest is malformed"""
+
+
+class WorkflowTemplate:
+    """An immutable, validated ComfyUI API-format workflow with named parameter slots.
+
+    ``bind`` produces a request-ready workflow by copying only the nodes whose
+    inputs change; every other node is shared with the template, so bound
+    workflows must be treated as read-only.
+    """
+
+    def __init__(self, name: str, graph: Dict[str, Any], slots: Dict[str, List[Tuple[str, str]]],
+                 outputs: Dict[str, str]):
+        self.name = name
+        self.graph: Mapping[str, Any] = MappingProxyType(graph)
+        self.slots: Mapping[str, List[Tuple[str, str]]] = MappingProxyType(slots)
+        self.outputs: Mapping[str, str] = MappingProxyType(outputs)
+        canonical = json.dumps(graph, sort_keys=True, separators=(",", ":"))
+        self.version = hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:12]
+
+    def bind(self, **values) -> Dict[str, Any]:
+        """Return a workflow with the given slot values applied"""
+        unknown = set(values) - set(self.slots)
+        if unknown:
+            raise KeyError(f"Workflow {self.name} has no slot(s): {', '.join(sorted(unknown))}")
+
+        workflow = dict(self.graph)
+        copied = {}
+        for slot, value in values.items():
+            for node_id, input_name in self.slots[slot]:
+                node = copied.get(node_id)
+                if node is None:
+                    node = dict(workflow[node_id])
+                    node["inputs"] = dict(node["inputs"])
+                    copied[node_id] = workflow[node_id] = node
+                node["inputs"][input_name] = value
+        return workflow
+
+    def default(self, slot: str) -> Any:
+        """Return the template's own value for a slot"""
+        node_id, input_name = self.slots[slot][0]
+        return self.graph[node_id]["inputs"][input_name]
+
+
+def validate_graph(name: str, graph: Any):
+    """Raise WorkflowValidationError unless ``graph`` is API-format nodes whose links all resolve"""
+    if not isinstance(graph, dict) or not graph:
+        raise WorkflowValidationError(f"{name}: workflow must be a non-empty API-format object")
+    for node_id, node in graph.items():
+        if not isinstance(node, dict) or not isinstance(node.get("class_type"), str) \
+                or not isinstance(node.get("inputs"), dict):
+            raise WorkflowValidationError(f"{name}: node {node_id} needs a class_type and inputs")
+        for input_name, value in node["inputs"].items():
+            if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+                if str(value[0]) not in graph:
+                    raise WorkflowValidationError(
+                        f"{name}: node {node_id} input {input_name} links to missing node {value[0]}")
+
+
+def _parse_slots(name: str, graph: Dict[str, Any], manifest: Dict[str, Any]):
+    slots = {}
+    for slot, targets in manifest.get("slots", {}).items():
+        if isinstance(targets, dict):
+            targets = [targets]
+        slots[slot] = []
+        for target in targets:
+            node_id, input_name = str(target["node"]), target["input"]
+            if node_id not in graph or input_name not in graph[node_id]["inputs"]:
+                raise WorkflowValidationError(f"{name}: slot {slot} targets missing input {node_id}.{input_name}")
+            slots[slot].append((node_id, input_name))
+
+    outputs = {key: str(node_id) for key, node_id in manifest.get("outputs", {}).items()}
+    for key, node_id in outputs.items():
+        if node_id not in graph:
+            raise WorkflowValidationError(f"{name}: output {key} refers to missing node {node_id}")
+    return slots, outputs
+
+
+class WorkflowRegistry:
+    """Every workflow in a directory, loaded and validated once at startup.
+
+    A workflow ``Foo.json`` exposes named slots when a ``Foo.slots.json``
+    manifest sits next to it, for example::
+
+        {"slots": {"width": {"node": "5", "input": "width"}},
+         "outputs": {"images": "9"}}
+    """
+
+    def __init__(self, directory: str = WORKFLOW_DIR):
+        self.directory = directory
+        self.templates: Dict[str, WorkflowTemplate] = {}
+
+    def load(self) -> "WorkflowRegistry":
+        templates = {}
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith(".json") or filename.endswith(SLOTS_SUFFIX):
+                continue
+            name = filename[:-len(".json")]
+            with open(os.path.join(self.directory, filename), "r", encoding="utf-8") as f:
+                graph = json.load(f)
+            validate_graph(name, graph)
+
+            manifest = {}
+            manifest_path = os.path.join(self.directory, name + SLOTS_SUFFIX)
+            if os.path.exists(manifest_path):
+                with open(manifest_path, "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            slots, outputs = _parse_slots(name, graph, manifest)
+            templates[name] = WorkflowTemplate(name, graph, slots, outputs)
+            logger.debug(f"Loaded workflow template {name} with slots {sorted(slots)}")
+
+        self.templates = templates
+        return self
+
+    def get(self, name: str) -> WorkflowTemplate:
+        try:
+            return self.templates[name]
+        except KeyError:
+            raise KeyError(f"Unknown workflow template: {name}")
+
+
+_default_registry = None
+
+
+def get_registry() -> WorkflowRegistry:
+    """Return the process-wide registry, loading it on first use"""
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = WorkflowRegistry().load()
+    return _default_registry